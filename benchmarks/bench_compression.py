@@ -0,0 +1,174 @@
+"""
+Size and speed benchmark of the output compression profiles.
+
+Builds a mosaic from representative MODIS tiles (the test fixture, or the tiles of a
+tile cache directory passed with --tiles) and runs the merged image write and the COG
+conversion with every compression profile, recording encode time and bytes:
+
+    python benchmarks/bench_compression.py --tiles $MODIS_CACHE_DIR/tiles --size 16
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import mercantile
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_bounds
+
+from compression import COMPRESSION_PROFILES, to_cog, write_multiband_tif
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+FIXTURE_TILE = Path(__file__).resolve().parent.parent / "tests/mock_data/tile.jpg"
+TILE_SIZE = 256
+ORIGIN_TILE = mercantile.Tile(x=270, y=178, z=9)
+
+
+def find_tiles(tiles_dir: Path) -> List[Path]:
+    return sorted(
+        path
+        for pattern in ("*.jpg", "*.jpeg", "*.png")
+        for path in tiles_dir.rglob(pattern)
+    )
+
+
+def build_mosaic(tile_paths: List[Path], size: int, path: Path):
+    """
+    Writes an uncompressed 3 band mosaic of size x size tiles, cycling through the
+    tiles with varying orientation so neighbouring tiles differ
+    """
+    tiles = []
+    for tile_path in tile_paths:
+        with rio.open(tile_path) as src:
+            tiles.append(src.read(indexes=[1, 2, 3]))
+    mosaic = np.zeros((3, size * TILE_SIZE, size * TILE_SIZE), dtype=np.uint8)
+    orientations = itertools.cycle(
+        [lambda a: a, np.fliplr, np.flipud, lambda a: np.flipud(np.fliplr(a))]
+    )
+    for index, (row, col) in enumerate(itertools.product(range(size), repeat=2)):
+        orient = next(orientations) if index % len(tiles) == 0 else lambda a: a
+        mosaic[
+            :,
+            row * TILE_SIZE : (row + 1) * TILE_SIZE,
+            col * TILE_SIZE : (col + 1) * TILE_SIZE,
+        ] = np.stack([orient(band) for band in tiles[index % len(tiles)]])
+
+    upper_left = mercantile.xy_bounds(ORIGIN_TILE)
+    lower_right = mercantile.xy_bounds(
+        ORIGIN_TILE.x + size - 1, ORIGIN_TILE.y + size - 1, ORIGIN_TILE.z
+    )
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=size * TILE_SIZE,
+        height=size * TILE_SIZE,
+        count=3,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_bounds(
+            upper_left.left,
+            lower_right.bottom,
+            lower_right.right,
+            upper_left.top,
+            size * TILE_SIZE,
+            size * TILE_SIZE,
+        ),
+    ) as dst:
+        dst.write(mosaic)
+
+
+def run_profiles(tile_paths: List[Path], size: int, repeat: int = 3) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = Path(tmp_dir) / "source.tif"
+        build_mosaic(tile_paths, size, source)
+        raw_bytes = size * size * TILE_SIZE * TILE_SIZE * 3
+        for profile in COMPRESSION_PROFILES.values():
+            merge_seconds, cog_seconds = [], []
+            for _ in range(repeat):
+                merged = Path(tmp_dir) / f"{profile.name}.tif"
+                start = time.perf_counter()
+                write_multiband_tif([source], merged, profile)
+                merge_seconds.append(time.perf_counter() - start)
+                merged_bytes = merged.stat().st_size
+
+                start = time.perf_counter()
+                to_cog(merged, profile)
+                cog_seconds.append(time.perf_counter() - start)
+                cog_bytes = merged.stat().st_size
+                merged.unlink()
+            result = {
+                "profile": profile.name,
+                "settings": profile.creation_options(),
+                "overview_resampling": profile.overview_resampling,
+                "merge_seconds": round(min(merge_seconds), 4),
+                "cog_seconds": round(min(cog_seconds), 4),
+                "merged_bytes": merged_bytes,
+                "cog_bytes": cog_bytes,
+                "compression_ratio": round(raw_bytes / cog_bytes, 3),
+                "megapixels_per_second": round(
+                    raw_bytes / 3 / 1e6 / (min(merge_seconds) + min(cog_seconds)), 2
+                ),
+            }
+            print(
+                f"{profile.name}: merge {result['merge_seconds']}s, "
+                f"cog {result['cog_seconds']}s, {cog_bytes} bytes "
+                f"(ratio {result['compression_ratio']})"
+            )
+            results.append(result)
+
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "mosaic": {"tiles_per_side": size, "source_tiles": len(tile_paths)},
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument(
+        "--tiles",
+        type=Path,
+        default=None,
+        help="Directory searched for tiles, e.g. a tile cache; defaults to the test tile",
+    )
+    arg_parser.add_argument("--size", type=int, default=8, help="Tiles per side")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"compression-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    args = arg_parser.parse_args(argv)
+
+    tile_paths = find_tiles(args.tiles) if args.tiles else [FIXTURE_TILE]
+    if not tile_paths:
+        arg_parser.error(f"No tiles found in {args.tiles}")
+
+    results = run_profiles(tile_paths, args.size, args.repeat)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
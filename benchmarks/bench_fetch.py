@@ -0,0 +1,262 @@
+"""
+End-to-end fetch benchmark against the local GIBS stand-in server.
+
+Runs `Modis.fetch` over a matrix of AOI sizes, layer counts and date counts. Every case
+runs in a fresh process so its peak RSS can be measured in isolation. Results are saved
+as JSON and can be compared against a previous run to spot regressions:
+
+    python benchmarks/bench_fetch.py --output benchmarks/results/new.json \
+        --compare benchmarks/results/baseline.json
+
+With `--memory-budget-mb` the fetches run with that memory budget, and every case
+records whether its peak RSS stayed within it.
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import mercantile
+
+from benchmarks.gibs_stub_server import GibsStubServer
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+LAYERS = [
+    "MODIS_Terra_CorrectedReflectance_TrueColor",
+    "MODIS_Aqua_CorrectedReflectance_TrueColor",
+    "MODIS_Terra_CorrectedReflectance_Bands721",
+]
+# Upper left tile of the benchmark AOIs at zoom level 9 (Central Europe)
+ORIGIN_TILE = mercantile.Tile(x=270, y=178, z=9)
+LAST_DATE = datetime(2019, 6, 30)
+
+
+def aoi_bbox(tiles_per_side: int) -> List[float]:
+    """
+    Bounding box covering exactly tiles_per_side x tiles_per_side zoom 9 tiles
+    """
+    upper_left = mercantile.bounds(ORIGIN_TILE)
+    lower_right = mercantile.bounds(
+        ORIGIN_TILE.x + tiles_per_side - 1, ORIGIN_TILE.y + tiles_per_side - 1, 9
+    )
+    # Shrink slightly so the neighbouring tiles are not touched
+    margin = 1e-6
+    return [
+        upper_left.west + margin,
+        lower_right.south + margin,
+        lower_right.east - margin,
+        upper_left.north - margin,
+    ]
+
+
+def make_query(case: dict) -> dict:
+    first_date = LAST_DATE - timedelta(days=case["dates"] - 1)
+    query = {
+        "zoom_level": 9,
+        "time": f"{first_date.strftime('%Y-%m-%d')}T00:00:00+00:00/"
+        f"{LAST_DATE.strftime('%Y-%m-%d')}T23:59:59+00:00",
+        "limit": case["dates"],
+        "bbox": aoi_bbox(case["aoi_tiles"]),
+        "imagery_layers": LAYERS[: case["layers"]],
+    }
+    if case.get("memory_budget_mb"):
+        query["memory_budget_mb"] = case["memory_budget_mb"]
+    return query
+
+
+def case_id(case: dict) -> str:
+    budget = (
+        f"-budget{case['memory_budget_mb']}" if case.get("memory_budget_mb") else ""
+    )
+    return f"aoi{case['aoi_tiles']}x{case['aoi_tiles']}-layers{case['layers']}-dates{case['dates']}{budget}"
+
+
+def run_case(case: dict, server_url: str, queue):
+    """
+    Runs a single fetch in the current (fresh) process and puts the result on the queue
+    """
+    # pylint: disable=import-outside-toplevel
+    from blockutils.common import ensure_data_directories_exist
+    from blockutils.stac import STACQuery
+    from modis import OUTPUT_DIR, Modis
+
+    ensure_data_directories_exist()
+    modis = Modis()
+    modis.api.wmts_url = server_url + "/wmts"
+    modis.api.wms_url = server_url + "/wms"
+
+    start = time.perf_counter()
+    try:
+        result = modis.fetch(STACQuery.from_dict(make_query(case)), dry_run=False)
+        status = "ok"
+    except Exception as err:  # pylint: disable=broad-except
+        result = None
+        status = f"failed: {err}"
+    seconds = time.perf_counter() - start
+
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        # ru_maxrss is in bytes on macOS
+        peak_rss_kb //= 1024
+
+    if result is not None:
+        for feature in result.features:
+            Path(OUTPUT_DIR / f"{feature['id']}.tif").unlink()
+            Path(f"/tmp/quicklooks/{feature['id']}.jpg").unlink()
+
+    summary = modis.metrics.summary()
+    peak_rss_mb = round(peak_rss_kb / 1024, 1)
+    queue.put(
+        {
+            "id": case_id(case),
+            "case": case,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "seconds_per_date": round(seconds / case["dates"], 4),
+            "tiles": summary["tiles"],
+            "tiles_per_second": round(summary["tiles"] / seconds, 2),
+            "peak_rss_mb": peak_rss_mb,
+            "within_budget": (
+                peak_rss_mb <= case["memory_budget_mb"]
+                if case.get("memory_budget_mb")
+                else None
+            ),
+            "metrics": summary,
+        }
+    )
+
+
+def run_matrix(
+    aoi_sizes: List[int],
+    layer_counts: List[int],
+    date_counts: List[int],
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    seed: int = 42,
+    memory_budget_mb: Optional[float] = None,
+) -> dict:
+    cases = [
+        {
+            "aoi_tiles": aoi,
+            "layers": layers,
+            "dates": dates,
+            "memory_budget_mb": memory_budget_mb,
+        }
+        for aoi, layers, dates in itertools.product(
+            aoi_sizes, layer_counts, date_counts
+        )
+    ]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with GibsStubServer(
+        latency=latency, jitter=jitter, error_rate=error_rate, seed=seed
+    ) as server:
+        for case in cases:
+            queue = context.Queue()
+            process = context.Process(target=run_case, args=(case, server.url, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print(
+                f"{result['id']}: {result['status']}, {result['seconds']}s, "
+                f"{result['tiles_per_second']} tiles/s, {result['peak_rss_mb']} MB"
+            )
+            results.append(result)
+
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "server": {
+            "latency": latency,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Returns the case ids that got slower than the baseline by more than threshold
+    (relative). Cases that do not exist in both runs are ignored.
+    """
+    baseline_by_id = {result["id"]: result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_by_id.get(result["id"])
+        if previous is None or previous["status"] != "ok" or result["status"] != "ok":
+            continue
+        ratio = result["seconds"] / previous["seconds"]
+        rss_ratio = result["peak_rss_mb"] / previous["peak_rss_mb"]
+        print(f"{result['id']}: time x{ratio:.2f}, peak RSS x{rss_ratio:.2f}")
+        if ratio > 1 + threshold or rss_ratio > 1 + threshold:
+            regressions.append(result["id"])
+    return regressions
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--aoi-sizes", type=int_list, default=[1, 4, 8])
+    arg_parser.add_argument("--layer-counts", type=int_list, default=[1, 2])
+    arg_parser.add_argument("--date-counts", type=int_list, default=[1, 3])
+    arg_parser.add_argument("--latency", type=float, default=0.02)
+    arg_parser.add_argument("--jitter", type=float, default=0.005)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--seed", type=int, default=42)
+    arg_parser.add_argument("--memory-budget-mb", type=float, default=None)
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"fetch-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    arg_parser.add_argument("--compare", type=Path, default=None)
+    arg_parser.add_argument("--threshold", type=float, default=0.2)
+    args = arg_parser.parse_args(argv)
+
+    current = run_matrix(
+        args.aoi_sizes,
+        args.layer_counts,
+        args.date_counts,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        memory_budget_mb=args.memory_budget_mb,
+    )
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(current, out, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as src:
+            regressions = compare(current, json.load(src), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
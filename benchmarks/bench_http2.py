@@ -0,0 +1,134 @@
+"""
+Benchmark of the HTTP/2 transport against HTTP/1.1.
+
+Requests the tiles of a grid through `GibsAPI` from the local GIBS stand-in server,
+which speaks HTTP/2 (h2c) with latency per request and serves a limited number of
+connections at once. Compares the default blocking transport (one request at a time),
+the same concurrent transport over HTTP/1.1 (one request per connection at a time) and
+over HTTP/2 (all requests as streams of a few connections):
+
+    python benchmarks/bench_http2.py --size 8 --latency 0.05
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import mercantile
+
+from gibs import GibsAPI, HttpTransport
+from http2_transport import DEFAULT_MAX_CONNECTIONS, Http2Transport
+
+from benchmarks.bench_compression import ORIGIN_TILE
+from benchmarks.gibs_stub_server import GibsStubServer
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+DATE = "2019-06-30"
+TRANSPORTS = {
+    "http1_blocking": HttpTransport,
+    "http1_pooled": lambda: Http2Transport(http2=False),
+    "http2": lambda: Http2Transport(prior_knowledge=True),
+}
+
+
+def fetch_tiles(api: GibsAPI, tile_list) -> int:
+    """
+    Requests the tiles the way a layer merge does, returns the bytes received
+    """
+    api.prefetch_tiles(tile_list, LAYER, DATE, "jpeg")
+    return sum(
+        len(api.requests_wmts_tile(tile, LAYER, DATE, "jpeg").content)
+        for tile in tile_list
+    )
+
+
+def run_transports(
+    size: int,
+    latency: float,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    transports=None,
+) -> dict:
+    tile_list = [
+        mercantile.Tile(ORIGIN_TILE.x + col, ORIGIN_TILE.y + row, ORIGIN_TILE.z)
+        for row in range(size)
+        for col in range(size)
+    ]
+    results = []
+    for name in transports or TRANSPORTS:
+        with GibsStubServer(
+            latency=latency, http2=True, max_connections=max_connections
+        ) as server:
+            transport = TRANSPORTS[name]()
+            api = GibsAPI(transport=transport)
+            api.wmts_url = server.wmts_url
+            start = time.perf_counter()
+            received = fetch_tiles(api, tile_list)
+            seconds = time.perf_counter() - start
+            if hasattr(transport, "close"):
+                transport.close()
+
+        result = {
+            "transport": name,
+            "seconds": round(seconds, 4),
+            "tiles_per_second": round(len(tile_list) / seconds, 1),
+            "mb_received": round(received / 2**20, 2),
+            "connections": server.connections,
+            "http2_connections": server.http2_connections,
+        }
+        print(
+            f"{name}: {result['seconds']}s, {result['tiles_per_second']} tiles/s, "
+            f"{result['connections']} connections"
+        )
+        results.append(result)
+
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "tiles": len(tile_list),
+        "latency": latency,
+        "server_max_connections": max_connections,
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--size", type=int, default=8, help="Tiles per side")
+    arg_parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds per request"
+    )
+    arg_parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=DEFAULT_MAX_CONNECTIONS,
+        help="Connections the server serves at once",
+    )
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"http2-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    args = arg_parser.parse_args(argv)
+
+    results = run_transports(args.size, args.latency, args.max_connections)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Allocation benchmark of merging the tiles of a layer.
+
+Merges a grid of tiles served by a tile cache (the test fixture tile, no network) into
+a layer file, once by writing each tile into a temporary tif and merging the files
+(`TileMergeHelper`) and once by decoding the tiles into a pooled mosaic
+(`Modis.merge_layer`). Records the time, the peak of the memory allocated by Python and
+numpy (tracemalloc), the minor page faults (memory newly touched by the process,
+including GDAL's) and the temporary files written:
+
+    python benchmarks/bench_merge.py --size 8
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+import mercantile
+
+from blockutils.common import ensure_data_directories_exist
+from blockutils.wmts import TileMergeHelper
+
+from data_coverage import TileCoverage
+from gibs import WEB_MERCATOR_TILE_MATRIX_SET
+from modis import OUTPUT_DIR, Modis
+from mosaic import BufferPool
+from tile_cache import TileCache
+
+from benchmarks.bench_compression import FIXTURE_TILE, ORIGIN_TILE
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+DATE = "2019-06-30"
+LAYERS = OrderedDict(
+    [(LAYER, {"Format": "jpeg", "TileMatrixSet": WEB_MERCATOR_TILE_MATRIX_SET})]
+)
+
+
+def tile_files_merge(modis: Modis, tile_list, path: Path):
+    TileMergeHelper(
+        tile_list,
+        req=modis.api.requests_wmts_tile,
+        req_kwargs={"layer": LAYER, "date": DATE, "img_format": "jpeg"},
+        crs=modis.api.crs,
+    ).get_final_image(path, return_cog=False)
+
+
+def pooled_merge(modis: Modis, tile_list, path: Path):
+    modis.merge_layer(tile_list, LAYERS, LAYER, DATE, TileCoverage(), path)
+
+
+MERGES = {"tile_files": tile_files_merge, "pooled": pooled_merge}
+
+
+def count_files(directory: Path) -> int:
+    return sum(1 for _ in directory.iterdir())
+
+
+def run_merges(size: int, repeat: int = 5) -> dict:
+    ensure_data_directories_exist()
+    tile_list = [
+        mercantile.Tile(ORIGIN_TILE.x + col, ORIGIN_TILE.y + row, ORIGIN_TILE.z)
+        for row in range(size)
+        for col in range(size)
+    ]
+    content = FIXTURE_TILE.read_bytes()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = TileCache(Path(tmp_dir) / "cache")
+        for tile in tile_list:
+            cache.put_tile(tile, LAYER, DATE, "jpeg", content)
+        for name, merge in MERGES.items():
+            modis = Modis()
+            modis.api.tile_cache = cache
+            modis.buffer_pool = BufferPool()
+            path = Path(tmp_dir) / f"{name}.tif"
+            # Warm up, e.g. GDAL's drivers and the pool
+            merge(modis, tile_list, path)
+
+            seconds = []
+            max_files = 0
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+            for _ in range(repeat):
+                start = time.perf_counter()
+                merge(modis, tile_list, path)
+                seconds.append(time.perf_counter() - start)
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+
+            # Counts the temporary tile files while the last tile is fetched
+            request = modis.api.requests_wmts_tile
+
+            def counting_request(*args, **kwargs):
+                nonlocal max_files
+                max_files = max(max_files, count_files(OUTPUT_DIR))
+                return request(*args, **kwargs)
+
+            modis.api.requests_wmts_tile = counting_request
+            files_before = count_files(OUTPUT_DIR)
+            tracemalloc.start()
+            merge(modis, tile_list, path)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            result = {
+                "merge": name,
+                "seconds": round(min(seconds), 4),
+                "peak_traced_mb": round(peak / 2**20, 2),
+                "minor_page_faults_per_merge": faults // repeat,
+                "temporary_files": max(0, max_files - files_before),
+                "pool_allocations": modis.buffer_pool.allocated,
+            }
+            print(
+                f"{name}: {result['seconds']}s, peak {result['peak_traced_mb']} MB, "
+                f"{result['minor_page_faults_per_merge']} page faults, "
+                f"{result['temporary_files']} temporary files"
+            )
+            results.append(result)
+
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "tiles": len(tile_list),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--size", type=int, default=8, help="Tiles per side")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"merge-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    args = arg_parser.parse_args(argv)
+
+    results = run_merges(args.size, args.repeat)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Time to first pixel of progressive fetches.
+
+Fetches one date of an AOI from the local GIBS stand-in server (with latency per
+request), once as usual and once in progressive mode, and records the time until the
+first feature is emitted (the preview in progressive mode) and the total time:
+
+    python benchmarks/bench_progressive.py --aoi-tiles 8 --latency 0.02
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from blockutils.common import ensure_data_directories_exist
+from blockutils.stac import STACQuery
+
+from modis import OUTPUT_DIR, QUICKLOOK_DIR, Modis
+
+from benchmarks.bench_fetch import make_query
+from benchmarks.gibs_stub_server import GibsStubServer
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def run_progressive(aoi_tiles: int, latency: float) -> dict:
+    ensure_data_directories_exist()
+    query = make_query({"aoi_tiles": aoi_tiles, "layers": 1, "dates": 1})
+    results = []
+    for progressive in (False, True):
+        with GibsStubServer(latency=latency) as server:
+            modis = Modis()
+            modis.api.wmts_url = server.wmts_url
+            modis.api.wms_url = server.wms_url
+            start = time.perf_counter()
+            first_seconds = None
+            features = []
+            for feature in modis.fetch_iter(
+                STACQuery.from_dict({**query, "progressive": progressive})
+            ):
+                if first_seconds is None:
+                    first_seconds = time.perf_counter() - start
+                features.append(feature)
+            seconds = time.perf_counter() - start
+            requests_served = server.requests_served
+        if first_seconds is None:
+            raise RuntimeError("The fetch emitted no feature")
+        for feature in features:
+            (OUTPUT_DIR / f"{feature['id']}.tif").unlink(missing_ok=True)
+            (QUICKLOOK_DIR / f"{feature['id']}.jpg").unlink(missing_ok=True)
+
+        result = {
+            "progressive": progressive,
+            "first_feature_seconds": round(first_seconds, 4),
+            "seconds": round(seconds, 4),
+            "first_feature_fraction": round(first_seconds / seconds, 3),
+            "requests": requests_served,
+        }
+        print(
+            f"progressive={progressive}: first feature after "
+            f"{result['first_feature_seconds']}s of {result['seconds']}s"
+        )
+        results.append(result)
+
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "aoi_tiles": aoi_tiles,
+        "latency": latency,
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--aoi-tiles", type=int, default=8, help="Tiles per side")
+    arg_parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per request"
+    )
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"progressive-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    args = arg_parser.parse_args(argv)
+
+    results = run_progressive(args.aoi_tiles, args.latency)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Cold start benchmark of the block.
+
+Every run starts a fresh interpreter, as a block run does in its container, and records
+the time to import `modis` (the entry point of `run.py`), the time of a dry-run fetch
+against the local GIBS stand-in server (including the catalog lookup) and the wall time
+of the whole process. Results are saved as JSON and can be compared against a previous
+run to catch import time regressions:
+
+    python benchmarks/bench_startup.py --output benchmarks/results/startup.json \
+        --compare benchmarks/results/startup-baseline.json
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks.bench_fetch import make_query
+from benchmarks.gibs_stub_server import GibsStubServer
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+REPO_DIR = Path(__file__).resolve().parent.parent
+CASE = {"aoi_tiles": 2, "layers": 1, "dates": 1}
+# Runs in the fresh interpreter, prints the timings as JSON
+RUN_SCRIPT = """
+import json, sys, time
+sys.path[:0] = [{repo!r}, {src!r}]
+start = time.perf_counter()
+import modis
+import_seconds = time.perf_counter() - start
+imported = len(sys.modules)
+
+from blockutils.stac import STACQuery
+start = time.perf_counter()
+block = modis.Modis()
+block.api.wmts_url = {server_url!r} + "/wmts"
+block.api.wms_url = {server_url!r} + "/wms"
+block.fetch(STACQuery.from_dict({query!r}), dry_run=True)
+dry_run_seconds = time.perf_counter() - start
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "dry_run_seconds": dry_run_seconds,
+    "modules": imported,
+}}))
+"""
+
+
+def run_once(server_url: str) -> dict:
+    """
+    Runs the block's start up and a dry-run fetch in a fresh interpreter
+    """
+    script = RUN_SCRIPT.format(
+        repo=str(REPO_DIR),
+        src=str(REPO_DIR / "src"),
+        server_url=server_url,
+        query=make_query(CASE),
+    )
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-c", script],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    process_seconds = time.perf_counter() - start
+    return {
+        **json.loads(completed.stdout.strip().splitlines()[-1]),
+        "process_seconds": process_seconds,
+    }
+
+
+def run_startup(repeat: int = 5) -> dict:
+    with GibsStubServer() as server:
+        runs = [run_once(server.url) for _ in range(repeat)]
+
+    results = [
+        {
+            "id": key,
+            "status": "ok",
+            "seconds": round(statistics.median(run[key] for run in runs), 4),
+            "min_seconds": round(min(run[key] for run in runs), 4),
+        }
+        for key in ("import_seconds", "dry_run_seconds", "process_seconds")
+    ]
+    for result in results:
+        print(
+            f"{result['id']}: median {result['seconds']}s, min {result['min_seconds']}s"
+        )
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "modules": runs[-1]["modules"],
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Returns the timings that got slower than the baseline by more than threshold
+    (relative)
+    """
+    baseline_by_id = {result["id"]: result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_by_id.get(result["id"])
+        if previous is None:
+            continue
+        ratio = result["seconds"] / previous["seconds"]
+        print(f"{result['id']}: x{ratio:.2f}")
+        if ratio > 1 + threshold:
+            regressions.append(result["id"])
+    return regressions
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"startup-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    arg_parser.add_argument("--compare", type=Path, default=None)
+    arg_parser.add_argument("--threshold", type=float, default=0.2)
+    args = arg_parser.parse_args(argv)
+
+    current = run_startup(args.repeat)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(current, out, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as src:
+            regressions = compare(current, json.load(src), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
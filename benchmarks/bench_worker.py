@@ -0,0 +1,176 @@
+"""
+Benchmark of the worker mode against one block run per job.
+
+Runs the same jobs (one date each, a different date per job so the tile cache of the
+worker does not serve them) against the local GIBS stand-in server, once as a fresh
+process per job like block runs and once as jobs of a single worker process (see
+`worker`). Records the wall time per job and the capabilities downloads:
+
+    python benchmarks/bench_worker.py --jobs 5
+"""
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from worker import job_status, submit_job
+
+from benchmarks.bench_fetch import LAST_DATE, make_query
+from benchmarks.bench_startup import REPO_DIR
+from benchmarks.gibs_stub_server import GibsStubServer
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+CASE = {"aoi_tiles": 2, "layers": 1, "dates": 1}
+# A block run of the query in a fresh interpreter, against the stand-in server
+RUN_SCRIPT = """
+import sys
+sys.path[:0] = [{repo!r}, {src!r}]
+import shutil
+from blockutils.common import ensure_data_directories_exist
+from blockutils.stac import STACQuery
+from modis import OUTPUT_DIR, QUICKLOOK_DIR, Modis
+shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+shutil.rmtree(QUICKLOOK_DIR, ignore_errors=True)
+ensure_data_directories_exist()
+block = Modis()
+block.api.wmts_url = {server_url!r} + "/wmts"
+block.api.wms_url = {server_url!r} + "/wms"
+block.run_query(STACQuery.from_dict({query!r}))
+"""
+
+
+def job_queries(jobs: int):
+    queries = []
+    for index in range(jobs):
+        date = (LAST_DATE - timedelta(days=index)).strftime("%Y-%m-%d")
+        queries.append(
+            {
+                **make_query(CASE),
+                "time": f"{date}T00:00:00+00:00/{date}T23:59:59+00:00",
+            }
+        )
+    return queries
+
+
+def run_block_runs(server: GibsStubServer, queries) -> list:
+    seconds = []
+    for query in queries:
+        script = RUN_SCRIPT.format(
+            repo=str(REPO_DIR),
+            src=str(REPO_DIR / "src"),
+            server_url=server.url,
+            query=query,
+        )
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", script], check=True, capture_output=True)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def run_worker(server: GibsStubServer, queries) -> dict:
+    with tempfile.TemporaryDirectory() as spool_dir:
+        job_ids = [submit_job(Path(spool_dir), query) for query in queries]
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                str(REPO_DIR / "src" / "worker.py"),
+                "run",
+                "--spool-dir",
+                spool_dir,
+                "--exit-when-idle",
+                "--wmts-url",
+                server.wmts_url,
+                "--wms-url",
+                server.wms_url,
+            ],
+            check=True,
+            capture_output=True,
+        )
+        seconds = time.perf_counter() - start
+        statuses = [job_status(Path(spool_dir), job_id) for job_id in job_ids]
+    if any(status["exit_code"] for status in statuses):
+        raise RuntimeError(f"Worker jobs failed: {statuses}")
+    return {"seconds": seconds, "job_seconds": [s["seconds"] for s in statuses]}
+
+
+def run_worker_benchmark(jobs: int, latency: float) -> dict:
+    queries = job_queries(jobs)
+    with GibsStubServer(latency=latency) as server:
+        block_seconds = run_block_runs(server, queries)
+        block_capabilities = server.capabilities_served
+    with GibsStubServer(latency=latency) as server:
+        worker = run_worker(server, queries)
+        worker_capabilities = server.capabilities_served
+
+    results = [
+        {
+            "mode": "block_runs",
+            "seconds": round(sum(block_seconds), 4),
+            "seconds_per_job": round(statistics.mean(block_seconds), 4),
+            "capabilities_downloads": block_capabilities,
+        },
+        {
+            "mode": "worker",
+            "seconds": round(worker["seconds"], 4),
+            "seconds_per_job": round(worker["seconds"] / jobs, 4),
+            "first_job_seconds": worker["job_seconds"][0],
+            "warm_job_seconds": (
+                round(statistics.mean(worker["job_seconds"][1:]), 4)
+                if jobs > 1
+                else None
+            ),
+            "capabilities_downloads": worker_capabilities,
+        },
+    ]
+    for result in results:
+        print(
+            f"{result['mode']}: {result['seconds']}s, {result['seconds_per_job']}s per "
+            f"job, {result['capabilities_downloads']} capabilities downloads"
+        )
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "jobs": jobs,
+        "latency": latency,
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("--jobs", type=int, default=5)
+    arg_parser.add_argument(
+        "--latency", type=float, default=0.01, help="Seconds per request"
+    )
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        default=RESULTS_DIR / f"worker-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    args = arg_parser.parse_args(argv)
+
+    results = run_worker_benchmark(args.jobs, args.latency)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
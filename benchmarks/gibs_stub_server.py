@@ -0,0 +1,269 @@
+"""
+Local stand-in for the GIBS WMTS/WMS endpoints used by the benchmarks.
+
+Serves the capabilities document and tiles from the test fixtures with configurable
+latency, jitter and error rate so fetch performance can be measured reproducibly
+without depending on NASA's servers. With `http2`, connections opening with the HTTP/2
+preface (prior knowledge, h2c) are served over HTTP/2 (h2), each stream with its own
+latency; other connections stay HTTP/1.1. `max_connections` limits the connections
+served at once, further connections wait like at a busy server.
+"""
+
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional, Tuple
+
+MOCK_DATA_DIR = Path(__file__).resolve().parent.parent / "tests" / "mock_data"
+HTTP2_PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+
+class GibsStubServer:
+    """
+    Threaded HTTP server answering WMTS capabilities, WMTS tile and WMS GetMap requests.
+
+    Example:
+        ```python
+        with GibsStubServer(latency=0.02, jitter=0.01) as server:
+            api.wmts_url = server.wmts_url
+            api.wms_url = server.wms_url
+        ```
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 42,
+        capabilities_path: Path = MOCK_DATA_DIR / "available_imagery_layers.xml",
+        tile_path: Path = MOCK_DATA_DIR / "tile.jpg",
+        port: int = 0,
+        http2: bool = False,
+        max_connections: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.capabilities = Path(capabilities_path).read_bytes()
+        self.tile = Path(tile_path).read_bytes()
+        self.http2 = http2
+        self.requests_served = 0
+        self.capabilities_served = 0
+        self.connections = 0
+        self.http2_connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = (
+            threading.BoundedSemaphore(max_connections)
+            if max_connections is not None
+            else None
+        )
+        self._httpd = self._server_class()(("127.0.0.1", port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def wmts_url(self) -> str:
+        return self.url + "/wmts"
+
+    @property
+    def wms_url(self) -> str:
+        return self.url + "/wms"
+
+    def _delay_and_fail(self) -> bool:
+        """
+        Sleeps for latency +- jitter and returns whether the request should fail
+        """
+        with self._lock:
+            self.requests_served += 1
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+            fail = self._random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+    def _response(self, path: str) -> Tuple[int, bytes, str]:
+        """
+        Status, body and content type answering a GET of path
+        """
+        path = path.split("?")[0]
+        if path.endswith("WMTSCapabilities.xml"):
+            with self._lock:
+                self.capabilities_served += 1
+            return 200, self.capabilities, "application/xml"
+        if path.startswith("/wmts/") or path.startswith("/wms/"):
+            if self._delay_and_fail():
+                return 500, b"Internal Server Error", "text/plain"
+            return 200, self.tile, "image/jpeg"
+        return 404, b"Not Found", "text/plain"
+
+    def _is_http2(self, connection: socket.socket) -> bool:
+        """
+        Whether the client opened the connection with the HTTP/2 preface
+        """
+        # Every HTTP/1.1 request line has the 3 bytes of a method
+        method = connection.recv(3, socket.MSG_PEEK | socket.MSG_WAITALL)
+        return method == HTTP2_PREFACE[:3]
+
+    def _serve_http2(self, connection: socket.socket):
+        """
+        Serves the streams of an HTTP/2 connection, each in its own thread
+        """
+        # pylint: disable=import-outside-toplevel
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.exceptions
+
+        h2_connection = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False)
+        )
+        # Guards the connection state; the senders wait on it for window updates
+        state = threading.Condition()
+        closed = False
+
+        def send_pending():
+            data = h2_connection.data_to_send()
+            if data:
+                connection.sendall(data)
+
+        def respond(stream_id: int, path: str):
+            status, body, content_type = self._response(path)
+            try:
+                with state:
+                    h2_connection.send_headers(
+                        stream_id,
+                        [
+                            (":status", str(status)),
+                            ("content-type", content_type),
+                            ("content-length", str(len(body))),
+                        ],
+                        end_stream=not body,
+                    )
+                    send_pending()
+                    view = memoryview(body)
+                    while view and not closed:
+                        size = min(
+                            len(view),
+                            h2_connection.local_flow_control_window(stream_id),
+                            h2_connection.max_outbound_frame_size,
+                        )
+                        if size <= 0:
+                            state.wait()
+                            continue
+                        h2_connection.send_data(
+                            stream_id,
+                            view[:size].tobytes(),
+                            end_stream=size == len(view),
+                        )
+                        send_pending()
+                        view = view[size:]
+            except (h2.exceptions.StreamClosedError, OSError):
+                pass
+
+        with state:
+            h2_connection.initiate_connection()
+            send_pending()
+        try:
+            while not closed:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                with state:
+                    for event in h2_connection.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(
+                                target=respond,
+                                args=(
+                                    event.stream_id,
+                                    dict(event.headers)[b":path"].decode(),
+                                ),
+                                daemon=True,
+                            ).start()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            closed = True
+                    send_pending()
+                    state.notify_all()
+        except (h2.exceptions.ProtocolError, OSError):
+            pass
+        finally:
+            with state:
+                closed = True
+                state.notify_all()
+
+    def _server_class(self):
+        server = self
+
+        class Server(ThreadingHTTPServer):
+            # pylint: disable=protected-access
+            def process_request_thread(self, request, client_address):
+                slots = server._slots
+                if slots is not None:
+                    slots.acquire()
+                try:
+                    super().process_request_thread(request, client_address)
+                finally:
+                    if slots is not None:
+                        slots.release()
+
+            def finish_request(self, request, client_address):
+                http2 = server.http2 and server._is_http2(request)
+                with server._lock:
+                    server.connections += 1
+                    server.http2_connections += http2
+                if http2:
+                    server._serve_http2(request)
+                else:
+                    super().finish_request(request, client_address)
+
+        return Server
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately
+            disable_nagle_algorithm = True
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                # pylint: disable=protected-access
+                self._send(*server._response(self.path))
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        return Handler
+
+    def start(self) -> "GibsStubServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self) -> "GibsStubServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
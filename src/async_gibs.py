@@ -0,0 +1,290 @@
+"""
+Asyncio client of GIBS, for embedding the block in async services.
+
+`AsyncGibsClient` holds one connection pool (aiohttp) and one catalog per crs, and is
+meant to be shared by all the queries of a service on one event loop. It serves the
+capabilities, tiles and quicklooks as coroutines.
+
+`fetch_iter_async` runs a `Modis` fetch as an async generator. The decoding, merging and
+COG conversion stay blocking and run in an executor thread, but none of their requests
+block it on the network: every request is sent by the client on the event loop through
+a `LoopTransport`, and the tiles of a layer are all requested at once instead of by the
+merge threads one after another. Cancelling the fetch cancels its in-flight requests,
+the worker thread then stops at its next request.
+
+Concurrent queries must not share a checkpoint journal, metrics or data.json, so every
+query writes into new directories of its own below the output and quicklook directories
+of its `Modis`, which then point to them:
+
+    async with AsyncGibsClient() as client:
+        modis = Modis()
+        result = await modis.fetch_async(query, client=client)
+        image = modis.output_dir / result.features[0]["properties"]["up42.data_path"]
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import aiohttp
+import mercantile
+import requests
+from geojson import Feature
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from geographic import EPSG_3857, EPSG_4326
+from gibs import WEB_MERCATOR_TILE_MATRIX_SET, GibsAPI, LayerCatalog
+from tile_cache import DEFAULT_CAPABILITIES_MAX_AGE, cached_response
+
+logger = get_logger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 32
+
+
+class AsyncGibsClient:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        wmts_url: Optional[str] = None,
+        wms_url: Optional[str] = None,
+    ):
+        """
+        :param max_connections: Size of the connection pool shared by all queries
+        :param wmts_url: The WMTS endpoint, GIBS by default
+        :param wms_url: The WMS endpoint, GIBS by default
+        """
+        self.max_connections = max_connections
+        self.wmts_url = wmts_url
+        self.wms_url = wms_url
+        # Keyed by crs, shared with the `GibsAPI` of every fetch
+        self.catalogs: Dict[str, LayerCatalog] = {}
+        self._catalog_locks: Dict[str, asyncio.Lock] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncGibsClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Connection pool, created on first use in the running event loop
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def api(self, crs: str = EPSG_3857) -> GibsAPI:
+        """
+        `GibsAPI` building the urls of the crs
+        """
+        api = GibsAPI(crs=crs)
+        if self.wmts_url is not None:
+            api.wmts_url = self.wmts_url
+        if self.wms_url is not None:
+            api.wms_url = self.wms_url
+        return api
+
+    async def get(self, url: str) -> requests.Response:
+        """
+        Sends a GET request, the response is returned as `requests.Response` whatever
+        its status. Connection failures raise `requests.exceptions.ConnectionError`.
+        """
+        try:
+            async with self.session.get(url) as response:
+                content = await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise requests.exceptions.ConnectionError(str(err)) from err
+        result = cached_response(content, url)
+        result.status_code = status
+        return result
+
+    async def get_capabilities(self, crs: str = EPSG_3857) -> bytes:
+        response = await self.get(self.api(crs).capabilities_url)
+        if response.status_code != 200:
+            raise UP42Error(
+                SupportedErrors.API_CONNECTION_ERROR,
+                f"Capabilities request failed with status {response.status_code}",
+            )
+        return response.content
+
+    async def get_catalog(self, crs: str = EPSG_3857) -> LayerCatalog:
+        """
+        Catalog of the crs, downloaded once for all queries and refreshed once it is
+        as old as the capabilities a tile cache keeps
+        """
+        lock = self._catalog_locks.setdefault(crs, asyncio.Lock())
+        async with lock:
+            catalog = self.catalogs.get(crs)
+            if catalog is None or time.time() - catalog.loaded > (
+                DEFAULT_CAPABILITIES_MAX_AGE
+            ):
+                catalog = LayerCatalog(await self.get_capabilities(crs), crs)
+                self.catalogs[crs] = catalog
+            return catalog
+
+    async def get_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str = "jpg",
+        tile_matrix_set: str = WEB_MERCATOR_TILE_MATRIX_SET,
+        crs: str = EPSG_3857,
+    ) -> bytes:
+        url = self.api(crs).wmts_tile_url(
+            tile, layer, date, img_format, tile_matrix_set
+        )
+        try:
+            response = await self.get(url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as err:
+            raise UP42Error(SupportedErrors.API_CONNECTION_ERROR, str(err)) from err
+        return response.content
+
+    async def get_quicklook(self, layer: str, bbox, date: str) -> bytes:
+        """
+        RGB quicklook image of the bbox (WMS), raises `requests.exceptions.HTTPError`
+        if it is not available
+        """
+        response = await self.get(self.api().quicklook_url(layer, bbox, date))
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                f"Quicklook download unsuccessful with status code "
+                f"{response.status_code}"
+            )
+        return response.content
+
+
+class LoopTransport:
+    """
+    Transport of the `GibsAPI` of a fetch running in a worker thread. The requests are
+    sent by the client on the event loop, the thread only waits for the responses.
+    """
+
+    def __init__(self, client: AsyncGibsClient, loop: asyncio.AbstractEventLoop):
+        self.client = client
+        self.loop = loop
+        self.cancelled = False
+        # Requests started by `prefetch` and not yet taken, only used on the loop
+        self._prefetched: Dict[str, asyncio.Future] = {}
+        self._waiting: Set[concurrent.futures.Future] = set()
+        self._lock = threading.Lock()
+
+    async def _request(self, url: str) -> requests.Response:
+        request = self._prefetched.pop(url, None)
+        if request is None:
+            request = asyncio.ensure_future(self.client.get(url))
+        return await request
+
+    def get(self, url: str) -> requests.Response:
+        if self.cancelled:
+            raise concurrent.futures.CancelledError()
+        future = asyncio.run_coroutine_threadsafe(self._request(url), self.loop)
+        with self._lock:
+            self._waiting.add(future)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._waiting.discard(future)
+
+    def _start(self, urls: List[str]):
+        if self.cancelled:
+            return
+        for url in urls:
+            if url not in self._prefetched:
+                self._prefetched[url] = asyncio.ensure_future(self.client.get(url))
+
+    def prefetch(self, urls: List[str]):
+        """
+        Starts all requests at once, `get` then takes over the running requests
+        """
+        # Runs before any later `get` of the thread, the loop keeps the order
+        self.loop.call_soon_threadsafe(self._start, urls)
+
+    async def close(self, cancel: bool = False):
+        """
+        Drops the prefetched requests that were not taken. With cancel, the requests
+        the worker thread waits for are cancelled as well and later ones fail.
+        """
+        if cancel:
+            self.cancelled = True
+            with self._lock:
+                waiting = list(self._waiting)
+            for future in waiting:
+                future.cancel()
+        requests_left = list(self._prefetched.values())
+        self._prefetched.clear()
+        for request in requests_left:
+            request.cancel()
+        await asyncio.gather(*requests_left, return_exceptions=True)
+
+
+async def fetch_iter_async(
+    modis,
+    query: STACQuery,
+    client: AsyncGibsClient,
+    dry_run: bool = False,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> AsyncIterator[Feature]:
+    """
+    Yields the features of `Modis.fetch_iter`, the blocking work of each date running
+    in executor (the loop's default executor if None). The outputs of the query are
+    written to new directories below the ones of modis, see the module docstring.
+    """
+    query_dirname = str(uuid.uuid4())
+    modis.output_dir = modis.output_dir / query_dirname
+    modis.quicklook_dir = modis.quicklook_dir / query_dirname
+    modis.output_dir.mkdir(parents=True)
+    modis.quicklook_dir.mkdir(parents=True)
+
+    loop = asyncio.get_running_loop()
+    transport = LoopTransport(client, loop)
+    modis.api.transport = transport
+    if client.wmts_url is not None:
+        modis.api.wmts_url = client.wmts_url
+    if client.wms_url is not None:
+        modis.api.wms_url = client.wms_url
+    if modis.api.tile_bundle is None:
+        modis.api.catalogs = client.catalogs
+        crs = query.get_param_if_exists("crs", EPSG_3857)
+        if crs in (EPSG_3857, EPSG_4326):
+            await client.get_catalog(crs)
+
+    done = object()
+    features = modis.fetch_iter(query, dry_run)
+    try:
+        while True:
+            step = loop.run_in_executor(executor, next, features, done)
+            try:
+                feature = await asyncio.shield(step)
+            except asyncio.CancelledError:
+                logger.info("Fetch cancelled")
+                await transport.close(cancel=True)
+                # The worker stops at its next request
+                await asyncio.wait([step])
+                raise
+            if feature is done:
+                return
+            yield feature
+    finally:
+        # Runs the clean up of the fetch, also if the consumer stopped early
+        await loop.run_in_executor(executor, features.close)
+        await transport.close()
@@ -13,6 +13,7 @@ def run():
     with open(
         os.path.realpath(os.path.join(os.getcwd(), "available_imagery_layers.json")),
         "w",
+        encoding="utf-8",
     ) as out:
         json.dump(imagery_layers, out)
 
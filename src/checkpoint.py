@@ -0,0 +1,124 @@
+"""
+Per-date checkpointing of fetch jobs.
+
+Completed dates and their features are recorded in a journal under
+`/tmp/output/.checkpoint`. A restarted job with the same query skips the dates already
+in the journal. Without a tile cache configured, the downloaded tiles are kept in the
+journal's tile cache when the job resumes a journal or the query sets
+`"checkpoint_tiles": true`, so a further restart does not download them again. The
+journal and its tiles are removed once the job completed.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, Optional
+
+from geojson import Feature
+
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from compression import DEFAULT_COMPRESSION_PROFILE
+from tile_cache import TileCache, write_atomic
+
+logger = get_logger(__name__)
+
+CHECKPOINT_DIRNAME = ".checkpoint"
+JOURNAL_FILENAME = "journal.json"
+
+
+def query_key(query: STACQuery, dry_run: bool, *extra) -> str:
+    """
+    Stable hash of everything in the query that determines the outputs
+    """
+    content = {
+        "geometry": query.geometry(),
+        "time": query.time,
+        "limit": query.limit,
+        "zoom_level": query.get_param_if_exists("zoom_level"),
+        "imagery_layers": query.get_param_if_exists("imagery_layers"),
+        "bands": query.get_param_if_exists("bands"),
+        "jpeg_passthrough": bool(query.get_param_if_exists("jpeg_passthrough")),
+        "native_overviews": bool(query.get_param_if_exists("native_overviews")),
+        "min_coverage": query.get_param_if_exists("min_coverage"),
+        "output_format": query.get_param_if_exists("output_format") or "geotiff",
+        "crs": query.get_param_if_exists("crs") or "EPSG:3857",
+        "compression_profile": query.get_param_if_exists("compression_profile")
+        or DEFAULT_COMPRESSION_PROFILE,
+        "dry_run": dry_run,
+        "extra": extra,
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class CheckpointJournal:
+    def __init__(self, output_dir: Path, key: str):
+        """
+        Opens the journal in output_dir. A journal of a different query is discarded.
+
+        :param output_dir: The output directory of the job
+        :param key: Key of the query, see `query_key`
+        """
+        self.output_dir = Path(output_dir)
+        self.checkpoint_dir = self.output_dir / CHECKPOINT_DIRNAME
+        self.key = key
+        self.features: Dict[str, dict] = {}
+        # Whether a journal of an earlier run of the query was found
+        self.resumable = False
+
+        journal = self._load()
+        if journal is not None and journal.get("key") == key:
+            self.features = journal["features"]
+            self.resumable = True
+            logger.info(
+                f"Resuming job, {len(self.features)} dates already completed: "
+                f"{sorted(self.features)}"
+            )
+        elif journal is not None:
+            logger.info("Discarding checkpoint of a different query")
+            self.clear()
+
+    @property
+    def journal_path(self) -> Path:
+        return self.checkpoint_dir / JOURNAL_FILENAME
+
+    @property
+    def tile_cache(self) -> TileCache:
+        """
+        Cache for the tiles downloaded in this job, so they survive a failure
+        """
+        return TileCache(self.checkpoint_dir)
+
+    def _load(self) -> Optional[dict]:
+        try:
+            with open(self.journal_path, encoding="utf-8") as src:
+                return json.load(src)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def completed(self, query_date: str) -> Optional[Feature]:
+        """
+        Feature of a completed date, None if the date (or its output file) is missing
+        """
+        feature = self.features.get(query_date)
+        if feature is None:
+            return None
+        data_path = feature["properties"].get("up42.data_path")
+        if data_path and not (self.output_dir / data_path).exists():
+            return None
+        return Feature(**feature)
+
+    def record(self, query_date: str, feature: Feature):
+        self.features[query_date] = feature
+        write_atomic(
+            self.journal_path,
+            json.dumps({"key": self.key, "features": self.features}).encode(),
+        )
+
+    def clear(self):
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        self.features = {}
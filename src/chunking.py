@@ -0,0 +1,257 @@
+"""
+Memory budgeted merging of large AOIs.
+
+Without a budget, the tiles of each layer are merged into one in-memory mosaic, so the
+memory of a job grows with the AOI. With `memory_budget_mb` the tile grid of the AOI is
+split into rectangular chunks of tiles that can each be merged within the budget. The
+chunks are merged one after another and written by window into a single output that
+covers the tile grid, so only one chunk is in memory at a time. Chunks are aligned to
+the blocks of the output where the budget allows it, so that no compressed block is
+written twice.
+
+The budget applies to the whole process. The memory already in use (the resident set,
+e.g. the interpreter and GDAL) is deducted before the chunks are sized, and GDAL's block
+cache is limited to a quarter of the rest.
+"""
+
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio as rio
+from mercantile import Tile
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+
+from compression import CompressionProfile
+
+# The mosaic of a layer and the buffers of writing it and reading it back by window
+MERGE_OVERHEAD = 2
+MIN_GDAL_CACHE_MB = 16
+
+
+@dataclass(frozen=True)
+class TileChunk:
+    """
+    Rectangle of the tile grid, offsets and size in tiles from the top left tile
+    """
+
+    col_off: int
+    row_off: int
+    cols: int
+    rows: int
+    tiles: List[Tile]
+
+    def window(self, tile_size: int) -> Window:
+        return Window(
+            self.col_off * tile_size,
+            self.row_off * tile_size,
+            self.cols * tile_size,
+            self.rows * tile_size,
+        )
+
+
+def validate_memory_budget(memory_budget_mb: Optional[float]):
+    if memory_budget_mb is not None and memory_budget_mb <= 0:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid memory_budget_mb {memory_budget_mb}, must be positive.",
+        )
+
+
+def current_rss_mb() -> float:
+    """
+    Resident memory of the process in MB, 0 if unknown
+    """
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0.0
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def available_mb(memory_budget_mb: float) -> float:
+    """
+    Part of the budget not yet used by the process
+    """
+    return max(0.0, memory_budget_mb - current_rss_mb())
+
+
+def gdal_cache_env(memory_budget_mb: Optional[float]):
+    """
+    Environment limiting GDAL's block cache to a quarter of the available budget
+    """
+    if memory_budget_mb is None:
+        return nullcontext()
+    cache_mb = max(MIN_GDAL_CACHE_MB, int(available_mb(memory_budget_mb) // 4))
+    return rio.Env(GDAL_CACHEMAX=cache_mb)
+
+
+def max_chunk_tiles(budget_mb: float, bands: int, tile_size: int) -> int:
+    """
+    Number of tiles that can be merged within budget_mb, at least one
+    """
+    tile_bytes = bands * tile_size**2 * MERGE_OVERHEAD
+    return max(1, int(budget_mb * 2**20 // tile_bytes))
+
+
+def plan_chunks(
+    tile_list: List[Tile], max_tiles: int, align: int = 1
+) -> List[TileChunk]:
+    """
+    Splits the tile grid of tile_list into chunks of at most max_tiles tiles, rows of
+    the grid first. Chunk sides are multiples of align tiles unless they span the
+    grid or max_tiles is too small. Chunks without tiles of tile_list are left out.
+    """
+    min_x = min(tile.x for tile in tile_list)
+    min_y = min(tile.y for tile in tile_list)
+    grid_cols = max(tile.x for tile in tile_list) - min_x + 1
+    grid_rows = max(tile.y for tile in tile_list) - min_y + 1
+
+    # Leave room for align rows, sides at the end of the grid need no alignment
+    cols = min(grid_cols, max(1, max_tiles // align))
+    if align <= cols < grid_cols:
+        cols -= cols % align
+    rows = min(grid_rows, max(1, max_tiles // cols))
+    if align <= rows < grid_rows:
+        rows -= rows % align
+
+    chunk_tiles: Dict[Tuple[int, int], List[Tile]] = {}
+    for tile in tile_list:
+        key = ((tile.y - min_y) // rows, (tile.x - min_x) // cols)
+        chunk_tiles.setdefault(key, []).append(tile)
+    return [
+        TileChunk(
+            col * cols,
+            row * rows,
+            min(cols, grid_cols - col * cols),
+            min(rows, grid_rows - row * rows),
+            chunk_tiles[(row, col)],
+        )
+        for row, col in sorted(chunk_tiles)
+    ]
+
+
+def chunked_output_profile(
+    transform: Affine,
+    width: int,
+    height: int,
+    crs: str,
+    count: int,
+    compression_profile: CompressionProfile,
+) -> dict:
+    """
+    Profile of an output covering the tile grid that chunks are written into
+    """
+    return {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": count,
+        "width": width,
+        "height": height,
+        "crs": crs,
+        "transform": transform,
+        **compression_profile.creation_options(compression_profile.merge_level),
+    }
+
+
+def _read_into(
+    data: np.ndarray,
+    dataset: rio.io.DatasetReader,
+    window: Window,
+    offset: Tuple[int, int],
+):
+    """
+    Reads the part of window (in the output grid) that dataset covers into data,
+    dataset being placed at offset (col, row) in the output grid
+    """
+    col_start = max(window.col_off, offset[0])
+    row_start = max(window.row_off, offset[1])
+    col_stop = min(window.col_off + window.width, offset[0] + dataset.width)
+    row_stop = min(window.row_off + window.height, offset[1] + dataset.height)
+    if col_start >= col_stop or row_start >= row_stop:
+        return
+    data[
+        :,
+        row_start - window.row_off : row_stop - window.row_off,
+        col_start - window.col_off : col_stop - window.col_off,
+    ] = dataset.read(
+        window=Window(
+            col_start - offset[0],
+            row_start - offset[1],
+            col_stop - col_start,
+            row_stop - row_start,
+        )
+    )
+
+
+def _grid_offset(
+    dataset: rio.io.DatasetReader, dst: rio.io.DatasetWriter
+) -> Tuple[int, int]:
+    """
+    Offset (col, row) of dataset in the grid of dst
+    """
+    return (
+        int(round((dataset.transform.c - dst.transform.c) / dataset.res[0])),
+        int(round((dst.transform.f - dataset.transform.f) / dataset.res[1])),
+    )
+
+
+def write_chunk(
+    dst: rio.io.DatasetWriter,
+    chunk: TileChunk,
+    layer_files: Sequence[Optional[Path]],
+    layer_bands: Sequence[int],
+    tile_size: int,
+):
+    """
+    Writes the merged layers of a chunk into its window of dst, block by block.
+    Layers without a file (no valid tile in the chunk) and the empty tiles of the
+    others are written as 0.
+    """
+    datasets = [rio.open(path) if path is not None else None for path in layer_files]
+    try:
+        # Layers with a file and their offset in the output grid
+        placed: List[Optional[Tuple[rio.io.DatasetReader, Tuple[int, int]]]] = [
+            (dataset, _grid_offset(dataset, dst)) if dataset is not None else None
+            for dataset in datasets
+        ]
+        chunk_window = chunk.window(tile_size)
+        block_height, block_width = dst.block_shapes[0]
+        for row in range(
+            chunk_window.row_off,
+            chunk_window.row_off + chunk_window.height,
+            block_height,
+        ):
+            for col in range(
+                chunk_window.col_off,
+                chunk_window.col_off + chunk_window.width,
+                block_width,
+            ):
+                window = Window(
+                    col,
+                    row,
+                    min(block_width, chunk_window.col_off + chunk_window.width - col),
+                    min(block_height, chunk_window.row_off + chunk_window.height - row),
+                )
+                data = np.zeros(
+                    (sum(layer_bands), window.height, window.width), dst.dtypes[0]
+                )
+                band = 0
+                for layer, bands in zip(placed, layer_bands):
+                    if layer is not None:
+                        _read_into(
+                            data[band : band + bands], layer[0], window, layer[1]
+                        )
+                    band += bands
+                dst.write(data, window=window)
+    finally:
+        for dataset in datasets:
+            if dataset is not None:
+                dataset.close()
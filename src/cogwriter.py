@@ -0,0 +1,275 @@
+"""
+Writer for tiled GeoTIFFs with internal overviews in the Cloud Optimized GeoTIFF layout
+from already encoded tile payloads.
+
+The layout follows the one produced by GDAL's COG driver: the IFDs of the full
+resolution image and of all overviews come first, followed by the tile data from the
+smallest overview to the full resolution image. Tiles without data are left sparse
+(offset and byte count 0) and read as 0 by GDAL.
+"""
+
+import math
+import struct
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+COMPRESSION_NONE = 1
+COMPRESSION_JPEG = 7
+COMPRESSION_DEFLATE = 8
+
+PHOTOMETRIC_MINISBLACK = 1
+PHOTOMETRIC_RGB = 2
+PHOTOMETRIC_YCBCR = 6
+
+PREDICTOR_HORIZONTAL = 2
+
+# TIFF field types
+_ASCII, _SHORT, _LONG, _DOUBLE, _LONG8 = 2, 3, 4, 12, 16
+_TYPE_FORMAT = {_ASCII: "s", _SHORT: "H", _LONG: "I", _DOUBLE: "d", _LONG8: "Q"}
+# IFD entry: tag, field type and values (the NUL terminated bytes of ASCII fields)
+IfdEntry = Tuple[int, int, Union[bytes, Sequence[int], Sequence[float]]]
+
+# Tags of the full resolution image only
+_GEO_TAGS = {33550, 33922, 34735, 42112, 42113}
+
+_EPSG_GEOGRAPHIC = {4326}
+
+
+def overview_sizes(
+    width: int, height: int, tile_size: int, max_overviews: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    """
+    Sizes of the full resolution image and its overviews, halving the size until the
+    image fits into a single tile
+    """
+    sizes = [(width, height)]
+    while (sizes[-1][0] > tile_size or sizes[-1][1] > tile_size) and (
+        max_overviews is None or len(sizes) <= max_overviews
+    ):
+        sizes.append((math.ceil(sizes[-1][0] / 2), math.ceil(sizes[-1][1] / 2)))
+    return sizes
+
+
+def geokeys(epsg: int) -> List[int]:
+    """
+    GeoKeyDirectory of a georeferenced raster in the given EPSG code (pixel is area)
+    """
+    if epsg in _EPSG_GEOGRAPHIC:
+        # GTModelType geographic, GeographicType
+        model_type, crs_key = 2, 2048
+    else:
+        # GTModelType projected, ProjectedCSType
+        model_type, crs_key = 1, 3072
+    return [1, 1, 0, 3, 1024, 0, 1, model_type, 1025, 0, 1, 1, crs_key, 0, 1, epsg]
+
+
+class CogWriter:
+    """
+    Example:
+        ```python
+        with CogWriter(path, 512, 512, samples=3, geotransform=(x0, y0, res, res),
+                       epsg=3857) as writer:
+            for level in reversed(range(writer.level_count)):
+                for (col, row), payload in encoded_tiles[level].items():
+                    writer.write_tile(level, col, row, payload)
+        ```
+    Tiles have to be written level by level from the smallest overview
+    (`level_count - 1`) to the full resolution image (level 0).
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+        self,
+        path: Path,
+        width: int,
+        height: int,
+        samples: int,
+        tile_size: int = 256,
+        compression: int = COMPRESSION_JPEG,
+        photometric: int = PHOTOMETRIC_YCBCR,
+        ycbcr_subsampling: Tuple[int, int] = (2, 2),
+        predictor: Optional[int] = None,
+        geotransform: Optional[Sequence[float]] = None,
+        epsg: Optional[int] = None,
+        gdal_metadata: Optional[str] = None,
+        nodata: Optional[float] = None,
+        max_overviews: Optional[int] = None,
+        bigtiff: bool = False,
+    ):
+        """
+        :param path: Output path
+        :param width: Width of the full resolution image
+        :param height: Height of the full resolution image
+        :param samples: Number of bands (8 bit unsigned)
+        :param tile_size: Size of the square tiles
+        :param compression: TIFF compression of the encoded tiles
+        :param photometric: TIFF photometric interpretation
+        :param ycbcr_subsampling: Chroma subsampling of YCbCr JPEG tiles
+        :param predictor: TIFF predictor applied when encoding the tiles
+        :param geotransform: Upper left x, upper left y, pixel width, pixel height
+        :param epsg: EPSG code of the coordinate reference system
+        :param gdal_metadata: GDAL metadata XML, e.g. band tags
+        :param nodata: Nodata value
+        :param max_overviews: Maximum number of overviews
+        :param bigtiff: Whether to write a BigTIFF (required for files > 4GB)
+        """
+        self.path = Path(path)
+        self.samples = samples
+        self.tile_size = tile_size
+        self.compression = compression
+        self.photometric = photometric
+        self.ycbcr_subsampling = ycbcr_subsampling
+        self.predictor = predictor
+        self.geotransform = geotransform
+        self.epsg = epsg
+        self.gdal_metadata = gdal_metadata
+        self.nodata = nodata
+        self.bigtiff = bigtiff
+        self.sizes = overview_sizes(width, height, tile_size, max_overviews)
+        self.tile_grids = [
+            (math.ceil(w / tile_size), math.ceil(h / tile_size)) for w, h in self.sizes
+        ]
+        self.offsets = [[0] * (cols * rows) for cols, rows in self.tile_grids]
+        self.byte_counts = [[0] * (cols * rows) for cols, rows in self.tile_grids]
+
+        self._header_size = 16 if bigtiff else 8
+        self._ifd_offsets, self._data_start = self._layout()
+        # pylint: disable=consider-using-with
+        self._file = open(self.path, "wb")
+        self._file.write(b"\0" * self._data_start)
+
+    @property
+    def level_count(self) -> int:
+        return len(self.sizes)
+
+    def _tags(self, level: int) -> List[IfdEntry]:
+        width, height = self.sizes[level]
+        offset_type = _LONG8 if self.bigtiff else _LONG
+        tags: List[IfdEntry] = [
+            (254, _LONG, [1 if level else 0]),
+            (256, _LONG, [width]),
+            (257, _LONG, [height]),
+            (258, _SHORT, [8] * self.samples),
+            (259, _SHORT, [self.compression]),
+            (262, _SHORT, [self.photometric]),
+            (277, _SHORT, [self.samples]),
+            (284, _SHORT, [1]),
+            (322, _SHORT, [self.tile_size]),
+            (323, _SHORT, [self.tile_size]),
+            (324, offset_type, self.offsets[level]),
+            (325, offset_type, self.byte_counts[level]),
+            (339, _SHORT, [1] * self.samples),
+        ]
+        colour_samples = 1 if self.photometric == PHOTOMETRIC_MINISBLACK else 3
+        if self.samples > colour_samples:
+            tags.append((338, _SHORT, [0] * (self.samples - colour_samples)))
+        if self.predictor:
+            tags.append((317, _SHORT, [self.predictor]))
+        if self.photometric == PHOTOMETRIC_YCBCR:
+            tags.append((530, _SHORT, list(self.ycbcr_subsampling)))
+        if self.geotransform is not None:
+            origin_x, origin_y, res_x, res_y = self.geotransform
+            tags += [
+                (33550, _DOUBLE, [res_x, res_y, 0.0]),
+                (33922, _DOUBLE, [0.0, 0.0, 0.0, origin_x, origin_y, 0.0]),
+            ]
+        if self.epsg is not None:
+            tags.append((34735, _SHORT, geokeys(self.epsg)))
+        if self.gdal_metadata:
+            tags.append((42112, _ASCII, self.gdal_metadata.encode() + b"\0"))
+        if self.nodata is not None:
+            tags.append((42113, _ASCII, f"{self.nodata:g}".encode() + b"\0"))
+        if level:
+            tags = [tag for tag in tags if tag[0] not in _GEO_TAGS]
+        return sorted(tags)
+
+    def _encode_ifd(self, level: int, ifd_offset: int, next_ifd: int) -> bytes:
+        count_format, entry_size, inline_size, offset_format = (
+            ("Q", 20, 8, "Q") if self.bigtiff else ("H", 12, 4, "I")
+        )
+        # Value counts of entries have the size of offsets
+        value_count_format = offset_format
+        tags = self._tags(level)
+        entries = struct.pack("<" + count_format, len(tags))
+        data_offset = (
+            ifd_offset
+            + struct.calcsize(count_format)
+            + entry_size * len(tags)
+            + struct.calcsize(offset_format)
+        )
+        data = b""
+        for tag, field_type, values in tags:
+            if isinstance(values, bytes):
+                value_bytes, count = values, len(values)
+            else:
+                value_bytes = struct.pack(
+                    f"<{len(values)}{_TYPE_FORMAT[field_type]}", *values
+                )
+                count = len(values)
+            header = struct.pack(f"<HH{value_count_format}", tag, field_type, count)
+            if len(value_bytes) <= inline_size:
+                entries += header + value_bytes.ljust(inline_size, b"\0")
+            else:
+                entries += header + struct.pack(
+                    "<" + offset_format, data_offset + len(data)
+                )
+                data += value_bytes
+                if len(data) % 2:
+                    data += b"\0"
+        entries += struct.pack("<" + offset_format, next_ifd)
+        return entries + data
+
+    def _layout(self) -> Tuple[List[int], int]:
+        ifd_offsets = []
+        position = self._header_size
+        for level in range(self.level_count):
+            ifd_offsets.append(position)
+            position += len(self._encode_ifd(level, position, 0))
+            position += position % 2
+        return ifd_offsets, position
+
+    def write_tile(self, level: int, col: int, row: int, payload: bytes):
+        """
+        Appends an encoded tile to the file
+        """
+        cols, rows = self.tile_grids[level]
+        if not (0 <= col < cols and 0 <= row < rows):
+            raise ValueError(f"Tile {col}/{row} outside of level {level}")
+        index = row * cols + col
+        self.offsets[level][index] = self._file.tell()
+        self.byte_counts[level][index] = len(payload)
+        self._file.write(payload)
+
+    def close(self):
+        """
+        Writes the header and the IFDs with the final tile offsets
+        """
+        if self._file.closed:
+            return
+        if not self.bigtiff and self._file.tell() >= 2**32:
+            self._file.close()
+            raise ValueError("File exceeds 4GB, a BigTIFF is required")
+        self._file.seek(0)
+        if self.bigtiff:
+            self._file.write(
+                b"II" + struct.pack("<HHHQ", 43, 8, 0, self._ifd_offsets[0])
+            )
+        else:
+            self._file.write(b"II" + struct.pack("<HI", 42, self._ifd_offsets[0]))
+        for level, ifd_offset in enumerate(self._ifd_offsets):
+            next_ifd = (
+                self._ifd_offsets[level + 1] if level + 1 < self.level_count else 0
+            )
+            self._file.seek(ifd_offset)
+            self._file.write(self._encode_ifd(level, ifd_offset, next_ifd))
+        self._file.close()
+
+    def __enter__(self) -> "CogWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+        return False
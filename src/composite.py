@@ -0,0 +1,222 @@
+"""
+Best-pixel composite of all dates of a query.
+
+With the `composite` query parameter a fetch returns a single image instead of one image
+per date. The tiles of all dates are streamed tile by tile through a vectorized
+compositor, so memory is bounded by one tile position of all dates, independent of the
+AOI size. For every pixel the rule selects from the dates with valid (non-nodata) data:
+
+- `latest_valid`: the most recent valid pixel
+- `median`: the per band median of the valid pixels
+- `max_ndvi`: the pixel of the date with the highest NDVI, computed from a requested
+  corrected reflectance 7-2-1 layer (NIR in the green and red in the blue channel)
+"""
+
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import mercantile
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy  # pylint: disable=no-name-in-module
+from rasterio.windows import Window
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+
+from data_coverage import valid_fraction
+from gibs import GibsAPI, get_tile_grid, layer_bands
+
+logger = get_logger(__name__)
+
+COMPOSITE_RULES = ("latest_valid", "median", "max_ndvi")
+TILE_SIZE = 256
+NDVI_LAYER_SUFFIX = "CorrectedReflectance_Bands721"
+# Bands of the 7-2-1 composite: red = MODIS band 7, green = band 2 (NIR), blue = band 1
+NIR_BAND = 1
+RED_BAND = 2
+
+
+def ndvi_bands(imagery_layers: dict) -> Tuple[int, int]:
+    """
+    Indexes of the NIR and red band in the stacked bands of all layers
+    """
+    offset = 0
+    for layer, attributes in imagery_layers.items():
+        bands = attributes.get("bands") or list(
+            range(1, attributes.get("bands_count", 3) + 1)
+        )
+        if layer.endswith(NDVI_LAYER_SUFFIX):
+            if NIR_BAND + 1 not in bands or RED_BAND + 1 not in bands:
+                raise UP42Error(
+                    SupportedErrors.INPUT_PARAMETERS_ERROR,
+                    f"The max_ndvi composite requires the bands {NIR_BAND + 1} and "
+                    f"{RED_BAND + 1} of {layer}.",
+                )
+            return offset + bands.index(NIR_BAND + 1), offset + bands.index(
+                RED_BAND + 1
+            )
+        offset += len(bands)
+    raise UP42Error(
+        SupportedErrors.INPUT_PARAMETERS_ERROR,
+        f"The max_ndvi composite requires a *_{NDVI_LAYER_SUFFIX} imagery layer.",
+    )
+
+
+def validate_composite(rule: Optional[str], imagery_layers: dict):
+    if rule is None:
+        return
+    if rule not in COMPOSITE_RULES:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid composite {rule}, valid composites are {list(COMPOSITE_RULES)}.",
+        )
+    if rule == "max_ndvi":
+        ndvi_bands(imagery_layers)
+
+
+def composite_stack(
+    stack: np.ndarray, rule: str, nir_red: Optional[Tuple[int, int]] = None
+) -> np.ndarray:
+    """
+    Composites a (dates, bands, rows, cols) stack, dates in ascending order, into a
+    (bands, rows, cols) array. Pixels without valid data in any date are 0.
+    """
+    valid = stack.any(axis=1)
+    if rule == "median":
+        with warnings.catch_warnings():
+            # All-nodata pixels give a NaN median
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(
+                np.where(valid[:, None], stack.astype(np.float32), np.nan), axis=0
+            )
+        return np.rint(np.nan_to_num(median)).astype(stack.dtype)
+
+    if rule == "latest_valid":
+        index = stack.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+    elif rule == "max_ndvi":
+        if nir_red is None:
+            raise ValueError("The max_ndvi rule requires the NIR and red band indexes")
+        nir = stack[:, nir_red[0]].astype(np.float32)
+        red = stack[:, nir_red[1]].astype(np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndvi = (nir - red) / (nir + red)
+        ndvi[~valid | np.isnan(ndvi)] = -np.inf
+        index = np.argmax(ndvi, axis=0)
+    else:
+        raise ValueError(f"Unknown composite rule {rule}")
+    # Dates without valid data are only selected if no date has any, and are all 0
+    return np.take_along_axis(stack, index[None, None], axis=0)[0]
+
+
+def read_tile(
+    api: GibsAPI, imagery_layers: dict, tile: mercantile.Tile, layer: str, date: str
+) -> np.ndarray:
+    attributes = imagery_layers[layer]
+    response = api.requests_wmts_tile(tile, layer, date, attributes["Format"])
+    with api.metrics.stage("decode"), MemoryFile(response.content) as mem_file:
+        with mem_file.open() as image:
+            return image.read(indexes=layer_bands(attributes))
+
+
+def write_composite(
+    img_filename: Path,
+    api: GibsAPI,
+    imagery_layers: dict,
+    dates: List[str],
+    tile_list: List[mercantile.Tile],
+    rule: str,
+    max_workers: int = 8,
+) -> float:
+    """
+    Writes the composite of the tiles of all dates into an uncompressed tiled GeoTIFF
+    covering the tile grid of tile_list, tile by tile.
+
+    :return: The valid data coverage of the composite
+    """
+    nir_red = ndvi_bands(imagery_layers) if rule == "max_ndvi" else None
+    dates = sorted(dates)
+    count = sum(attributes["bands_count"] for attributes in imagery_layers.values())
+    transform, width, height = get_tile_grid(tile_list, TILE_SIZE)
+    min_x = min(tile.x for tile in tile_list)
+    min_y = min(tile.y for tile in tile_list)
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": count,
+        "width": width,
+        "height": height,
+        "crs": "EPSG:3857",
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": TILE_SIZE,
+        "blockysize": TILE_SIZE,
+    }
+    # One task per date and layer, in the order of the stacked bands
+    task_dates = [date for date in dates for _ in imagery_layers]
+    task_layers = [layer for _ in dates for layer in imagery_layers]
+    covered = 0.0
+    with rio.open(img_filename, "w", **profile) as dst, ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        for tile in tile_list:
+            layer_data = list(
+                executor.map(
+                    partial(read_tile, api, imagery_layers, tile),
+                    task_layers,
+                    task_dates,
+                )
+            )
+            stack = np.stack(
+                [
+                    np.concatenate(layer_data[i : i + len(imagery_layers)])
+                    for i in range(0, len(layer_data), len(imagery_layers))
+                ]
+            )
+            with api.metrics.stage("composite"):
+                data = composite_stack(stack, rule, nir_red)
+                covered += valid_fraction(data)
+            dst.write(
+                data,
+                window=Window(
+                    (tile.x - min_x) * TILE_SIZE,
+                    (tile.y - min_y) * TILE_SIZE,
+                    TILE_SIZE,
+                    TILE_SIZE,
+                ),
+            )
+
+    logger.info(f"Composited {len(tile_list)} tiles of {len(dates)} dates ({rule})")
+    return covered / len(tile_list)
+
+
+def write_composite_quicklook(
+    img_filename: Path, quicklook_filename: Path, size: Tuple[int, int] = (512, 512)
+):
+    """
+    RGB JPEG quicklook of the first three bands of the composite
+    """
+    with rio.open(img_filename) as src:
+        scale = min(size[0] / src.width, size[1] / src.height, 1)
+        out_shape = (max(1, int(src.height * scale)), max(1, int(src.width * scale)))
+        indexes = [min(band, src.count) for band in (1, 2, 3)]
+        data = src.read(
+            indexes=indexes, out_shape=out_shape, resampling=Resampling.average
+        )
+    # The JPEG driver can only copy datasets
+    with MemoryFile() as mem_file:
+        with mem_file.open(
+            driver="GTiff",
+            width=out_shape[1],
+            height=out_shape[0],
+            count=3,
+            dtype="uint8",
+        ) as rgb:
+            rgb.write(data)
+            copy(rgb, str(quicklook_filename), driver="JPEG")
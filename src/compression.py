@@ -0,0 +1,276 @@
+"""
+Output compression profiles.
+
+A profile sets the codec, compression level, predictor, block size and overview
+resampling used for the merged image and its COG conversion. It is selected with the
+`compression_profile` query parameter:
+
+- `fast`: quick turnaround, ZSTD level 1 (readers need GDAL >= 2.3 with ZSTD)
+- `balanced` (default): the previous DEFLATE output with a horizontal predictor, which
+  makes the files smaller without changing any pixel values
+- `archival`: smallest files, ZSTD level 19, slow to encode
+
+All profiles are lossless. See `benchmarks/bench_compression.py` for encode time and size
+per profile.
+
+The COG conversion compresses and builds overviews with `cog_threads` GDAL threads (all
+CPUs by default). With `cog_workers` > 1 the conversions of different dates run in
+parallel worker processes, overlapping with the fetch of the following dates.
+"""
+
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Literal, Optional
+
+import numpy as np
+import rasterio as rio
+from rasterio.shutil import copy  # pylint: disable=no-name-in-module
+from rio_cogeo.cogeo import cog_translate
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_COMPRESSION_PROFILE = "balanced"
+
+# Overview resampling methods of rio-cogeo
+OverviewResampling = Literal[
+    "nearest",
+    "bilinear",
+    "cubic",
+    "cubic_spline",
+    "lanczos",
+    "average",
+    "mode",
+    "gauss",
+    "rms",
+]
+
+# Creation option of the compression level of each codec
+_LEVEL_OPTIONS = {
+    "deflate": "zlevel",
+    "zstd": "zstd_level",
+    "lzma": "lzma_preset",
+    "jpeg": "jpeg_quality",
+    "webp": "webp_level",
+}
+
+
+@dataclass(frozen=True)
+class CompressionProfile:
+    name: str
+    codec: str
+    level: Optional[int] = None
+    predictor: int = 1
+    blocksize: int = 512
+    overview_resampling: OverviewResampling = "nearest"
+    # Level of the merged image, which is only read once by the COG conversion
+    merge_level: Optional[int] = None
+
+    def creation_options(self, level: Optional[int] = None) -> dict:
+        """
+        GeoTIFF creation options of the profile, optionally with a different level
+        """
+        level = self.level if level is None else level
+        options = {
+            "tiled": True,
+            "blockxsize": self.blocksize,
+            "blockysize": self.blocksize,
+            "compress": self.codec,
+        }
+        if self.predictor > 1:
+            options["predictor"] = self.predictor
+        if level is not None:
+            options[_LEVEL_OPTIONS[self.codec]] = level
+        return options
+
+    def cog_profile(self) -> dict:
+        """
+        Output profile for rio-cogeo
+        """
+        return {"driver": "GTiff", "interleave": "pixel", **self.creation_options()}
+
+
+COMPRESSION_PROFILES: Dict[str, CompressionProfile] = {
+    profile.name: profile
+    for profile in [
+        CompressionProfile("fast", codec="zstd", level=1, predictor=2),
+        CompressionProfile("balanced", codec="deflate", level=6, predictor=2),
+        CompressionProfile(
+            "archival",
+            codec="zstd",
+            level=19,
+            predictor=2,
+            overview_resampling="average",
+            merge_level=1,
+        ),
+    ]
+}
+
+
+def get_compression_profile(name: str) -> CompressionProfile:
+    try:
+        return COMPRESSION_PROFILES[name]
+    except KeyError as err:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid compression profile {name}, "
+            f"valid profiles are {list(COMPRESSION_PROFILES)}.",
+        ) from err
+
+
+def write_multiband_tif(
+    list_tif_files: List[Path], filename_path: Path, profile: CompressionProfile
+):
+    """
+    Stacks the bands of all tif files into one tif written with the profile's
+    compression, block by block of the output
+    """
+    datasets = [rio.open(tif_file) for tif_file in list_tif_files]
+    try:
+        raster_profile = datasets[0].profile
+        raster_profile.update(
+            count=sum(dataset.count for dataset in datasets),
+            **profile.creation_options(profile.merge_level),
+        )
+        with rio.open(filename_path, "w", **raster_profile) as dst:
+            for _, window in dst.block_windows(1):
+                dst.write(
+                    np.concatenate(
+                        [dataset.read(window=window) for dataset in datasets], axis=0
+                    ),
+                    window=window,
+                )
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+
+def copy_with_overviews(
+    src_path: Path, dst_path: Path, overviews: List[Path], output_profile: dict
+):
+    """
+    Copies src_path into a COG using the given files as overview levels instead of
+    computing them. The band tags and color interpretation are kept.
+    """
+    vrt_path = Path(str(dst_path) + ".vrt")
+    copy(str(src_path), str(vrt_path), driver="VRT")
+    try:
+        tree = ET.parse(vrt_path)
+        for band in tree.getroot().iter("VRTRasterBand"):
+            for overview in overviews:
+                element = ET.SubElement(band, "Overview")
+                ET.SubElement(element, "SourceFilename").text = str(overview)
+                ET.SubElement(element, "SourceBand").text = band.get("band")
+        tree.write(vrt_path)
+        copy(str(vrt_path), str(dst_path), copy_src_overviews=True, **output_profile)
+    finally:
+        vrt_path.unlink()
+
+
+def to_cog(
+    path_to_image: Path,
+    profile: CompressionProfile,
+    threads: Optional[int] = None,
+    overviews: Optional[List[Path]] = None,
+    blocksize: Optional[int] = None,
+    **options,
+):
+    """
+    Converts a GeoTIFF into a Cloud-optimized GeoTIFF with the profile's compression.
+
+    :param threads: Threads for compression and overviews, defaults to all CPUs
+    :param overviews: Prebuilt overview levels (largest first) used instead of
+        resampling the image; they are removed afterwards
+    :param blocksize: Tile size of the COG instead of the profile's
+    """
+    logger.info(f"Now converting to COG with {profile.name} compression")
+    tmp_file_path = Path(str(path_to_image) + ".tmp")
+    path_to_image.rename(tmp_file_path)
+
+    num_threads = str(threads) if threads else "ALL_CPUS"
+    output_profile = profile.cog_profile()
+    output_profile.update(dict(BIGTIFF="IF_SAFER", NUM_THREADS=num_threads))
+    if blocksize is not None:
+        output_profile.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+    config = dict(
+        GDAL_NUM_THREADS=num_threads,
+        GDAL_TIFF_INTERNAL_MASK=True,
+        GDAL_TIFF_OVR_BLOCKSIZE="128",
+    )
+
+    if overviews:
+        with rio.Env(**config):
+            copy_with_overviews(tmp_file_path, path_to_image, overviews, output_profile)
+        for overview in overviews:
+            overview.unlink()
+    else:
+        cog_translate(
+            str(tmp_file_path),
+            str(path_to_image),
+            output_profile,
+            config=config,
+            overview_resampling=profile.overview_resampling,
+            in_memory=False,
+            quiet=True,
+            **options,
+        )
+    tmp_file_path.unlink()
+
+
+def _timed_to_cog(path_to_image: Path, profile: CompressionProfile, **options) -> float:
+    start = time.perf_counter()
+    to_cog(path_to_image, profile, **options)
+    return time.perf_counter() - start
+
+
+class CogWorkerPool:
+    """
+    Runs the COG conversions of different dates in parallel worker processes
+    """
+
+    def __init__(self, workers: int, threads: Optional[int] = None):
+        """
+        :param workers: Number of worker processes
+        :param threads: GDAL threads per conversion, defaults to the CPUs per worker
+        """
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        # pylint: disable=import-outside-toplevel
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._futures: Dict[Path, Future] = {}
+
+    def submit(self, path_to_image: Path, profile: CompressionProfile, **options):
+        self._futures[Path(path_to_image)] = self._executor.submit(
+            _timed_to_cog, path_to_image, profile, threads=self.threads, **options
+        )
+
+    def wait(self, path_to_image: Path) -> Optional[float]:
+        """
+        Waits for the conversion of an image and returns its duration in seconds,
+        None if no conversion was submitted for it
+        """
+        future = self._futures.pop(Path(path_to_image), None)
+        return future.result() if future is not None else None
+
+    def shutdown(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._futures = {}
+
+    def __enter__(self) -> "CogWorkerPool":
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
@@ -0,0 +1,68 @@
+"""
+Valid data coverage of the fetched dates.
+
+While the tiles are merged, the fraction of valid (not nodata) pixels of every tile is
+measured. Their sum over the tile cover gives the coverage ratio of the feature, which is
+added to its properties as `coverage`. Dates below the optional `min_coverage` query
+parameter (e.g. mostly swath gaps) are dropped before post-processing and COG conversion.
+"""
+
+import threading
+from typing import Dict, Iterable
+
+import numpy as np
+from geojson import Feature
+from mercantile import Tile
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+
+# Marks the features of dropped dates in the checkpoint journal
+DROPPED_PROPERTY = "dropped"
+
+
+def valid_fraction(data: np.ndarray) -> float:
+    """
+    Fraction of pixels with data in any band of a (bands, rows, cols) array; GIBS
+    tiles have 0 in all bands outside of the swaths
+    """
+    return float(np.count_nonzero(data.any(axis=0))) / (data.shape[1] * data.shape[2])
+
+
+class TileCoverage:
+    """
+    Valid pixel fractions of the tiles of one layer, collected from the merge threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fractions: Dict[Tile, float] = {}
+
+    def add(self, tile: Tile, fraction: float):
+        with self._lock:
+            self.fractions[tile] = fraction
+
+    def ratio(self, tile_count: int) -> float:
+        """
+        Coverage of a tile cover of tile_count tiles; tiles that were not added
+        (empty tiles) count as without data
+        """
+        return sum(self.fractions.values()) / tile_count if tile_count else 0.0
+
+
+def feature_coverage(coverages: Iterable[TileCoverage], tile_count: int) -> float:
+    """
+    Coverage of a feature with several layers, the coverage of its least covered layer
+    """
+    return min(coverage.ratio(tile_count) for coverage in coverages)
+
+
+def validate_min_coverage(min_coverage) -> None:
+    if min_coverage is not None and not 0 <= min_coverage <= 1:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid min_coverage {min_coverage}, must be between 0 and 1.",
+        )
+
+
+def is_dropped(feature: Feature) -> bool:
+    return bool(feature["properties"].get(DROPPED_PROPERTY))
@@ -0,0 +1,171 @@
+"""
+Settings of a fetch job, shared by all its dates.
+
+`set_query_defaults` fills in and validates the optional parameters of a query, and
+`FetchOptions.from_query` resolves them against the imagery layers of the query, e.g.
+JPEG pass-through only applies to a single JPEG layer and is disabled otherwise.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from chunking import validate_memory_budget
+from compression import (
+    COMPRESSION_PROFILES,
+    DEFAULT_COMPRESSION_PROFILE,
+    CogWorkerPool,
+    CompressionProfile,
+    get_compression_profile,
+)
+from data_coverage import validate_min_coverage
+from geographic import EPSG_3857, EPSG_4326, validate_crs
+from gibs import validate_bands
+from jpeg_passthrough import is_passthrough_eligible
+from zarr_store import ZARR_STORE_NAME
+
+logger = get_logger(__name__)
+
+OUTPUT_FORMATS = ("geotiff", "zarr")
+
+
+def set_query_defaults(query: STACQuery):
+    """
+    Sets the defaults of the optional query parameters and validates them
+    """
+    query.set_param_if_not_exists("bands", None)
+    validate_bands(query.bands, query.imagery_layers)
+    query.set_param_if_not_exists("include_metrics", False)
+    query.set_param_if_not_exists("incremental", False)
+    query.set_param_if_not_exists("checkpoint_tiles", False)
+    query.set_param_if_not_exists("jpeg_passthrough", False)
+    query.set_param_if_not_exists("compression_profile", DEFAULT_COMPRESSION_PROFILE)
+    get_compression_profile(query.compression_profile)
+    query.set_param_if_not_exists("cog_threads", None)
+    query.set_param_if_not_exists("cog_workers", 1)
+    query.set_param_if_not_exists("native_overviews", False)
+    query.set_param_if_not_exists("min_coverage", None)
+    validate_min_coverage(query.min_coverage)
+    query.set_param_if_not_exists("crs", EPSG_3857)
+    validate_crs(query.crs)
+    query.set_param_if_not_exists("memory_budget_mb", None)
+    validate_memory_budget(query.memory_budget_mb)
+    query.set_param_if_not_exists("progressive", False)
+    query.set_param_if_not_exists("composite", None)
+    query.set_param_if_not_exists("output_format", "geotiff")
+    if query.output_format not in OUTPUT_FORMATS:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid output format {query.output_format}, "
+            f"valid formats are {list(OUTPUT_FORMATS)}.",
+        )
+    if query.crs == EPSG_4326 and (query.output_format == "zarr" or query.composite):
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            "Zarr output and composites are only available in EPSG:3857.",
+        )
+
+
+@dataclass
+class FetchOptions:
+    """
+    Settings of a fetch job resolved from its query, see `from_query`
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    dry_run: bool = False
+    # Copies the tiles of a single JPEG layer into the COG without decoding and
+    # re-encoding them, the compression profile does not apply
+    jpeg_passthrough: bool = False
+    compression_profile: CompressionProfile = COMPRESSION_PROFILES[
+        DEFAULT_COMPRESSION_PROFILE
+    ]
+    cog_threads: Optional[int] = None
+    cog_workers: int = 1
+    # Builds the COG overviews from the lower GIBS zoom levels
+    native_overviews: bool = False
+    # Dates with a lower valid data coverage are dropped after the merge
+    min_coverage: Optional[float] = None
+    # Store the mosaics are appended to instead of being converted to COGs
+    zarr_path: Optional[Path] = None
+    # Merges AOIs whose mosaic does not fit in chunks, see `chunking`
+    memory_budget_mb: Optional[float] = None
+    # Emits a preview of each date first, see `progressive`
+    progressive: bool = False
+    include_metrics: bool = False
+    incremental: bool = False
+    # Keeps the tiles of the job in its checkpoint, see `checkpoint`
+    checkpoint_tiles: bool = False
+    # Runs the COG conversions of the dates in parallel, the conversion of a date
+    # has to be waited for before its image is used
+    cog_pool: Optional[CogWorkerPool] = None
+
+    @classmethod
+    def from_query(
+        cls,
+        query: STACQuery,
+        dry_run: bool,
+        valid_imagery_layers: OrderedDict,
+        output_dir: Path,
+    ) -> "FetchOptions":
+        """
+        Options of a query with its defaults set, see `set_query_defaults`. The
+        options that do not apply to the layers, crs or output format are disabled.
+        """
+        options = cls(
+            dry_run=dry_run,
+            jpeg_passthrough=query.jpeg_passthrough
+            and is_passthrough_eligible(valid_imagery_layers),
+            compression_profile=get_compression_profile(query.compression_profile),
+            cog_threads=query.cog_threads,
+            cog_workers=query.cog_workers,
+            native_overviews=query.native_overviews,
+            min_coverage=query.min_coverage,
+            memory_budget_mb=query.memory_budget_mb,
+            progressive=query.progressive and not dry_run,
+            include_metrics=query.include_metrics,
+            incremental=query.incremental and not dry_run,
+            checkpoint_tiles=query.checkpoint_tiles and not dry_run,
+        )
+        if query.output_format == "zarr" and not dry_run:
+            options.zarr_path = output_dir / ZARR_STORE_NAME
+        if query.jpeg_passthrough and not options.jpeg_passthrough:
+            logger.info(
+                "JPEG pass-through requires a single JPEG layer without a band "
+                "selection, disabled"
+            )
+        if query.crs == EPSG_4326 and (
+            options.jpeg_passthrough or options.native_overviews
+        ):
+            logger.info(
+                "JPEG pass-through and native overviews use the Web Mercator "
+                "tile grid, disabled"
+            )
+            options.jpeg_passthrough = False
+            options.native_overviews = False
+        if options.zarr_path is not None and (
+            options.jpeg_passthrough or options.incremental
+        ):
+            logger.info(
+                "Zarr output appends to one store, pass-through and "
+                "incremental mode are disabled"
+            )
+            options.jpeg_passthrough = False
+            options.incremental = False
+        if options.progressive and (
+            query.crs == EPSG_4326 or options.zarr_path is not None
+        ):
+            logger.info(
+                "Previews are Web Mercator GeoTIFFs, progressive mode is disabled for "
+                "geographic and Zarr output"
+            )
+            options.progressive = False
+        if options.dry_run or options.jpeg_passthrough or options.zarr_path is not None:
+            # Nothing is converted to a COG in the job
+            options.cog_workers = 1
+        return options
@@ -0,0 +1,128 @@
+"""
+Tile grid of the GIBS geographic (EPSG:4326) tile matrix sets.
+
+With `"crs": "EPSG:4326"` the catalog, tile cover, tile URLs and mosaic use the
+`epsg4326/best` endpoint of GIBS, so the output is in geographic coordinates without a
+reprojection. All geographic tile matrix sets share one grid of 512 pixel tiles with the
+top left corner at (-180, 90) and 0.5625 degrees per pixel at level 0; they only differ
+in their highest level. Level n has about the resolution of the Web Mercator zoom level
+n + 1 at the equator, so the zoom level of the query maps to level zoom_level - 1.
+
+The module can be used in place of mercantile for `bounds`, e.g. in
+`blockutils.geometry.tiles_to_geom(tiles, func=geographic)`.
+"""
+
+import math
+from typing import Iterator, List, Tuple
+
+import mercantile
+from mercantile import Tile
+from rasterio.transform import Affine, from_bounds
+from shapely.geometry import box, shape
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+
+EPSG_3857 = "EPSG:3857"
+EPSG_4326 = "EPSG:4326"
+SUPPORTED_CRS = (EPSG_3857, EPSG_4326)
+
+TILE_SIZE = 512
+# COG tile size of the output, smaller than a column of tiles: rio-cogeo reports blocks
+# as wide as the image as not tiled
+COG_BLOCKSIZE = 256
+LEVEL0_RESOLUTION = 0.5625
+# Highest level of the geographic tile matrix sets
+TILE_MATRIX_SET_LEVELS = {
+    "2km": 5,
+    "1km": 6,
+    "500m": 7,
+    "250m": 8,
+    "125m": 9,
+    "62.5m": 10,
+    "31.25m": 11,
+    "15.625m": 12,
+}
+
+
+def validate_crs(crs: str):
+    if crs not in SUPPORTED_CRS:
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            f"Invalid crs {crs}, valid values are {list(SUPPORTED_CRS)}.",
+        )
+
+
+def tile_level(zoom_level: int, imagery_layers: dict) -> int:
+    """
+    Geographic level of a query zoom level, limited to the highest level all
+    imagery layers have, so their tiles share one grid
+    """
+    return min(
+        [zoom_level - 1]
+        + [
+            TILE_MATRIX_SET_LEVELS[attributes["TileMatrixSet"]]
+            for attributes in imagery_layers.values()
+        ]
+    )
+
+
+def tile_span(level: int) -> float:
+    """
+    Width and height of a tile in degrees
+    """
+    return TILE_SIZE * LEVEL0_RESOLUTION / 2**level
+
+
+def bounds(tile: Tile) -> mercantile.LngLatBbox:
+    span = tile_span(tile.z)
+    west = -180 + tile.x * span
+    north = 90 - tile.y * span
+    return mercantile.LngLatBbox(west, north - span, west + span, north)
+
+
+def tiles(west, south, east, north, level: int) -> Iterator[Tile]:
+    """
+    Tiles of a level intersecting the bounds, by row and column
+    """
+    span = tile_span(level)
+    max_col = math.ceil(360 / span) - 1
+    max_row = math.ceil(180 / span) - 1
+    min_x = max(0, math.floor((max(west, -180) + 180) / span))
+    max_x = min(max_col, max(min_x, math.ceil((min(east, 180) + 180) / span) - 1))
+    min_y = max(0, math.floor((90 - min(north, 90)) / span))
+    max_y = min(max_row, max(min_y, math.ceil((90 - max(south, -90)) / span) - 1))
+    for y in range(min_y, max_y + 1):
+        for x in range(min_x, max_x + 1):
+            yield Tile(x, y, level)
+
+
+def get_tile_list(bbox, geometry, level: int) -> List[Tile]:
+    """
+    List of geographic tiles that cover the geometry, sorted by (y, x) in ascending
+    order
+    """
+    geometry = shape(geometry)
+    west, south, east, north = bbox
+    tile_list = []
+    for tile in tiles(west, south, east, north, level):
+        tile_bbox = box(*bounds(tile))
+        if geometry.intersects(tile_bbox) and not geometry.touches(tile_bbox):
+            tile_list.append(tile)
+    return tile_list
+
+
+def get_tile_grid(tile_list: List[Tile]) -> Tuple[Affine, int, int]:
+    """
+    Geographic grid of the bounding tile range of a tile list, see
+    `gibs.get_tile_grid`
+    """
+    min_x = min(tile.x for tile in tile_list)
+    min_y = min(tile.y for tile in tile_list)
+    max_x = max(tile.x for tile in tile_list)
+    max_y = max(tile.y for tile in tile_list)
+    level = tile_list[0].z
+    west, _, _, north = bounds(Tile(min_x, min_y, level))
+    _, south, east, _ = bounds(Tile(max_x, max_y, level))
+    width = (max_x - min_x + 1) * TILE_SIZE
+    height = (max_y - min_y + 1) * TILE_SIZE
+    return from_bounds(west, south, east, north, width, height), width, height
@@ -1,7 +1,9 @@
 import collections
+import time
 from datetime import datetime, timedelta
 from io import BytesIO
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
 
 import mercantile
 import pytz
@@ -12,13 +14,24 @@ from dateutil import parser
 from requests import Response
 from shapely.geometry import box
 from rasterio.enums import ColorInterp
+from rasterio.transform import Affine, from_bounds
 
 from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.geometry import filter_tiles_intersect_with_geometry
 from blockutils.logging import get_logger
 from blockutils.stac import STACQuery
 
+from geographic import EPSG_3857, EPSG_4326, TILE_MATRIX_SET_LEVELS
+from metrics import Metrics
+from tile_cache import DEFAULT_CAPABILITIES_MAX_AGE, TileCache, cached_response
+
 logger = get_logger(__name__)
 
+WEB_MERCATOR_TILE_MATRIX_SET = "GoogleMapsCompatible_Level9"
+QUICKLOOK_CHUNK_SIZE = 2**20
+# Seconds to wait on the connection and on each read of a response
+REQUEST_TIMEOUT = 60.0
+
 
 class WMTSException(Exception):
     pass
@@ -85,6 +98,80 @@ def extract_query_dates(query: STACQuery) -> list:
     return date_list
 
 
+def get_tile_list(bounds, geometry, zoom_level: int) -> List[mercantile.Tile]:
+    """
+    List of tiles that cover the geometry, sorted by (y, x) in ascending order
+
+    :param bounds: Bounds of the geometry
+    :param geometry: A GeoJSON geometry
+    :param zoom_level: The zoom level of the tiles
+    :return: A list of tiles intersecting with the geometry
+    """
+    return list(
+        filter_tiles_intersect_with_geometry(
+            tiles=mercantile.tiles(*bounds, zooms=zoom_level, truncate=True),
+            geometry=geometry,
+        )
+    )
+
+
+def get_tile_grid(
+    tile_list: List[mercantile.Tile], tile_size: int = 256
+) -> Tuple[Affine, int, int]:
+    """
+    Web Mercator grid of the bounding tile range of a tile list
+
+    :return: The transform, width and height of the grid
+    """
+    min_x = min(tile.x for tile in tile_list)
+    min_y = min(tile.y for tile in tile_list)
+    max_x = max(tile.x for tile in tile_list)
+    max_y = max(tile.y for tile in tile_list)
+    zoom = tile_list[0].z
+    left, _, _, top = mercantile.xy_bounds(mercantile.Tile(min_x, min_y, zoom))
+    _, bottom, right, _ = mercantile.xy_bounds(mercantile.Tile(max_x, max_y, zoom))
+    width = (max_x - min_x + 1) * tile_size
+    height = (max_y - min_y + 1) * tile_size
+    return from_bounds(left, bottom, right, top, width, height), width, height
+
+
+def layer_bands(attributes: dict) -> List[int]:
+    """
+    Bands of a layer in the output, by their index (from 1) in the tiles of the layer
+    """
+    return attributes.get("bands") or list(range(1, attributes["bands_count"] + 1))
+
+
+def validate_bands(bands: Optional[dict], imagery_layers: List[str]):
+    """
+    Checks the band selection of a query, distinct band indexes (from 1) by layer
+    """
+    if bands is None:
+        return
+    if not isinstance(bands, dict):
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            "Invalid bands, expected band indexes by imagery layer.",
+        )
+    for layer, indexes in bands.items():
+        if layer not in imagery_layers:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"Invalid bands, {layer} is not one of the imagery layers.",
+            )
+        if (
+            not isinstance(indexes, list)
+            or not indexes
+            or not all(isinstance(index, int) and index >= 1 for index in indexes)
+            or len(set(indexes)) != len(indexes)
+        ):
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"Invalid bands {indexes} of {layer}, expected distinct band "
+                "indexes starting at 1.",
+            )
+
+
 def make_list_layer_band(imagery_layers: collections.OrderedDict, count: int) -> List:
     """
     Makes list of all output bands and their respective provenance.
@@ -99,7 +186,7 @@ def make_list_layer_band(imagery_layers: collections.OrderedDict, count: int) ->
 
     for layer in imagery_layers:
         layer_names += [layer] * imagery_layers[layer]["bands_count"]
-        band_order += list(range(1, imagery_layers[layer]["bands_count"] + 1))
+        band_order += layer_bands(imagery_layers[layer])
 
     for band_number in range(1, count + 1):
         layer_name = layer_names[band_number - 1]
@@ -108,48 +195,205 @@ def make_list_layer_band(imagery_layers: collections.OrderedDict, count: int) ->
     return out_list
 
 
+def catalog_entry(layer: dict) -> dict:
+    """
+    Relevant attributes of a parsed capabilities layer element
+    """
+    extent_lc = layer["ows:WGS84BoundingBox"]["ows:LowerCorner"]
+    extent_uc = layer["ows:WGS84BoundingBox"]["ows:UpperCorner"]
+    coords = [float(i) for i in extent_lc.split(" ") + extent_uc.split(" ")]
+    return {
+        "Identifier": layer["ows:Identifier"],
+        "TileMatrixSet": layer["TileMatrixSetLink"]["TileMatrixSet"],
+        "WGS84BoundingBox": box(*coords),
+        "Format": layer["Format"].split("/")[1],
+    }
+
+
+class LayerCatalog:
+    """
+    Suitable imagery layers of a capabilities document, parsed on demand. Looking up
+    a layer only parses its own layer element, so a job does not pay for parsing the
+    hundreds of layers (with their long lists of dates) it does not request.
+    """
+
+    def __init__(self, content: bytes, crs: str = EPSG_3857):
+        self.content = content
+        self.crs = crs
+        self.loaded = time.time()
+        self._layers: Dict[str, Optional[dict]] = {}
+        self._all: Optional[Dict[str, dict]] = None
+
+    def is_suitable(self, entry: dict) -> bool:
+        """
+        Layers with TileMatrixSet == GoogleMapsCompatible_Level9, or a known
+        geographic TileMatrixSet in EPSG:4326
+        """
+        if self.crs == EPSG_4326:
+            return entry["TileMatrixSet"] in TILE_MATRIX_SET_LEVELS
+        return entry["TileMatrixSet"] == WEB_MERCATOR_TILE_MATRIX_SET
+
+    def _parse_layer(self, identifier: str) -> Optional[dict]:
+        marker = f"<ows:Identifier>{escape(identifier)}</ows:Identifier>".encode()
+        position = self.content.find(marker)
+        while position != -1:
+            start = self.content.rfind(b"<Layer", 0, position)
+            end = self.content.find(b"</Layer>", position)
+            # Identifiers of styles and tile matrix sets are not in a layer of their own
+            if (
+                start != -1
+                and end != -1
+                and self.content.find(b"</Layer>", start, position) == -1
+            ):
+                element = self.content[start : end + len(b"</Layer>")]
+                layer = xmltodict.parse(element)["Layer"]
+                if layer.get("ows:Identifier") == identifier:
+                    entry = catalog_entry(layer)
+                    return entry if self.is_suitable(entry) else None
+            position = self.content.find(marker, position + len(marker))
+        return None
+
+    def get(self, identifier: str) -> Optional[dict]:
+        """
+        Copy of the attributes of the layer, None if it is unknown or not suitable
+        """
+        if self._all is not None:
+            entry = self._all.get(identifier)
+        else:
+            if identifier not in self._layers:
+                self._layers[identifier] = self._parse_layer(identifier)
+            entry = self._layers[identifier]
+        return dict(entry) if entry is not None else None
+
+    def layers(self) -> Dict[str, dict]:
+        """
+        Copy of the attributes of all suitable layers, parses the whole document
+        """
+        if self._all is None:
+            capabilities = xmltodict.parse(self.content)
+            self._all = {}
+            for layer in capabilities["Capabilities"]["Contents"]["Layer"]:
+                entry = catalog_entry(layer)
+                if self.is_suitable(entry):
+                    self._all[entry["Identifier"]] = entry
+        return {identifier: dict(entry) for identifier, entry in self._all.items()}
+
+
+class HttpTransport:
+    """
+    Blocking HTTP transport of `GibsAPI`
+    """
+
+    def __init__(self, session: Optional[requests.Session] = None):
+        """
+        :param session: Keeps the connections alive between requests, by default
+            every request opens its own
+        """
+        self.session = session
+
+    def get(self, url: str) -> Response:
+        if self.session is not None:
+            return self.session.get(url, timeout=REQUEST_TIMEOUT)
+        return requests.get(url, timeout=REQUEST_TIMEOUT)
+
+    def prefetch(self, urls: List[str]):
+        """
+        Hint that the urls are about to be requested, unused by blocking transports
+        """
+
+
 class GibsAPI:
-    def __init__(self):
+    def __init__(
+        self,
+        metrics: Metrics = None,
+        tile_cache: TileCache = None,
+        crs: str = EPSG_3857,
+        tile_bundle=None,
+        transport=None,
+    ):
+        """
+        :param crs: EPSG:3857 for the Web Mercator, EPSG:4326 for the geographic tile
+            matrix sets of GIBS
+        :param tile_bundle: `TileBundle` serving the catalog, tiles and quicklooks
+            instead of GIBS, without any requests
+        :param transport: Sends the requests, `HttpTransport` by default
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tile_cache = tile_cache
+        self.tile_bundle = tile_bundle
+        self.transport = transport if transport is not None else HttpTransport()
+        self.crs = crs
         self.wmts_url = "https://gibs.earthdata.nasa.gov/wmts"
-        self.get_capabilities_url = "/epsg3857/best/1.0.0/WMTSCapabilities.xml"
+        self.get_capabilities_url = "/{epsg}/best/1.0.0/WMTSCapabilities.xml"
         self.wmts_endpoint = (
-            "/epsg3857/best/{layer}/default"
-            + "/{date}/GoogleMapsCompatible_Level9/{zoom}/{y}/{x}.{img_format}"
+            "/{epsg}/best/{layer}/default"
+            + "/{date}/{tile_matrix_set}/{zoom}/{y}/{x}.{img_format}"
         )
         self.wms_url = "https://gibs.earthdata.nasa.gov/wms"
         self.wms_endpoint = "/epsg4326/best/wms.cgi?" + "SERVICE=WMS&REQUEST=GetMap&"
         self.quicklook_size = 512, 512
+        # Keyed by crs, may be shared between instances
+        self.catalogs: Dict[str, LayerCatalog] = {}
+
+    @property
+    def epsg(self) -> str:
+        """
+        Path segment of the GIBS endpoint of the crs, e.g. epsg3857
+        """
+        return self.crs.replace(":", "").lower()
+
+    @property
+    def capabilities_url(self) -> str:
+        return self.wmts_url + self.get_capabilities_url.format(epsg=self.epsg)
 
     def get_capabilities(self) -> Response:
         """
         Get capabilities from WMTS service
         """
-        url = self.wmts_url + self.get_capabilities_url
-        response = requests.request("GET", url)
+        url = self.capabilities_url
+        if self.tile_bundle is not None:
+            content = self.tile_bundle.get_capabilities(self.crs)
+            if content is None:
+                raise UP42Error(
+                    SupportedErrors.API_CONNECTION_ERROR,
+                    f"The tile bundle has no {self.crs} capabilities.",
+                )
+            return cached_response(content, url)
+        if self.tile_cache is not None:
+            content = self.tile_cache.get_capabilities(self.crs)
+            self.metrics.record_cache("capabilities", content is not None)
+            if content is not None:
+                return cached_response(content, url)
+
+        response = self.transport.get(url)
+        if self.tile_cache is not None and response.status_code == 200:
+            self.tile_cache.put_capabilities(response.content, self.crs)
         return response
 
+    @property
+    def catalog(self) -> LayerCatalog:
+        """
+        Catalog of the crs, downloaded on first use and refreshed once it is as old as
+        the capabilities a tile cache keeps
+        """
+        catalog = self.catalogs.get(self.crs)
+        if catalog is None or time.time() - catalog.loaded > (
+            DEFAULT_CAPABILITIES_MAX_AGE
+        ):
+            response = self.get_capabilities()
+            catalog = LayerCatalog(response.content, self.crs)
+            if response.status_code == 200:
+                self.catalogs[self.crs] = catalog
+        return catalog
+
     def get_dict_available_imagery_layers(self) -> dict:
         """
         Get a dictionary of all suitable imagery_layers (with TileMatrixSet ==
-        GoogleMapsCompatible_Level9) and output a dict with relevant attributes:
+        GoogleMapsCompatible_Level9, or a known geographic TileMatrixSet in EPSG:4326)
+        and output a dict with relevant attributes:
         Identifier, TileMatrixSet, WGS84BoundingBox and Format
         """
-        capabilities = xmltodict.parse(self.get_capabilities().text)
-        imagery_layers = {}
-        for layer in capabilities["Capabilities"]["Contents"]["Layer"]:
-            extent_lc = layer["ows:WGS84BoundingBox"]["ows:LowerCorner"]
-            extent_uc = layer["ows:WGS84BoundingBox"]["ows:UpperCorner"]
-            coords = [float(i) for i in extent_lc.split(" ") + extent_uc.split(" ")]
-            extent_bbox = box(*coords)
-            candidate = {
-                "Identifier": layer["ows:Identifier"],
-                "TileMatrixSet": layer["TileMatrixSetLink"]["TileMatrixSet"],
-                "WGS84BoundingBox": extent_bbox,
-                "Format": layer["Format"].split("/")[1],
-            }
-            if candidate["TileMatrixSet"] == "GoogleMapsCompatible_Level9":
-                imagery_layers[candidate["Identifier"]] = candidate
-        return imagery_layers
+        return self.catalog.layers()
 
     def validate_imagery_layers(
         self, imagery_layers: collections.OrderedDict, bbox: List[float]
@@ -159,7 +403,7 @@ class GibsAPI:
         GoogleMapsCompatible_Level9) and output a dict with relevant attributes:
         Identifier, TileMatrixSet, WGS84BoundingBox and Format
         """
-        available_imagery_layers = self.get_dict_available_imagery_layers()
+        catalog = self.catalog
         search_geom = box(*bbox)
 
         is_name = True
@@ -171,24 +415,18 @@ class GibsAPI:
         valid_imagery_layers: collections.OrderedDict = collections.OrderedDict()
 
         for each_layer in imagery_layers:
-            is_name = each_layer in available_imagery_layers.keys() and is_name
-            if is_name:
-                has_intersection = (
-                    available_imagery_layers[each_layer]["WGS84BoundingBox"].intersects(
-                        search_geom
-                    )
-                    and has_intersection
-                )
-                if not has_intersection:
-                    invalid_geom += [
-                        available_imagery_layers[each_layer]["WGS84BoundingBox"].wkt
-                    ]
-                else:
-                    valid_imagery_layers[each_layer] = available_imagery_layers[
-                        each_layer
-                    ]
-            else:
+            entry = catalog.get(each_layer)
+            if entry is None:
+                is_name = False
                 invalid_names += [each_layer]
+                continue
+            has_intersection = (
+                entry["WGS84BoundingBox"].intersects(search_geom) and has_intersection
+            )
+            if not has_intersection:
+                invalid_geom += [entry["WGS84BoundingBox"].wkt]
+            else:
+                valid_imagery_layers[each_layer] = entry
 
         return (
             (is_name and has_intersection),
@@ -196,12 +434,10 @@ class GibsAPI:
             valid_imagery_layers,
         )
 
-    def download_quicklook(self, layer: str, bbox, date: str) -> Response:
+    def quicklook_url(self, layer: str, bbox, date: str) -> str:
         """
-        Fetches an RGB quicklook image using WMS
+        WMS request of an RGB quicklook image of the bbox, at most quicklook_size
         """
-        logger.debug(f"Will now fetch quicklook {bbox} for date {date}")
-
         width_height_ratio = abs((bbox[0] - bbox[2]) / (bbox[1] - bbox[3]))
         if width_height_ratio > 1:
             width = self.quicklook_size[0]
@@ -227,35 +463,67 @@ class GibsAPI:
             + "BBOX={BBOX}&"
             + "TIME={TIME}"
         ).format(**params)
+        return self.wms_url + self.wms_endpoint + quicklook_string
 
-        logger.debug(quicklook_string)
+    def download_quicklook(self, layer: str, bbox, date: str) -> Response:
+        """
+        Fetches an RGB quicklook image using WMS
+        """
+        logger.debug(f"Will now fetch quicklook {bbox} for date {date}")
+        url = self.quicklook_url(layer, bbox, date)
+        logger.debug(url)
+
+        if self.tile_bundle is not None:
+            content = self.tile_bundle.get_quicklook(layer, date, bbox)
+            if content is None:
+                raise requests.exceptions.HTTPError(
+                    f"Quicklook of {layer} on {date} is not in the tile bundle"
+                )
+            return cached_response(content, url)
 
-        response = requests.get(self.wms_url + self.wms_endpoint + quicklook_string)
+        response = self.transport.get(url)
 
         if response.status_code != 200:
+            self.metrics.record_failure(("quicklook", layer, date))
             raise requests.exceptions.HTTPError(
                 """Quicklook download unsuccessful
                                     with status code """,
                 response.status_code,
             )
+        self.metrics.record_request(
+            ("quicklook", layer, date), len(response.content), tile=False
+        )
         return response
 
-    def write_quicklook(self, layer: str, bbox, date: str, output_uuid: str):
+    def write_quicklook(
+        self,
+        layer: str,
+        bbox,
+        date: str,
+        output_uuid: str,
+        quicklook_dir: str = "/tmp/quicklooks",
+    ):
         """
         Write quicklook to the quicklook output location
         """
         response = self.download_quicklook(layer, bbox, date)
-        name = "/tmp/quicklooks/%s.jpg" % (output_uuid)
+        name = "%s/%s.jpg" % (quicklook_dir, output_uuid)
         with open(name, "wb") as ql_file:
-            for chunk in response.iter_content():
+            for chunk in response.iter_content(chunk_size=QUICKLOOK_CHUNK_SIZE):
                 if chunk:
                     ql_file.write(chunk)
 
-    # Number of variables required to fetch the tiles
-    def requests_wmts_tile(
-        self, tile: mercantile.Tile, layer: str, date: str, img_format: str = "jpg"
-    ) -> requests.Response:
-        tile_url = self.wmts_url + self.wmts_endpoint.format(
+    def wmts_tile_url(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str = "jpg",
+        tile_matrix_set: str = WEB_MERCATOR_TILE_MATRIX_SET,
+    ) -> str:
+        return self.wmts_url + self.wmts_endpoint.format(
+            epsg=self.epsg,
+            tile_matrix_set=tile_matrix_set,
             layer=layer,
             date=date,
             x=tile.x,
@@ -264,21 +532,83 @@ class GibsAPI:
             img_format=img_format,
         )
 
+    def prefetch_tiles(
+        self,
+        tile_list: List[mercantile.Tile],
+        layer: str,
+        date: str,
+        img_format: str = "jpg",
+        tile_matrix_set: str = WEB_MERCATOR_TILE_MATRIX_SET,
+    ):
+        """
+        Announces the tiles of a layer to the transport, so that a concurrent transport
+        can request them all at once. Tiles served by the bundle or cache are left out.
+        """
+        if self.tile_bundle is not None:
+            return
+        if self.tile_cache is not None:
+            tile_list = [
+                tile
+                for tile in tile_list
+                if not self.tile_cache.has_tile(tile, layer, date, img_format, self.crs)
+            ]
+        self.transport.prefetch(
+            [
+                self.wmts_tile_url(tile, layer, date, img_format, tile_matrix_set)
+                for tile in tile_list
+            ]
+        )
+
+    # Number of variables required to fetch the tiles
+    def requests_wmts_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str = "jpg",
+        tile_matrix_set: str = WEB_MERCATOR_TILE_MATRIX_SET,
+    ) -> requests.Response:
+        tile_url = self.wmts_tile_url(tile, layer, date, img_format, tile_matrix_set)
+
         logger.debug(tile_url)
 
+        if self.tile_bundle is not None:
+            content = self.tile_bundle.get_tile(tile, layer, date, img_format, self.crs)
+            self.metrics.record_cache("bundle", content is not None)
+            if content is None:
+                raise UP42Error(
+                    SupportedErrors.API_CONNECTION_ERROR,
+                    f"{tile} of {layer} on {date} is not in the tile bundle.",
+                )
+            return cached_response(content, tile_url)
+        if self.tile_cache is not None:
+            content = self.tile_cache.get_tile(tile, layer, date, img_format, self.crs)
+            self.metrics.record_cache("tiles", content is not None)
+            if content is not None:
+                return cached_response(content, tile_url)
+
+        request_key = (layer, date, tile)
         try:
-            wmts_response = requests.get(tile_url)
+            with self.metrics.stage("download"):
+                wmts_response = self.transport.get(tile_url)
             logger.info(f"response returned: {wmts_response.status_code}")
             wmts_response.raise_for_status()
         except requests.exceptions.ConnectionError as conn_err:
             logger.error("Network related error occured")
+            self.metrics.record_failure(request_key)
             raise UP42Error(
                 SupportedErrors.API_CONNECTION_ERROR, str(conn_err)
             ) from conn_err
         except requests.exceptions.HTTPError as err:
             logger.error("HTTP error occured")
+            self.metrics.record_failure(request_key)
             raise UP42Error(SupportedErrors.API_CONNECTION_ERROR, str(err)) from err
 
+        self.metrics.record_request(request_key, len(wmts_response.content))
+        if self.tile_cache is not None:
+            self.tile_cache.put_tile(
+                tile, layer, date, img_format, wmts_response.content, self.crs
+            )
         return wmts_response
 
     @staticmethod
@@ -290,6 +620,9 @@ class GibsAPI:
             # The COG conversion assumes last band is an alpha band therefore It's necessary to define the ColorInterp
             # property
             color_interp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+            if img_bands_count < 3:
+                # Band subsets without an RGB triplet
+                color_interp = [ColorInterp.gray] + [ColorInterp.undefined] * 2
             if img_bands_count > 3:
                 for _ in range(img_bands_count - 3):
                     color_interp.append(ColorInterp.undefined)
@@ -299,9 +632,24 @@ class GibsAPI:
     def get_layer_bands_count(self, tile_list, imagery_layers, date):
         for layer in imagery_layers:
             wmts_response = self.requests_wmts_tile(
-                tile_list[0], layer, date, imagery_layers[layer]["Format"]
+                tile_list[0],
+                layer,
+                date,
+                imagery_layers[layer]["Format"],
+                imagery_layers[layer].get(
+                    "TileMatrixSet", WEB_MERCATOR_TILE_MATRIX_SET
+                ),
             )
             img: rio.MemoryFile = BytesIO(wmts_response.content)
 
-            with rio.open(img) as image:
-                imagery_layers[layer]["bands_count"] = image.count
+            with self.metrics.stage("decode"), rio.open(img) as image:
+                count = image.count
+            bands = imagery_layers[layer].get("bands")
+            if bands is not None and max(bands) > count:
+                raise UP42Error(
+                    SupportedErrors.INPUT_PARAMETERS_ERROR,
+                    f"Invalid bands {bands} of {layer}, the layer has {count} bands.",
+                )
+            imagery_layers[layer]["bands_count"] = (
+                len(bands) if bands is not None else count
+            )
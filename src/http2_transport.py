@@ -0,0 +1,154 @@
+"""
+HTTP/2 transport of `GibsAPI`, multiplexing the tile requests of a layer over a few
+connections.
+
+With the environment variable `MODIS_HTTP2` set, `Modis` sends its requests through an
+`Http2Transport` (httpx with h2, optional dependencies) instead of one blocking request
+per tile. The tiles announced by `GibsAPI.prefetch_tiles` are then all requested at once
+as concurrent streams of at most `max_connections` connections. Values:
+
+- `1` / `true`: HTTP/2 negotiated with the server (ALPN, https only), HTTP/1.1 otherwise
+- `prior_knowledge`: HTTP/2 without negotiation, also over plain http (h2c)
+
+If the server turns out not to speak HTTP/2, the transport falls back to HTTP/1.1 over
+the same connection pool. If httpx or h2 are not installed, `Modis` keeps the default
+blocking transport.
+"""
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from blockutils.logging import get_logger
+
+from tile_cache import cached_response
+
+logger = get_logger(__name__)
+
+HTTP2_ENV_VAR = "MODIS_HTTP2"
+PRIOR_KNOWLEDGE = "prior_knowledge"
+DEFAULT_MAX_CONNECTIONS = 4
+# Concurrent streams of all connections
+DEFAULT_MAX_CONCURRENCY = 32
+TIMEOUT = 60.0
+
+
+class Http2Transport:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        prior_knowledge: bool = False,
+        http2: bool = True,
+    ):
+        """
+        :param max_connections: Connections kept open to the server
+        :param max_concurrency: Requests in flight at once when prefetching
+        :param prior_knowledge: Speaks HTTP/2 without negotiating it first
+        :param http2: False gives the same transport over HTTP/1.1, for comparison
+        """
+        # pylint: disable=import-outside-toplevel
+        import httpx
+
+        self._httpx = httpx
+        self.max_connections = max_connections
+        self.prior_knowledge = prior_knowledge
+        self.http2 = http2
+        # Whether the server answered over HTTP/2
+        self.negotiated = False
+        self._client = self._new_client()
+        self._lock = threading.Lock()
+        # Requests started by `prefetch` and not yet taken by `get`
+        self._prefetched: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="http2"
+        )
+
+    @classmethod
+    def from_env(cls) -> Optional["Http2Transport"]:
+        """
+        Transport configured by environment, None if not configured or if the HTTP/2
+        dependencies are missing
+        """
+        value = os.environ.get(HTTP2_ENV_VAR, "").strip().lower()
+        if value in ("", "0", "false", "no"):
+            return None
+        try:
+            return cls(prior_knowledge=value == PRIOR_KNOWLEDGE)
+        except ImportError as err:
+            logger.warning(
+                f"{HTTP2_ENV_VAR} is set but HTTP/2 is not available ({err}), "
+                f"using HTTP/1.1"
+            )
+            return None
+
+    def _new_client(self):
+        return self._httpx.Client(
+            http1=not (self.http2 and self.prior_knowledge),
+            http2=self.http2,
+            limits=self._httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=TIMEOUT,
+        )
+
+    def _fall_back(self, client):
+        """
+        Replaces the HTTP/2 client by an HTTP/1.1 client, once for all threads
+        """
+        with self._lock:
+            if self._client is client:
+                logger.warning("The server does not speak HTTP/2, using HTTP/1.1")
+                self.http2 = False
+                self._client = self._new_client()
+                client.close()
+
+    def _request(self, url: str) -> requests.Response:
+        client = self._client
+        try:
+            try:
+                response = client.get(url)
+            except self._httpx.RemoteProtocolError:
+                # Without negotiation, a server not speaking HTTP/2 fails the first
+                # requests. Later failures are those of the connection.
+                if not self.prior_knowledge or self.negotiated:
+                    raise
+                self._fall_back(client)
+                response = self._client.get(url)
+        except self._httpx.TransportError as err:
+            raise requests.exceptions.ConnectionError(str(err)) from err
+        if response.http_version == "HTTP/2":
+            self.negotiated = True
+        result = cached_response(response.content, url)
+        result.status_code = response.status_code
+        result.reason = response.reason_phrase
+        return result
+
+    def get(self, url: str) -> requests.Response:
+        with self._lock:
+            request = self._prefetched.pop(url, None)
+        if request is None:
+            return self._request(url)
+        return request.result()
+
+    def prefetch(self, urls: List[str]):
+        """
+        Starts all requests at once, `get` then takes over the running requests
+        """
+        with self._lock:
+            for url in urls:
+                if url not in self._prefetched:
+                    self._prefetched[url] = self._executor.submit(self._request, url)
+
+    def close(self):
+        with self._lock:
+            requests_left = list(self._prefetched.values())
+            self._prefetched.clear()
+        for request in requests_left:
+            request.cancel()
+        self._executor.shutdown(wait=True)
+        self._client.close()
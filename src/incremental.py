@@ -0,0 +1,151 @@
+"""
+Incremental mode for recurring queries with a sliding time window.
+
+The outputs of every date are kept in a manifest keyed by (geometry, imagery layers,
+zoom level) in the state directory (`MODIS_STATE_DIR`, which should be persistent
+between jobs). A later job with the same key only fetches the dates missing from the
+manifest; the prior outputs of all other dates are linked into the output directory.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from geojson import Feature
+
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from compression import DEFAULT_COMPRESSION_PROFILE
+from tile_cache import write_atomic
+
+logger = get_logger(__name__)
+
+STATE_DIR_ENV_VAR = "MODIS_STATE_DIR"
+DEFAULT_STATE_DIR = Path("/tmp/state")
+MANIFEST_FILENAME = "manifest.json"
+
+
+def incremental_key(query: STACQuery) -> str:
+    """
+    Hash of the query parameters that identify a recurring query
+    """
+    content = {
+        "geometry": query.geometry(),
+        "imagery_layers": query.get_param_if_exists("imagery_layers"),
+        "zoom_level": query.get_param_if_exists("zoom_level"),
+    }
+    # Pass-through outputs are JPEG compressed, keep them apart from the others
+    if query.get_param_if_exists("jpeg_passthrough"):
+        content["jpeg_passthrough"] = True
+    # Overviews built from native zoom levels differ from the resampled ones
+    if query.get_param_if_exists("native_overviews"):
+        content["native_overviews"] = True
+    if query.get_param_if_exists("bands"):
+        content["bands"] = query.get_param_if_exists("bands")
+    if query.get_param_if_exists("crs") not in (None, "EPSG:3857"):
+        content["crs"] = query.get_param_if_exists("crs")
+    compression_profile = (
+        query.get_param_if_exists("compression_profile") or DEFAULT_COMPRESSION_PROFILE
+    )
+    if compression_profile != DEFAULT_COMPRESSION_PROFILE:
+        content["compression_profile"] = compression_profile
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path):
+    """
+    Hard links src to dst, falls back to copying across file systems
+    """
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class IncrementalManifest:
+    def __init__(self, state_dir: Path, key: str):
+        """
+        :param state_dir: Root directory of the persistent state
+        :param key: Key of the recurring query, see `incremental_key`
+        """
+        self.manifest_dir = Path(state_dir) / "incremental" / key
+        self.dates: Dict[str, dict] = {}
+        try:
+            with open(self.manifest_path, encoding="utf-8") as src:
+                self.dates = json.load(src)["dates"]
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    @classmethod
+    def from_env(cls, key: str) -> "IncrementalManifest":
+        state_dir = os.environ.get(STATE_DIR_ENV_VAR, str(DEFAULT_STATE_DIR))
+        return cls(Path(state_dir), key)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.manifest_dir / MANIFEST_FILENAME
+
+    def _save(self):
+        write_atomic(self.manifest_path, json.dumps({"dates": self.dates}).encode())
+
+    def restore(
+        self, query_date: str, output_dir: Path, quicklook_dir: Path
+    ) -> Optional[Feature]:
+        """
+        Links the prior outputs of a date into the output directories and returns
+        its feature, None if the date was not produced before
+        """
+        entry = self.dates.get(query_date)
+        if entry is None:
+            return None
+        feature = Feature(**entry)
+        data_file = self.manifest_dir / f"{query_date}.tif"
+        if not data_file.is_file():
+            return None
+
+        link_or_copy(data_file, Path(output_dir) / f"{feature['id']}.tif")
+        quicklook_file = self.manifest_dir / f"{query_date}.jpg"
+        if quicklook_file.is_file():
+            link_or_copy(quicklook_file, Path(quicklook_dir) / f"{feature['id']}.jpg")
+        return feature
+
+    def add(
+        self, query_date: str, feature: Feature, output_dir: Path, quicklook_dir: Path
+    ):
+        """
+        Keeps the outputs of a newly fetched date for later jobs
+        """
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        link_or_copy(
+            Path(output_dir) / f"{feature['id']}.tif",
+            self.manifest_dir / f"{query_date}.tif",
+        )
+        quicklook_file = Path(quicklook_dir) / f"{feature['id']}.jpg"
+        if quicklook_file.is_file():
+            link_or_copy(quicklook_file, self.manifest_dir / f"{query_date}.jpg")
+        # Metrics describe the job that fetched the date, not the later jobs reusing it
+        properties = {
+            key: value
+            for key, value in feature["properties"].items()
+            if key != "metrics"
+        }
+        self.dates[query_date] = {**feature, "properties": properties}
+        self._save()
+
+    def prune(self, keep_dates: Iterable[str]):
+        """
+        Removes all dates that dropped out of the time window
+        """
+        keep_dates = set(keep_dates)
+        for query_date in sorted(set(self.dates) - keep_dates):
+            logger.info(f"Removing {query_date} from incremental manifest")
+            del self.dates[query_date]
+            for suffix in ("tif", "jpg"):
+                (self.manifest_dir / f"{query_date}.{suffix}").unlink(missing_ok=True)
+        self._save()
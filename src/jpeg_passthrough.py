@@ -0,0 +1,230 @@
+"""
+Fast path for single JPEG layer requests.
+
+The JPEG payloads of the fetched tiles are copied unchanged into the tiles of a
+JPEG-compressed Cloud Optimized GeoTIFF, as the GIBS tile grid matches the 256px
+tiling of the output. Only the overviews are decoded (at half resolution via the
+JPEG DCT scaling) and encoded, the full resolution image is neither decoded nor
+re-encoded.
+"""
+
+import io
+import struct
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import mercantile
+import numpy as np
+from mercantile import Tile
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+
+from cogwriter import CogWriter
+
+logger = get_logger(__name__)
+
+JPEG_FORMATS = ("jpeg", "jpg")
+TILE_SIZE = 256
+OVERVIEW_QUALITY = 90
+
+# Baseline and extended sequential DCT, the JPEG processes supported in TIFF
+_SOF_MARKERS = (0xC0, 0xC1)
+# YCbCr subsampling to the Pillow subsampling option
+_PIL_SUBSAMPLING = {(1, 1): 0, (2, 1): 1, (2, 2): 2}
+
+
+def is_passthrough_eligible(valid_imagery_layers: dict) -> bool:
+    """
+    Whether the request is a single JPEG layer request with all bands
+    """
+    return len(valid_imagery_layers) == 1 and all(
+        layer["Format"].lower() in JPEG_FORMATS and not layer.get("bands")
+        for layer in valid_imagery_layers.values()
+    )
+
+
+def jpeg_subsampling(payload: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Chroma subsampling of a sequential 3 component JPEG, None for all other images
+    """
+    if payload[:2] != b"\xff\xd8":
+        return None
+    position = 2
+    while position + 4 <= len(payload):
+        if payload[position] != 0xFF:
+            return None
+        marker = payload[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        (length,) = struct.unpack(">H", payload[position + 2 : position + 4])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if marker not in _SOF_MARKERS or payload[position + 9] != 3:
+                return None
+            sampling = payload[position + 11]
+            subsampling = (sampling >> 4, sampling & 0x0F)
+            return subsampling if subsampling in _PIL_SUBSAMPLING else None
+        if marker == 0xDA:
+            return None
+        position += 2 + length
+    return None
+
+
+def decode_half_resolution(payload: bytes) -> np.ndarray:
+    """
+    RGB array of a tile at half resolution, using the JPEG DCT scaling
+    """
+    # Pillow is only needed on this path, not at start up
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    with Image.open(io.BytesIO(payload)) as img:
+        img.draft("RGB", (TILE_SIZE // 2, TILE_SIZE // 2))
+        rgb = img.convert("RGB")
+        if rgb.size != (TILE_SIZE // 2, TILE_SIZE // 2):
+            rgb = rgb.resize(
+                (TILE_SIZE // 2, TILE_SIZE // 2), Image.Resampling.BILINEAR
+            )
+        return np.asarray(rgb)
+
+
+def downsample(array: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Averages 2x2 pixel blocks of a (height, width, bands) array to size (width, height)
+    """
+    width, height = size
+    padded = np.pad(
+        array,
+        ((0, height * 2 - array.shape[0]), (0, width * 2 - array.shape[1]), (0, 0)),
+        mode="edge",
+    ).astype(np.uint16)
+    summed = (
+        padded[0::2, 0::2]
+        + padded[1::2, 0::2]
+        + padded[0::2, 1::2]
+        + padded[1::2, 1::2]
+    )
+    return ((summed + 2) // 4).astype(np.uint8)
+
+
+def encode_tile(array: np.ndarray, subsampling: Tuple[int, int]) -> Optional[bytes]:
+    """
+    Encodes a (height, width, 3) block padded to the tile size, None if it is empty
+    """
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    if not array.any():
+        return None
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+    tile[: array.shape[0], : array.shape[1]] = array
+    out = io.BytesIO()
+    Image.fromarray(tile).save(
+        out,
+        "JPEG",
+        quality=OVERVIEW_QUALITY,
+        subsampling=_PIL_SUBSAMPLING[subsampling],
+    )
+    return out.getvalue()
+
+
+def band_metadata(layer: str, samples: int = 3) -> str:
+    """
+    GDAL metadata with the layer and band provenance of every band
+    """
+    items = "".join(
+        f'<Item name="band" sample="{sample}">{sample + 1}</Item>'
+        f'<Item name="layer" sample="{sample}">{escape(layer)}</Item>'
+        for sample in range(samples)
+    )
+    return f"<GDALMetadata>{items}</GDALMetadata>"
+
+
+def write_jpeg_passthrough_cog(
+    img_filename,
+    tile_list: List[Tile],
+    payloads: Dict[Tile, bytes],
+    layer: str,
+) -> List[Tile]:
+    """
+    Writes the JPEG tile payloads of one layer as a JPEG-compressed COG covering the
+    bounding box of tile_list. Tiles without data are left empty.
+
+    :return: The tiles with data
+    """
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    min_x = min(tile.x for tile in tile_list)
+    min_y = min(tile.y for tile in tile_list)
+    cols = max(tile.x for tile in tile_list) - min_x + 1
+    rows = max(tile.y for tile in tile_list) - min_y + 1
+
+    subsamplings = {
+        tile: jpeg_subsampling(payload) for tile, payload in payloads.items()
+    }
+    known = [value for value in subsamplings.values() if value is not None]
+    subsampling = max(set(known), key=known.count) if known else (2, 2)
+
+    half = np.zeros((rows * TILE_SIZE // 2, cols * TILE_SIZE // 2, 3), dtype=np.uint8)
+    full_res: Dict[Tuple[int, int], bytes] = {}
+    for tile, payload in payloads.items():
+        try:
+            half_tile = decode_half_resolution(payload)
+        except OSError as err:
+            raise UP42Error(SupportedErrors.API_CONNECTION_ERROR, str(err)) from err
+        if not half_tile.any():
+            logger.info(f"{tile} is empty, Skipping ...")
+            continue
+        col, row = tile.x - min_x, tile.y - min_y
+        half[
+            row * TILE_SIZE // 2 : (row + 1) * TILE_SIZE // 2,
+            col * TILE_SIZE // 2 : (col + 1) * TILE_SIZE // 2,
+        ] = half_tile
+        if subsamplings[tile] != subsampling:
+            # Progressive, grayscale or differently subsampled tiles can't be copied
+            with Image.open(io.BytesIO(payload)) as img:
+                encoded = encode_tile(np.asarray(img.convert("RGB")), subsampling)
+            if encoded is None:
+                raise UP42Error(
+                    SupportedErrors.API_CONNECTION_ERROR, f"{tile} is not a valid JPEG."
+                )
+            payload = encoded
+        full_res[(col, row)] = payload
+
+    if not full_res:
+        raise UP42Error(SupportedErrors.NO_INPUT_ERROR, "All tiles are empty.")
+
+    left, _, right, top = mercantile.xy_bounds(Tile(min_x, min_y, tile_list[0].z))
+    resolution = (right - left) / TILE_SIZE
+    with CogWriter(
+        img_filename,
+        cols * TILE_SIZE,
+        rows * TILE_SIZE,
+        samples=3,
+        tile_size=TILE_SIZE,
+        ycbcr_subsampling=subsampling,
+        geotransform=(left, top, resolution, resolution),
+        epsg=3857,
+        gdal_metadata=band_metadata(layer),
+    ) as writer:
+        levels = [half]
+        for size in writer.sizes[2:]:
+            levels.append(downsample(levels[-1], size))
+        for level in reversed(range(1, writer.level_count)):
+            array = levels[level - 1]
+            level_cols, level_rows = writer.tile_grids[level]
+            for row in range(level_rows):
+                for col in range(level_cols):
+                    overview_tile = encode_tile(
+                        array[
+                            row * TILE_SIZE : (row + 1) * TILE_SIZE,
+                            col * TILE_SIZE : (col + 1) * TILE_SIZE,
+                        ],
+                        subsampling,
+                    )
+                    # Empty overview tiles are left sparse
+                    if overview_tile is not None:
+                        writer.write_tile(level, col, row, overview_tile)
+        for (col, row), payload in sorted(full_res.items(), key=lambda i: i[0][::-1]):
+            writer.write_tile(0, col, row, payload)
+
+    return [tile for tile in tile_list if (tile.x - min_x, tile.y - min_y) in full_res]
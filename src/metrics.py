@@ -0,0 +1,172 @@
+"""
+Instrumentation for fetch jobs: wall time per stage, tile throughput, bytes transferred,
+cache hit ratios and retry counts.
+"""
+
+import copy
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Hashable, Optional, Set
+
+from blockutils.logging import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_FILENAME = "metrics.json"
+
+
+class Metrics:
+    """
+    Collects timings and counters for a single fetch job.
+
+    Stages may be nested (e.g. `download` inside `merge`); the time spent in a nested
+    stage is only accounted to the innermost stage, so the stage times add up to the
+    instrumented wall time. Stage stacks are tracked per thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._failed: Set[Hashable] = set()
+        self.started = time.perf_counter()
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.cache: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0}
+        )
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.stage_seconds[name] += seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager measuring the wall time spent in a stage
+        """
+        stack = self._stack()
+        now = time.perf_counter()
+        if stack:
+            parent = stack[-1]
+            self._add_time(parent[0], now - parent[1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, start = stack.pop()
+            self._add_time(name, now - start)
+            if stack:
+                stack[-1][1] = now
+
+    def record_stage(self, name: str, seconds: float):
+        """
+        Accounts time spent in a stage outside of this process, e.g. in a worker
+        """
+        self._add_time(name, seconds)
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def record_request(self, key: Hashable, nbytes: int, tile: bool = True):
+        """
+        Records a successful request. A request for a key that previously failed
+        is counted as a retry.
+        """
+        with self._lock:
+            if key in self._failed:
+                self._failed.discard(key)
+                self.counters["retries"] += 1
+            self.counters["requests"] += 1
+            self.counters["bytes"] += nbytes
+            if tile:
+                self.counters["tiles"] += 1
+
+    def record_failure(self, key: Hashable):
+        with self._lock:
+            if key in self._failed:
+                self.counters["retries"] += 1
+            self._failed.add(key)
+            self.counters["failed_requests"] += 1
+
+    def record_cache(self, name: str, hit: bool):
+        with self._lock:
+            self.cache[name]["hits" if hit else "misses"] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Copy of the current raw state, usable as `since` argument of `summary`
+        """
+        with self._lock:
+            return {
+                "time": time.perf_counter(),
+                "stage_seconds": dict(self.stage_seconds),
+                "counters": dict(self.counters),
+                "cache": copy.deepcopy(dict(self.cache)),
+            }
+
+    def summary(self, since: Optional[dict] = None) -> dict:
+        """
+        Summary of the collected metrics, either for the whole job or for the
+        interval since the given snapshot.
+        """
+        current = self.snapshot()
+        if since is None:
+            since = {
+                "time": self.started,
+                "stage_seconds": {},
+                "counters": {},
+                "cache": {},
+            }
+
+        wall_seconds = current["time"] - since["time"]
+        stages = {
+            name: round(seconds - since["stage_seconds"].get(name, 0.0), 4)
+            for name, seconds in current["stage_seconds"].items()
+        }
+        counters = {
+            name: value - since["counters"].get(name, 0)
+            for name, value in current["counters"].items()
+        }
+        cache_hit_ratio = {}
+        for name, stats in current["cache"].items():
+            previous = since["cache"].get(name, {"hits": 0, "misses": 0})
+            hits = stats["hits"] - previous["hits"]
+            lookups = hits + stats["misses"] - previous["misses"]
+            if lookups:
+                cache_hit_ratio[name] = round(hits / lookups, 4)
+
+        tiles = counters.get("tiles", 0)
+        return {
+            "wall_seconds": round(wall_seconds, 4),
+            "stages": {name: seconds for name, seconds in stages.items() if seconds},
+            "tiles": tiles,
+            "tiles_per_second": round(tiles / wall_seconds, 2) if wall_seconds else 0,
+            "bytes_transferred": counters.get("bytes", 0),
+            "requests": counters.get("requests", 0),
+            "failed_requests": counters.get("failed_requests", 0),
+            "retries": counters.get("retries", 0),
+            "cache_hit_ratio": cache_hit_ratio,
+        }
+
+    def write(self, output_dir: Path, **extra) -> Path:
+        """
+        Writes the job summary (and any extra entries) as JSON into output_dir
+        """
+        out_path = Path(output_dir) / METRICS_FILENAME
+        content = self.summary()
+        content.update(extra)
+        with open(out_path, "w", encoding="utf-8") as out:
+            json.dump(content, out, indent=2)
+        logger.info(f"Metrics written to {out_path}")
+        return out_path
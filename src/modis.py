@@ -1,29 +1,95 @@
 import uuid
-from typing import List
+from contextlib import ExitStack, contextmanager
+from dataclasses import replace
+from typing import Dict, Iterator, List, Optional, Tuple
 from pathlib import Path
 from collections import OrderedDict
 
-import mercantile
 from mercantile import Tile
 from mercantile import MercantileError
 import requests
 from geojson import Feature, FeatureCollection
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
 
 from blockutils.blocks import DataBlock
-from blockutils.exceptions import SupportedErrors, UP42Error
-from blockutils.geometry import filter_tiles_intersect_with_geometry, tiles_to_geom
+from blockutils.common import (
+    BlockModes,
+    ensure_data_directories_exist,
+    get_block_mode,
+    load_query,
+)
+from blockutils.exceptions import SupportedErrors, UP42Error, catch_exceptions
+from blockutils.geometry import check_validity, tiles_to_geom
 from blockutils.logging import get_logger
 from blockutils.stac import STACQuery
-from blockutils.wmts import MultiTileMergeHelper
 from blockutils.datapath import set_data_path
 
-from blockutils.raster import to_cog
-
-from gibs import GibsAPI, extract_query_dates
+from checkpoint import CheckpointJournal, query_key
+from chunking import (
+    TileChunk,
+    available_mb,
+    chunked_output_profile,
+    gdal_cache_env,
+    max_chunk_tiles,
+    plan_chunks,
+    write_chunk,
+)
+from composite import (
+    validate_composite,
+    write_composite,
+    write_composite_quicklook,
+)
+from compression import (
+    COMPRESSION_PROFILES,
+    DEFAULT_COMPRESSION_PROFILE,
+    CogWorkerPool,
+    CompressionProfile,
+    to_cog,
+    write_multiband_tif,
+)
+from data_coverage import (
+    DROPPED_PROPERTY,
+    TileCoverage,
+    is_dropped,
+    feature_coverage,
+    valid_fraction,
+)
+from fetch_options import FetchOptions, set_query_defaults
+import geographic
+from geographic import EPSG_4326
+from incremental import IncrementalManifest, incremental_key
+from gibs import (
+    GibsAPI,
+    extract_query_dates,
+    get_tile_grid,
+    get_tile_list,
+    make_list_layer_band,
+)
+from http2_transport import Http2Transport
+from jpeg_passthrough import write_jpeg_passthrough_cog
+from metrics import Metrics
+from mosaic import MOSAIC_POOL, open_tile, tile_window, valid_window
+from native_overviews import write_native_overviews
+from profiling import profile_job, profiling_enabled
+from progressive import (
+    PREVIEW_PROPERTY,
+    PREVIEW_SUFFIX,
+    latest_features,
+    remove_previews,
+    write_preview,
+)
+from streaming import FeatureCollectionWriter
+from tile_bundle import TileBundle
+from tile_cache import TileCache
+from zarr_store import ZarrTimeSeries
 
 logger = get_logger(__name__)
 DEFAULT_ZOOM_LEVEL = 9
 DEFAULT_IMAGERY_LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+OUTPUT_DIR = Path("/tmp/output")
+QUICKLOOK_DIR = Path("/tmp/quicklooks")
 
 
 class Modis(DataBlock):
@@ -31,109 +97,974 @@ class Modis(DataBlock):
         self,
         default_zoom_level: int = DEFAULT_ZOOM_LEVEL,
         default_imagery_layer: str = DEFAULT_IMAGERY_LAYER,
+        api: Optional[GibsAPI] = None,
+        output_dir: Path = OUTPUT_DIR,
+        quicklook_dir: Path = QUICKLOOK_DIR,
     ):
-        self.api = GibsAPI()
+        """
+        :param api: The `GibsAPI` of the block, e.g. sharing the warm state of a
+            `worker.Worker`; by default configured by environment
+        :param output_dir: Directory of the images, data.json, metrics and checkpoint
+        :param quicklook_dir: Directory of the quicklooks
+        """
+        if api is None:
+            api = GibsAPI(
+                tile_cache=TileCache.from_env(),
+                tile_bundle=TileBundle.from_env(),
+                transport=Http2Transport.from_env(),
+            )
+        self.api = api
+        self.output_dir = Path(output_dir)
+        self.quicklook_dir = Path(quicklook_dir)
+        self.buffer_pool = MOSAIC_POOL
         self.default_zoom_level = default_zoom_level
         self.default_imagery_layer = default_imagery_layer
 
+    @property
+    def metrics(self) -> Metrics:
+        return self.api.metrics
+
+    def tiles_to_geom(self, tile_list: List[Tile]):
+        """
+        Geometry covered by the tiles, in the tile grid of the crs of the job
+        """
+        if self.api.crs == EPSG_4326:
+            return tiles_to_geom(tile_list, func=geographic)
+        return tiles_to_geom(tile_list)
+
+    @property
+    def tile_size(self) -> int:
+        return geographic.TILE_SIZE if self.api.crs == EPSG_4326 else 256
+
+    def get_tile_grid(self, tile_list: List[Tile]):
+        """
+        Transform, width and height of the tile grid of tile_list in the crs of the job
+        """
+        if self.api.crs == EPSG_4326:
+            return geographic.get_tile_grid(tile_list)
+        return get_tile_grid(tile_list, self.tile_size)
+
+    def merge_layer(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        layer: str,
+        query_date: str,
+        coverage: TileCoverage,
+        layer_filename: Path,
+    ) -> List[Tile]:
+        """
+        Merges the tiles of a layer into layer_filename, which covers the bounding tile
+        range of the valid tiles. Each tile is decoded into its window of a pooled
+        mosaic of the tile grid (decode stage) and its valid pixel fraction is added
+        to coverage.
+
+        :return: The valid (non-empty) tiles
+        """
+        img_format = valid_imagery_layers[layer]["Format"]
+        tile_matrix_set = valid_imagery_layers[layer]["TileMatrixSet"]
+        # None reads all bands
+        bands = valid_imagery_layers[layer].get("bands")
+        self.api.prefetch_tiles(
+            tile_list, layer, query_date, img_format, tile_matrix_set
+        )
+        origin = min(tile.x for tile in tile_list), min(tile.y for tile in tile_list)
+        _, width, height = self.get_tile_grid(tile_list)
+        valid_tiles: List[Tile] = []
+        with ExitStack() as stack:
+            mosaic: Optional[np.ndarray] = None
+            for tile in tile_list:
+                response = self.api.requests_wmts_tile(
+                    tile, layer, query_date, img_format, tile_matrix_set
+                )
+                with self.metrics.stage("decode"):
+                    with open_tile(response.content) as image:
+                        if mosaic is None:
+                            mosaic = stack.enter_context(
+                                self.buffer_pool.array(
+                                    (len(bands or image.indexes), height, width),
+                                    image.dtypes[0],
+                                )
+                            )
+                        window = tile_window(mosaic, tile, origin, self.tile_size)
+                        image.read(indexes=bands, out=window)
+                    if not window.any():
+                        logger.info(f"{tile} is empty, Skipping ...")
+                        continue
+                    coverage.add(tile, valid_fraction(window))
+                valid_tiles.append(tile)
+
+            if mosaic is None or not valid_tiles:
+                raise UP42Error(SupportedErrors.NO_INPUT_ERROR, "All tiles are empty.")
+            transform, width, height = self.get_tile_grid(valid_tiles)
+            with rio.open(
+                layer_filename,
+                "w",
+                driver="GTiff",
+                width=width,
+                height=height,
+                count=mosaic.shape[0],
+                dtype=mosaic.dtype,
+                crs=self.api.crs,
+                transform=transform,
+            ) as dst:
+                valid = valid_window(mosaic, valid_tiles, origin, self.tile_size)
+                # By tile row, so only one row is copied into a contiguous array
+                for row in range(0, height, self.tile_size):
+                    dst.write(
+                        valid[:, row : row + self.tile_size],
+                        window=Window(0, row, width, self.tile_size),
+                    )
+        return valid_tiles
+
+    def _plan_chunks(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        memory_budget_mb: float,
+        compression_profile: CompressionProfile,
+    ) -> List[TileChunk]:
+        """
+        Chunks of the tile grid that can be merged within the memory budget
+        """
+        bands = max(
+            attributes.get("bands_count", 4)
+            for attributes in valid_imagery_layers.values()
+        )
+        available = available_mb(memory_budget_mb)
+        max_tiles = max_chunk_tiles(available, bands, self.tile_size)
+        chunks = plan_chunks(
+            tile_list,
+            max_tiles,
+            align=max(1, compression_profile.blocksize // self.tile_size),
+        )
+        logger.info(
+            f"{available:.0f} MB of the memory budget available, merging "
+            f"{len(tile_list)} tiles in {len(chunks)} chunks of up to {max_tiles} tiles"
+        )
+        return chunks
+
     def get_final_merged_image(
         self,
         tile_list: List[Tile],
         valid_imagery_layers: OrderedDict,
-        query_date: list,
+        query_date: str,
         feature_id: str,
-    ):
-        img_filename = Path("/tmp/output/%s.tif" % str(feature_id))
-        req_kwargs_list = []
-        for layer in valid_imagery_layers:
-            req_kwargs_list.append(
-                {
-                    "req_kwargs": {
-                        "layer": layer,
-                        "date": query_date,
-                        "img_format": valid_imagery_layers[layer]["Format"],
-                    },
-                    "crs": "EPSG:3857",
-                }
-            )
+        compression_profile: CompressionProfile = COMPRESSION_PROFILES[
+            DEFAULT_COMPRESSION_PROFILE
+        ],
+        chunks: Optional[List[TileChunk]] = None,
+    ) -> Tuple[Path, float]:
+        """
+        Merges the tiles of all layers into one image. With more than one chunk, the
+        chunks are merged one after another into an image covering the tile grid.
+
+        :return: The image and its valid data coverage
+        """
+        img_filename = self.output_dir / ("%s.tif" % str(feature_id))
+        coverages = [TileCoverage() for _ in valid_imagery_layers]
 
         logger.info("Fetching tiles")
-        valid_tiles = MultiTileMergeHelper.from_req_kwargs(
-            tile_list,
-            req=self.api.requests_wmts_tile,
-            kwargs_list=req_kwargs_list,
-        ).get_multiband_tif(img_filename, return_cog=False)
+        with self.metrics.stage("merge"):
+            if chunks is not None and len(chunks) > 1:
+                valid_count = self._write_chunked_image(
+                    img_filename,
+                    tile_list,
+                    valid_imagery_layers,
+                    query_date,
+                    coverages,
+                    compression_profile,
+                    chunks,
+                )
+            else:
+                layer_filenames = []
+                valid_tiles = []
+                try:
+                    for layer, coverage in zip(valid_imagery_layers, coverages):
+                        layer_filenames.append(self.output_dir / f"{uuid.uuid4()}.tif")
+                        valid_tiles.append(
+                            self.merge_layer(
+                                tile_list,
+                                valid_imagery_layers,
+                                layer,
+                                query_date,
+                                coverage,
+                                layer_filenames[-1],
+                            )
+                        )
+                    write_multiband_tif(
+                        layer_filenames, img_filename, compression_profile
+                    )
+                finally:
+                    for layer_filename in layer_filenames:
+                        layer_filename.unlink(missing_ok=True)
+                valid_count = len(valid_tiles[0])
 
+        coverage = feature_coverage(coverages, len(tile_list))
         logger.info(
-            f"There are {len(valid_tiles[0])} valid data tiles out of {len(tile_list)}"
+            f"There are {valid_count} valid data tiles out of {len(tile_list)}, "
+            f"coverage {coverage:.1%}"
         )
 
-        return img_filename
+        return img_filename, coverage
 
-    def fetch(self, query: STACQuery, dry_run: bool = False) -> FeatureCollection:
+    def _write_chunked_image(
+        self,
+        img_filename: Path,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        coverages: List[TileCoverage],
+        compression_profile: CompressionProfile,
+        chunks: List[TileChunk],
+    ) -> int:
+        """
+        Merges the layers chunk by chunk into an image covering the tile grid of
+        tile_list, so only one chunk is held in memory
 
-        query.set_param_if_not_exists("zoom_level", self.default_zoom_level)
-        query.set_param_if_not_exists("imagery_layers", [self.default_imagery_layer])
+        :return: The number of valid tiles of the first layer
+        """
+        transform, width, height = self.get_tile_grid(tile_list)
+        layer_bands = [
+            attributes["bands_count"] for attributes in valid_imagery_layers.values()
+        ]
+        profile = chunked_output_profile(
+            transform,
+            width,
+            height,
+            self.api.crs,
+            sum(layer_bands),
+            compression_profile,
+        )
+        valid_count = 0
+        with rio.open(img_filename, "w", **profile) as dst:
+            for chunk in chunks:
+                layer_filenames: List[Optional[Path]] = []
+                try:
+                    for index, (layer, coverage) in enumerate(
+                        zip(valid_imagery_layers, coverages)
+                    ):
+                        layer_filename = self.output_dir / f"{uuid.uuid4()}.tif"
+                        try:
+                            valid_tiles = self.merge_layer(
+                                chunk.tiles,
+                                valid_imagery_layers,
+                                layer,
+                                query_date,
+                                coverage,
+                                layer_filename,
+                            )
+                        except UP42Error as err:
+                            if err.error_code != SupportedErrors.NO_INPUT_ERROR:
+                                raise
+                            # No valid tile of this layer in the chunk
+                            layer_filenames.append(None)
+                            continue
+                        layer_filenames.append(layer_filename)
+                        if index == 0:
+                            valid_count += len(valid_tiles)
+                    write_chunk(
+                        dst, chunk, layer_filenames, layer_bands, self.tile_size
+                    )
+                finally:
+                    for merged_filename in layer_filenames:
+                        if merged_filename is not None:
+                            merged_filename.unlink(missing_ok=True)
+                self.metrics.increment("chunks")
+
+        if not all(coverage.fractions for coverage in coverages):
+            img_filename.unlink()
+            raise UP42Error(SupportedErrors.NO_INPUT_ERROR, "All tiles are empty.")
+        return valid_count
+
+    def get_jpeg_passthrough_image(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        feature_id: str,
+    ) -> Tuple[Path, float]:
+        """
+        Writes the COG of a single JPEG layer from the unchanged tile payloads
+
+        :return: The image and its coverage, by tile as the tiles are not decoded
+        """
+        img_filename = self.output_dir / f"{feature_id}.tif"
+        layer = next(iter(valid_imagery_layers))
+        img_format = valid_imagery_layers[layer]["Format"]
+
+        logger.info("Fetching tiles")
+        with self.metrics.stage("merge"):
+            self.api.prefetch_tiles(tile_list, layer, query_date, img_format)
+            payloads = {
+                tile: self.api.requests_wmts_tile(
+                    tile, layer, query_date, img_format
+                ).content
+                for tile in tile_list
+            }
+            valid_tiles = write_jpeg_passthrough_cog(
+                img_filename, tile_list, payloads, layer
+            )
+
+        logger.info(
+            f"There are {len(valid_tiles)} valid data tiles out of {len(tile_list)}"
+        )
+
+        return img_filename, len(valid_tiles) / len(tile_list)
 
-        # Get the list of tiles that cover the query AOI. Sorted by (y, x) in ascending order
+    def _get_native_overviews(
+        self,
+        img_filename: Path,
+        zoom_level: int,
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        compression_profile: CompressionProfile,
+    ) -> Optional[List[Path]]:
+        """
+        Overview levels of the image from the lower GIBS zoom levels, None if they
+        could not be fetched (the overviews are then resampled from the image)
+        """
         try:
-            tile_list = list(
-                filter_tiles_intersect_with_geometry(
-                    tiles=mercantile.tiles(
-                        *query.bounds(), zooms=query.zoom_level, truncate=True
-                    ),
-                    geometry=query.geometry(),
+            with self.metrics.stage("overviews"):
+                return write_native_overviews(
+                    img_filename,
+                    self.api,
+                    valid_imagery_layers,
+                    query_date,
+                    zoom_level,
+                    blocksize=compression_profile.blocksize,
+                )
+        except UP42Error as err:
+            logger.warning(f"Native overviews unavailable, resampling instead: {err}")
+            for overview in Path(img_filename).parent.glob(
+                f"{Path(img_filename).stem}.ovr*.tif"
+            ):
+                overview.unlink()
+            return None
+
+    def fetch_date(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        options: Optional[FetchOptions] = None,
+        feature_id: Optional[str] = None,
+    ) -> Feature:
+        """
+        Fetches the output feature (quicklook and, if not dry run, image) of a single
+        date, see `FetchOptions`. AOIs whose mosaic does not fit the memory budget are
+        merged in chunks, without native overviews. With a feature_id, e.g. the one of
+        the preview of the date, the feature keeps it.
+        """
+        options = options or FetchOptions()
+        self.api.get_layer_bands_count(tile_list, valid_imagery_layers, query_date)
+        feature = self.date_feature(
+            tile_list, valid_imagery_layers, query_date, feature_id
+        )
+        if options.dry_run:
+            return feature
+
+        date_id: str = feature["id"]
+        if options.jpeg_passthrough:
+            _, coverage = self.get_jpeg_passthrough_image(
+                tile_list, valid_imagery_layers, query_date, date_id
+            )
+            return self.finish_date(
+                feature, coverage, tile_list, valid_imagery_layers, query_date, options
+            )
+        chunks = None
+        if options.memory_budget_mb is not None:
+            chunks = self._plan_chunks(
+                tile_list,
+                valid_imagery_layers,
+                options.memory_budget_mb,
+                options.compression_profile,
+            )
+            if len(chunks) > 1 and options.native_overviews:
+                logger.info(
+                    "Native overviews are fetched as whole mosaics, disabled for "
+                    "chunked merging"
                 )
+                options = replace(options, native_overviews=False)
+        # Fetch tiles and patch them together
+        with gdal_cache_env(options.memory_budget_mb):
+            _, coverage = self.get_final_merged_image(
+                tile_list,
+                valid_imagery_layers,
+                query_date,
+                date_id,
+                options.compression_profile,
+                chunks,
             )
-        except MercantileError as mercerr:
-            raise UP42Error(SupportedErrors.INPUT_PARAMETERS_ERROR) from mercerr
+        return self.finish_date(
+            feature, coverage, tile_list, valid_imagery_layers, query_date, options
+        )
 
-        output_features: List[Feature] = []
+    def date_feature(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        feature_id: Optional[str] = None,
+    ) -> Feature:
+        """
+        Feature of a date covering the tiles, with its quicklook. With a feature_id the
+        feature keeps it, otherwise it gets a random one.
+        """
+        return_poly = self.tiles_to_geom(tile_list)
+        for layer in valid_imagery_layers:
+            date_id = feature_id or str(uuid.uuid4())
+            feature = Feature(id=date_id, bbox=return_poly.bounds, geometry=return_poly)
 
-        date_list = extract_query_dates(query)
+            try:
+                with self.metrics.stage("quicklook"):
+                    self.api.write_quicklook(
+                        layer,
+                        return_poly.bounds,
+                        query_date,
+                        date_id,
+                        quicklook_dir=self.quicklook_dir,
+                    )
+            except requests.exceptions.HTTPError:
+                continue
+        return feature
 
-        logger.debug(f"Checking layer {query.imagery_layers}")
-        are_valid, invalid, valid_imagery_layers = self.api.validate_imagery_layers(
-            query.imagery_layers, query.bounds()
+    def finish_date(
+        self,
+        feature: Feature,
+        coverage: float,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        options: Optional[FetchOptions] = None,
+    ) -> Feature:
+        """
+        Completes the feature of the merged image of a date (`<feature id>.tif` in the
+        output directory): drops the date below the minimum coverage, or appends the
+        image to the Zarr store, or converts it to a COG, see `fetch_date`
+        """
+        options = options or FetchOptions()
+        img_filename = self.output_dir / f"{feature['id']}.tif"
+        feature["properties"]["coverage"] = round(coverage, 4)
+        if options.min_coverage is not None and coverage < options.min_coverage:
+            logger.info(
+                f"Dropping {query_date}, coverage {coverage:.1%} is below "
+                f"{options.min_coverage:.1%}"
+            )
+            img_filename.unlink()
+            (self.quicklook_dir / f"{feature['id']}.jpg").unlink(missing_ok=True)
+            feature["properties"][DROPPED_PROPERTY] = True
+            return feature
+
+        if options.zarr_path is not None:
+            with self.metrics.stage("zarr"):
+                time_index = self._append_to_zarr(
+                    options.zarr_path,
+                    img_filename,
+                    tile_list,
+                    valid_imagery_layers,
+                    query_date,
+                )
+            img_filename.unlink()
+            feature["properties"]["time_index"] = time_index
+            set_data_path(feature, options.zarr_path.name)
+            return feature
+
+        if not options.jpeg_passthrough:
+            self._write_date_cog(
+                img_filename, tile_list, valid_imagery_layers, query_date, options
+            )
+        set_data_path(feature, img_filename.name)
+
+        return feature
+
+    def _write_date_cog(
+        self,
+        img_filename: Path,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        options: FetchOptions,
+    ):
+        """
+        Post processes the merged image of a date and converts it to a COG, or submits
+        the conversion to the COG pool of the job
+        """
+        with self.metrics.stage("post_process"):
+            self.api.post_process(img_filename, valid_imagery_layers)
+        overviews = None
+        if options.native_overviews:
+            overviews = self._get_native_overviews(
+                img_filename,
+                tile_list[0].z,
+                valid_imagery_layers,
+                query_date,
+                options.compression_profile,
+            )
+        blocksize = geographic.COG_BLOCKSIZE if self.api.crs == EPSG_4326 else None
+        if options.cog_pool is not None:
+            options.cog_pool.submit(
+                img_filename,
+                options.compression_profile,
+                overviews=overviews,
+                blocksize=blocksize,
+                forward_band_tags=True,
+            )
+            return
+        with self.metrics.stage("cog"), gdal_cache_env(options.memory_budget_mb):
+            to_cog(
+                img_filename,
+                options.compression_profile,
+                threads=options.cog_threads,
+                overviews=overviews,
+                blocksize=blocksize,
+                forward_band_tags=True,
+            )
+
+    def fetch_preview(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        options: Optional[FetchOptions] = None,
+    ) -> Optional[Feature]:
+        """
+        Preview feature of a date from a lower zoom level, see `progressive`. None if
+        there is no lower zoom level or its tiles could not be fetched.
+        """
+        options = options or FetchOptions()
+        if tile_list[0].z == 0:
+            return None
+        self.api.get_layer_bands_count(tile_list, valid_imagery_layers, query_date)
+        feature_id = str(uuid.uuid4())
+        return_poly = self.tiles_to_geom(tile_list)
+        feature = Feature(id=feature_id, bbox=return_poly.bounds, geometry=return_poly)
+        preview_filename = self.output_dir / f"{feature_id}{PREVIEW_SUFFIX}"
+        try:
+            with self.metrics.stage("preview"):
+                zoom = write_preview(
+                    preview_filename,
+                    self.api,
+                    valid_imagery_layers,
+                    query_date,
+                    tile_list,
+                    options.compression_profile,
+                    threads=options.cog_threads,
+                )
+        except UP42Error as err:
+            logger.warning(f"Preview of {query_date} unavailable: {err}")
+            preview_filename.unlink(missing_ok=True)
+            return None
+        feature["properties"].update(
+            {PREVIEW_PROPERTY: True, "preview_zoom_level": zoom}
         )
+        set_data_path(feature, preview_filename.name)
+        return feature
+
+    def _append_to_zarr(
+        self,
+        zarr_path: Path,
+        img_filename: Path,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+    ) -> int:
+        """
+        Appends the mosaic of a date to the Zarr store covering the tile grid of the
+        AOI, creating the store if needed
+
+        :return: The time index of the date in the store
+        """
+        transform, width, height = get_tile_grid(tile_list)
+        with rio.open(img_filename) as src:
+            bands = make_list_layer_band(valid_imagery_layers, src.count)
+        store = ZarrTimeSeries.create_or_open(
+            zarr_path, transform, width, height, "EPSG:3857", bands
+        )
+        return store.append(query_date, img_filename)
+
+    def fetch_composite(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        date_list: List[str],
+        rule: str,
+        options: Optional[FetchOptions] = None,
+    ) -> Feature:
+        """
+        Fetches a single feature compositing all dates with the given rule. A dry run
+        returns the same feature without image, with the quicklook of the latest date.
+        """
+        options = options or FetchOptions()
+        metrics = self.metrics
+        self.api.get_layer_bands_count(tile_list, valid_imagery_layers, date_list[-1])
+        feature_id = str(uuid.uuid4())
+        return_poly = self.tiles_to_geom(tile_list)
+        feature = Feature(id=feature_id, bbox=return_poly.bounds, geometry=return_poly)
+        feature["properties"].update(composite=rule, dates=sorted(date_list))
+        if options.dry_run:
+            for layer in valid_imagery_layers:
+                try:
+                    with metrics.stage("quicklook"):
+                        self.api.write_quicklook(
+                            layer,
+                            return_poly.bounds,
+                            max(date_list),
+                            feature_id,
+                            quicklook_dir=self.quicklook_dir,
+                        )
+                    break
+                except requests.exceptions.HTTPError:
+                    continue
+            return feature
+
+        img_filename = self.output_dir / f"{feature_id}.tif"
+
+        logger.info(f"Compositing {len(date_list)} dates ({rule})")
+        with metrics.stage("merge"):
+            coverage = write_composite(
+                img_filename,
+                self.api,
+                valid_imagery_layers,
+                date_list,
+                tile_list,
+                rule,
+            )
+        with metrics.stage("post_process"):
+            self.api.post_process(img_filename, valid_imagery_layers)
+        with metrics.stage("quicklook"):
+            write_composite_quicklook(
+                img_filename,
+                self.quicklook_dir / f"{feature_id}.jpg",
+                self.api.quicklook_size,
+            )
+        with metrics.stage("cog"):
+            to_cog(
+                img_filename,
+                options.compression_profile,
+                threads=options.cog_threads,
+                forward_band_tags=True,
+            )
+        set_data_path(feature, f"{feature_id}.tif")
+        feature["properties"]["coverage"] = round(coverage, 4)
+        return feature
+
+    def _ensure_quicklook(
+        self,
+        feature: Feature,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+    ):
+        """
+        Rewrites the quicklook of a feature completed in an earlier run if it got lost
+        """
+        if Path(self.quicklook_dir / f"{feature['id']}.jpg").is_file():
+            return
+        try:
+            with self.metrics.stage("quicklook"):
+                self.api.write_quicklook(
+                    list(valid_imagery_layers)[-1],
+                    self.tiles_to_geom(tile_list).bounds,
+                    query_date,
+                    feature["id"],
+                    quicklook_dir=self.quicklook_dir,
+                )
+        except requests.exceptions.HTTPError:
+            logger.warning(f"Quicklook of {feature['id']} could not be restored")
+
+    def get_tiles_and_layers(self, query: STACQuery) -> Tuple[List[Tile], OrderedDict]:
+        """
+        Tiles that cover the query AOI, sorted by (y, x) in ascending order, and the
+        catalog entries of the query's imagery layers
+        """
+        metrics = self.metrics
+        logger.debug(f"Checking layer {query.imagery_layers}")
+        with metrics.stage("catalog"):
+            (
+                are_valid,
+                invalid,
+                valid_imagery_layers,
+            ) = self.api.validate_imagery_layers(query.imagery_layers, query.bounds())
         if are_valid:
             logger.debug(f"Layers {query.imagery_layers} OK!")
+            for layer, bands in (query.get_param_if_exists("bands") or {}).items():
+                valid_imagery_layers[layer]["bands"] = bands
         else:
             raise UP42Error(
                 SupportedErrors.INPUT_PARAMETERS_ERROR,
                 f"Invalid Layers. {invalid} have invalid names."
                 f"{invalid} are layer bounds, search should be within this.",
             )
+        if query.crs == EPSG_4326:
+            # The geographic level depends on the tile matrix sets of the layers
+            with metrics.stage("tile_cover"):
+                tile_list = geographic.get_tile_list(
+                    query.bounds(),
+                    query.geometry(),
+                    geographic.tile_level(query.zoom_level, valid_imagery_layers),
+                )
+        else:
+            try:
+                with metrics.stage("tile_cover"):
+                    tile_list = get_tile_list(
+                        query.bounds(), query.geometry(), query.zoom_level
+                    )
+            except MercantileError as mercerr:
+                raise UP42Error(SupportedErrors.INPUT_PARAMETERS_ERROR) from mercerr
+        return tile_list, valid_imagery_layers
 
-        for query_date in date_list:
-            self.api.get_layer_bands_count(tile_list, valid_imagery_layers, query_date)
-            for layer in valid_imagery_layers:
-                feature_id: str = str(uuid.uuid4())
-                return_poly = tiles_to_geom(tile_list)
+    @classmethod
+    @catch_exceptions()
+    def run(cls, **kwargs):
+        """
+        Like `DataBlock.run`, but appends every feature to data.json as soon as it is
+        final
+        """
+        ensure_data_directories_exist()
+        query: STACQuery = load_query()
+        dry_run: bool = get_block_mode() == BlockModes.DRY_RUN.value
+        cls(**kwargs).run_query(query, dry_run)
 
-                feature = Feature(
-                    id=feature_id, bbox=return_poly.bounds, geometry=return_poly
-                )
+    def run_query(self, query: STACQuery, dry_run: bool = False):
+        """
+        Writes the outputs of a query and their data.json to the output directory, as
+        a block run does
+        """
+        if query.bbox or query.intersects or query.contains:
+            check_validity(query_geom=query.geometry())
+        with FeatureCollectionWriter(self.output_dir / "data.json") as writer:
+            writer.extend(self.fetch_iter(query=query, dry_run=dry_run))
 
-                try:
-                    self.api.write_quicklook(
-                        layer, return_poly.bounds, query_date, feature_id
+    def fetch(self, query: STACQuery, dry_run: bool = False) -> FeatureCollection:
+        return FeatureCollection(latest_features(self.fetch_iter(query, dry_run)))
+
+    def fetch_iter(self, query: STACQuery, dry_run: bool = False) -> Iterator[Feature]:
+        """
+        Yields the features of the query in date order, each as soon as its output is
+        final, while the later dates are still being fetched. In progressive mode, the
+        preview of a date is yielded first and its final feature (same id, dropped if
+        the date is dropped) later, see `progressive`.
+        """
+        with profile_job(self.output_dir, enabled=profiling_enabled(query)):
+            yield from self._fetch(query, dry_run)
+
+    async def fetch_async(
+        self, query: STACQuery, dry_run: bool = False, client=None
+    ) -> FeatureCollection:
+        """
+        Coroutine variant of `fetch` for async services, see `async_gibs`. Queries
+        sharing an `AsyncGibsClient` share its connection pool and catalog; without
+        a client the fetch uses its own. The outputs are written to a new directory
+        below the output directory, which output_dir then points to.
+        """
+        # pylint: disable=import-outside-toplevel
+        from async_gibs import AsyncGibsClient, fetch_iter_async
+
+        if client is None:
+            async with AsyncGibsClient() as own_client:
+                return await self.fetch_async(query, dry_run, own_client)
+        return FeatureCollection(
+            latest_features(
+                [
+                    feature
+                    async for feature in fetch_iter_async(self, query, client, dry_run)
+                ]
+            )
+        )
+
+    def _fetch(self, query: STACQuery, dry_run: bool = False) -> Iterator[Feature]:
+
+        query.set_param_if_not_exists("zoom_level", self.default_zoom_level)
+        query.set_param_if_not_exists("imagery_layers", [self.default_imagery_layer])
+        set_query_defaults(query)
+
+        metrics = self.api.metrics = Metrics()
+        self.api.crs = query.crs
+
+        tile_list, valid_imagery_layers = self.get_tiles_and_layers(query)
+
+        date_list = extract_query_dates(query)
+
+        validate_composite(query.composite, valid_imagery_layers)
+        options = FetchOptions.from_query(
+            query, dry_run, valid_imagery_layers, self.output_dir
+        )
+        if query.composite:
+            # A single output for all dates, which is not checkpointed
+            feature = self.fetch_composite(
+                tile_list, valid_imagery_layers, date_list, query.composite, options
+            )
+            if options.include_metrics:
+                feature["properties"]["metrics"] = metrics.summary()
+            metrics.write(self.output_dir)
+            yield feature
+            return
+
+        yield from self._fetch_dates(
+            query, tile_list, valid_imagery_layers, date_list, options
+        )
+
+    @contextmanager
+    def _job_journal(
+        self, query: STACQuery, options: FetchOptions
+    ) -> Iterator[Tuple[CheckpointJournal, Optional[IncrementalManifest]]]:
+        """
+        Checkpoint journal and, in incremental mode, manifest of a job, with the tile
+        cache and COG pool of the job set up for its duration
+        """
+        journal = CheckpointJournal(self.output_dir, query_key(query, options.dry_run))
+        manifest = None
+        if options.incremental:
+            manifest = IncrementalManifest.from_env(incremental_key(query))
+        user_tile_cache = self.api.tile_cache
+        if user_tile_cache is None and (options.checkpoint_tiles or journal.resumable):
+            # Keep the tiles of this job, so a restart does not download them again
+            self.api.tile_cache = journal.tile_cache
+        if options.cog_workers > 1:
+            options.cog_pool = CogWorkerPool(options.cog_workers, options.cog_threads)
+        try:
+            yield journal, manifest
+        finally:
+            if options.cog_pool is not None:
+                options.cog_pool.shutdown()
+                options.cog_pool = None
+            self.api.tile_cache = user_tile_cache
+
+    def _fetch_dates(
+        self,
+        query: STACQuery,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        date_list: List[str],
+        options: FetchOptions,
+    ) -> Iterator[Feature]:
+        """
+        Yields the features of the dates in date order, see `fetch_iter`. The dates
+        completed in an earlier run of the job (see `checkpoint`) or in an earlier job
+        (see `incremental`) are not fetched again.
+        """
+        # Features not yet emitted, in date order, and whether they were fetched in
+        # this job (their COG conversion may still be running in the pool)
+        pending: List[Tuple[str, Feature, bool]] = []
+        date_metrics: Dict[str, dict] = {}
+
+        with self._job_journal(query, options) as (journal, manifest):
+
+            def complete_date(
+                query_date: str, feature: Feature, fetched: bool
+            ) -> Feature:
+                logger.debug(feature)
+                if not fetched:
+                    return feature
+                if options.cog_pool is not None:
+                    cog_seconds = options.cog_pool.wait(
+                        self.output_dir / feature["properties"]["up42.data_path"]
                     )
-                except requests.exceptions.HTTPError:
-                    continue
+                    self.metrics.record_stage("cog", cog_seconds)
+                    date_metrics[query_date]["stages"]["cog"] = round(cog_seconds, 4)
+                if options.include_metrics:
+                    feature["properties"]["metrics"] = date_metrics[query_date]
+                if manifest is not None:
+                    manifest.add(
+                        query_date, feature, self.output_dir, self.quicklook_dir
+                    )
+                journal.record(query_date, feature)
+                return feature
 
-            if not dry_run:
-                # Fetch tiles and patch them together
-                img_filename = self.get_final_merged_image(
-                    tile_list, valid_imagery_layers, query_date, feature_id
+            for query_date in date_list:
+                feature = self._resume_date(
+                    query_date, tile_list, valid_imagery_layers, journal, manifest
                 )
-                self.api.post_process(img_filename, valid_imagery_layers)
-                to_cog(img_filename, forward_band_tags=True)
-                set_data_path(feature, f"{feature_id}.tif")
+                fetched = feature is None
+                if feature is None:
+                    previewed = False
+                    for feature in self._fetch_new_date(
+                        tile_list,
+                        valid_imagery_layers,
+                        query_date,
+                        options,
+                        date_metrics,
+                    ):
+                        if feature["properties"].get(PREVIEW_PROPERTY):
+                            previewed = True
+                            yield feature
+                    if is_dropped(feature):
+                        journal.record(query_date, feature)
+                        if previewed:
+                            # Withdraws the preview
+                            pending.append((query_date, feature, False))
+                if not is_dropped(feature):
+                    pending.append((query_date, feature, fetched))
+
+                # Keep at most one conversion per worker outstanding
+                while pending and (
+                    options.cog_pool is None
+                    or not pending[0][2]
+                    or sum(1 for *_, in_pool in pending if in_pool)
+                    > options.cog_workers
+                ):
+                    yield complete_date(*pending.pop(0))
 
-            logger.debug(feature)
-            output_features.append(feature)
+            while pending:
+                yield complete_date(*pending.pop(0))
+            remove_previews(self.output_dir)
 
-        logger.debug(f"Saving {len(output_features)} result features")
+        if manifest is not None:
+            manifest.prune(date_list)
+        journal.clear()
+        self.metrics.write(self.output_dir, dates=date_metrics)
 
-        return FeatureCollection(list(output_features))
+    def _resume_date(
+        self,
+        query_date: str,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        journal: CheckpointJournal,
+        manifest: Optional[IncrementalManifest],
+    ) -> Optional[Feature]:
+        """
+        Feature of a date completed in an earlier run of the job or in an earlier job,
+        None if the date has to be fetched
+        """
+        feature = journal.completed(query_date)
+        if feature is not None and is_dropped(feature):
+            logger.info(f"Date {query_date} already dropped, skipping")
+        elif feature is not None:
+            logger.info(f"Date {query_date} already completed, skipping")
+            self._ensure_quicklook(feature, tile_list, valid_imagery_layers, query_date)
+        elif manifest is not None:
+            feature = manifest.restore(query_date, self.output_dir, self.quicklook_dir)
+            if feature is not None:
+                logger.info(f"Reusing {query_date} fetched in an earlier job")
+                journal.record(query_date, feature)
+        return feature
+
+    def _fetch_new_date(
+        self,
+        tile_list: List[Tile],
+        valid_imagery_layers: OrderedDict,
+        query_date: str,
+        options: FetchOptions,
+        date_metrics: Dict[str, dict],
+    ) -> Iterator[Feature]:
+        """
+        Yields the feature of a date, in progressive mode preceded by its preview, and
+        adds the metrics of the date to date_metrics
+        """
+        date_snapshot = self.metrics.snapshot()
+        preview = None
+        if options.progressive:
+            preview = self.fetch_preview(
+                tile_list, valid_imagery_layers, query_date, options
+            )
+        if preview is not None:
+            yield preview
+        yield self.fetch_date(
+            tile_list,
+            valid_imagery_layers,
+            query_date,
+            options,
+            feature_id=preview["id"] if preview is not None else None,
+        )
+        date_metrics[query_date] = self.metrics.summary(since=date_snapshot)
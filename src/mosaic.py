@@ -0,0 +1,121 @@
+"""
+In-place merging of tiles into a pooled mosaic.
+
+Every tile is decoded by GDAL straight from the response bytes into its window of a
+mosaic array covering the tile grid, so merging allocates no per-tile arrays and writes
+no per-tile files. The mosaic arrays come from a `BufferPool`: the layers, chunks and
+dates of a process reuse the same few buffers instead of allocating a new mosaic each.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from mercantile import Tile
+from rasterio.errors import RasterioIOError
+from rasterio.io import DatasetReader, MemoryFile
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+
+# Larger buffers are freed after use instead of being kept for reuse
+MAX_POOLED_BYTES = 256 * 2**20
+
+
+class BufferPool:
+    def __init__(self, max_buffers: int = 2, max_bytes: int = MAX_POOLED_BYTES):
+        """
+        :param max_buffers: Number of free buffers kept for reuse
+        :param max_bytes: Size up to which a free buffer is kept
+        """
+        self.max_buffers = max_buffers
+        self.max_bytes = max_bytes
+        self.allocated = 0
+        self.reused = 0
+        self._free: List[np.ndarray] = []
+        self._lock = threading.Lock()
+
+    def _take(self, nbytes: int) -> np.ndarray:
+        with self._lock:
+            fitting = [
+                index
+                for index, buffer in enumerate(self._free)
+                if buffer.nbytes >= nbytes
+            ]
+            if fitting:
+                # By index, comparing arrays with remove() is ambiguous
+                index = min(fitting, key=lambda index: self._free[index].nbytes)
+                self.reused += 1
+                return self._free.pop(index)
+            self.allocated += 1
+        return np.empty(nbytes, dtype=np.uint8)
+
+    def _give(self, buffer: np.ndarray):
+        if buffer.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._free.append(buffer)
+            self._free.sort(key=lambda buffer: buffer.nbytes, reverse=True)
+            del self._free[self.max_buffers :]
+
+    @contextmanager
+    def array(self, shape: Tuple[int, ...], dtype) -> Iterator[np.ndarray]:
+        """
+        Zeroed array on a pooled buffer, the buffer is returned to the pool on exit
+        and the array must not be used afterwards
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buffer = self._take(nbytes)
+        try:
+            array = buffer[:nbytes].view(dtype).reshape(shape)
+            array.fill(0)
+            yield array
+        finally:
+            self._give(buffer)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+
+# Shared by all fetches of the process
+MOSAIC_POOL = BufferPool()
+
+
+@contextmanager
+def open_tile(content: bytes) -> Iterator[DatasetReader]:
+    """
+    Opens an encoded tile on the response bytes themselves (GDAL in-memory file, no
+    copy is made of bytes objects)
+    """
+    try:
+        with MemoryFile(content) as mem_file, mem_file.open() as image:
+            yield image
+    except RasterioIOError as err:
+        raise UP42Error(SupportedErrors.API_CONNECTION_ERROR, err) from err
+
+
+def tile_window(
+    mosaic: np.ndarray, tile: Tile, origin: Tuple[int, int], tile_size: int
+) -> np.ndarray:
+    """
+    View of the window of tile in a mosaic whose top left tile is origin (x, y)
+    """
+    row = (tile.y - origin[1]) * tile_size
+    col = (tile.x - origin[0]) * tile_size
+    return mosaic[:, row : row + tile_size, col : col + tile_size]
+
+
+def valid_window(
+    mosaic: np.ndarray, tiles: List[Tile], origin: Tuple[int, int], tile_size: int
+) -> np.ndarray:
+    """
+    View of the bounding tile range of tiles in the mosaic
+    """
+    rows = [tile.y - origin[1] for tile in tiles]
+    cols = [tile.x - origin[0] for tile in tiles]
+    return mosaic[
+        :,
+        min(rows) * tile_size : (max(rows) + 1) * tile_size,
+        min(cols) * tile_size : (max(cols) + 1) * tile_size,
+    ]
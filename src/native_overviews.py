@@ -0,0 +1,159 @@
+"""
+COG overviews from the native GIBS pyramid.
+
+GIBS publishes every layer at all zoom levels below the requested one. Instead of
+resampling the full resolution mosaic, overview level k of the COG is assembled from the
+tiles at zoom `zoom_level - k`, fetched concurrently (through the tile cache if one is
+configured) and cropped to the extent of the mosaic.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import mercantile
+import numpy as np
+import rasterio as rio
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rio_cogeo.utils import get_maximum_overview_level
+
+from blockutils.logging import get_logger
+
+from gibs import GibsAPI, layer_bands
+
+logger = get_logger(__name__)
+
+TILE_SIZE = 256
+# Upper left corner of the web mercator tile grid
+WORLD_LEFT, _, _, WORLD_TOP = mercantile.xy_bounds(mercantile.Tile(0, 0, 0))
+
+
+def overview_tile_range(
+    transform: Affine, width: int, height: int, zoom: int
+) -> Tuple[range, range, int, int]:
+    """
+    Tiles at zoom covering an image, and the pixel offset of the image in the mosaic
+    of these tiles
+
+    :return: x range, y range, column offset, row offset
+    """
+    resolution = (WORLD_TOP - WORLD_LEFT) / (TILE_SIZE * 2**zoom)
+    col = int(round((transform.c - WORLD_LEFT) / resolution))
+    row = int(round((WORLD_TOP - transform.f) / resolution))
+    x_range = range(col // TILE_SIZE, (col + width - 1) // TILE_SIZE + 1)
+    y_range = range(row // TILE_SIZE, (row + height - 1) // TILE_SIZE + 1)
+    return (
+        x_range,
+        y_range,
+        col - x_range.start * TILE_SIZE,
+        row - y_range.start * TILE_SIZE,
+    )
+
+
+def fetch_overview_level(
+    api: GibsAPI,
+    imagery_layers: dict,
+    date: str,
+    zoom: int,
+    transform: Affine,
+    width: int,
+    height: int,
+    max_workers: int = 8,
+) -> np.ndarray:
+    """
+    Mosaic of all layers at zoom, cropped to an image of the given size and transform
+    (at the resolution of zoom)
+    """
+    x_range, y_range, col_offset, row_offset = overview_tile_range(
+        transform, width, height, zoom
+    )
+    band_offsets = {}
+    count = 0
+    for layer, attributes in imagery_layers.items():
+        band_offsets[layer] = count
+        count += attributes["bands_count"]
+    mosaic = np.zeros(
+        (count, len(y_range) * TILE_SIZE, len(x_range) * TILE_SIZE), dtype=np.uint8
+    )
+
+    def fetch(task):
+        layer, tile = task
+        response = api.requests_wmts_tile(
+            tile, layer, date, imagery_layers[layer]["Format"]
+        )
+        with api.metrics.stage("decode"), MemoryFile(response.content) as mem_file:
+            with mem_file.open() as image:
+                data = image.read(indexes=layer_bands(imagery_layers[layer]))
+        row = (tile.y - y_range.start) * TILE_SIZE
+        col = (tile.x - x_range.start) * TILE_SIZE
+        mosaic[
+            band_offsets[layer] : band_offsets[layer] + data.shape[0],
+            row : row + data.shape[1],
+            col : col + data.shape[2],
+        ] = data
+
+    tasks = [
+        (layer, mercantile.Tile(x, y, zoom))
+        for layer in imagery_layers
+        for y in y_range
+        for x in x_range
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, tasks))
+
+    return mosaic[:, row_offset : row_offset + height, col_offset : col_offset + width]
+
+
+def write_native_overviews(
+    img_filename: Path,
+    api: GibsAPI,
+    imagery_layers: dict,
+    date: str,
+    zoom_level: int,
+    blocksize: int = 512,
+    max_workers: int = 8,
+) -> List[Path]:
+    """
+    Writes the overview levels of the mosaic at img_filename (at zoom_level) from the
+    lower GIBS zoom levels, next to the mosaic.
+
+    :return: The overview files, from the largest to the smallest
+    """
+    with rio.open(img_filename) as src:
+        profile = src.profile
+    profile.update(driver="GTiff", tiled=True, blockxsize=256, blockysize=256)
+    for option in ("compress", "predictor", "zlevel", "zstd_level"):
+        profile.pop(option, None)
+    level_count = min(
+        get_maximum_overview_level(
+            profile["width"], profile["height"], minsize=blocksize
+        ),
+        zoom_level,
+    )
+
+    overview_files = []
+    for level in range(1, level_count + 1):
+        width = -(-profile["width"] // 2**level)
+        height = -(-profile["height"] // 2**level)
+        transform = profile["transform"] * Affine.scale(2**level)
+        data = fetch_overview_level(
+            api,
+            imagery_layers,
+            date,
+            zoom_level - level,
+            transform,
+            width,
+            height,
+            max_workers,
+        )
+        overview_file = Path(img_filename).with_suffix(f".ovr{level}.tif")
+        with rio.open(
+            overview_file,
+            "w",
+            **{**profile, "width": width, "height": height, "transform": transform},
+        ) as dst:
+            dst.write(data)
+        overview_files.append(overview_file)
+        logger.info(f"Overview level {level} built from GIBS zoom {zoom_level - level}")
+    return overview_files
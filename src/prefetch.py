@@ -0,0 +1,191 @@
+"""
+Warms up the local tile cache for scheduled AOIs and date ranges.
+
+Computes the tiles the fetch will request for the given geometries, layers and dates,
+downloads the missing ones concurrently (within a rate limit) into the cache configured
+by `MODIS_CACHE_DIR` (or `--cache-dir`) and refreshes the cached capabilities, so the
+scheduled jobs are served from local disk. Example:
+
+    python src/prefetch.py --geometries aois.geojson --start 2021-03-01 --end 2021-03-02 \
+        --layers MODIS_Terra_CorrectedReflectance_TrueColor,MODIS_Terra_NDVI_8Day
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Set, Tuple
+
+import mercantile
+import shapely.geometry
+
+from blockutils.exceptions import UP42Error
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from gibs import GibsAPI, extract_query_dates, get_tile_list
+from modis import DEFAULT_IMAGERY_LAYER, DEFAULT_ZOOM_LEVEL
+from tile_cache import TileCache
+
+logger = get_logger(__name__)
+
+
+class RateLimiter:
+    """
+    Limits the rate of calls to `wait` across threads to `rate` per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def load_geometries(path: Path) -> List[dict]:
+    """
+    Geometries from a GeoJSON file with a FeatureCollection, Feature or Geometry
+    """
+    with open(path, encoding="utf-8") as src:
+        geojson_obj = json.load(src)
+    if geojson_obj["type"] == "FeatureCollection":
+        return [feature["geometry"] for feature in geojson_obj["features"]]
+    if geojson_obj["type"] == "Feature":
+        return [geojson_obj["geometry"]]
+    return [geojson_obj]
+
+
+def get_prefetch_dates(start: str, end: str) -> List[str]:
+    """
+    All dates between start and end (inclusive), as they would be requested by a fetch
+    """
+    query = STACQuery.from_dict(
+        {"time": f"{start}T00:00:00+00:00/{end}T23:59:59+00:00", "limit": 100000}
+    )
+    return extract_query_dates(query)
+
+
+def get_prefetch_tiles(
+    geometries: List[dict], zoom_level: int
+) -> List[mercantile.Tile]:
+    """
+    Union of the tiles covering all geometries, sorted by (y, x)
+    """
+    tiles: Set[mercantile.Tile] = set()
+    for geometry in geometries:
+        bounds = shapely.geometry.shape(geometry).bounds
+        tiles.update(get_tile_list(bounds, geometry, zoom_level))
+    return sorted(tiles, key=lambda tile: (tile.y, tile.x))
+
+
+def prefetch(
+    api: GibsAPI,
+    geometries: List[dict],
+    layers: List[str],
+    dates: List[str],
+    zoom_level: int = DEFAULT_ZOOM_LEVEL,
+    max_workers: int = 8,
+    rate: float = 20.0,
+) -> Tuple[int, int, int]:
+    """
+    Downloads all missing tiles into the cache of api and refreshes the cached catalog.
+
+    :return: Number of downloaded, already cached and failed tiles
+    """
+    if api.tile_cache is None:
+        raise ValueError("Prefetching requires a tile cache")
+
+    catalog = api.get_dict_available_imagery_layers()
+    unknown_layers = [layer for layer in layers if layer not in catalog]
+    if unknown_layers:
+        raise ValueError(f"Unknown imagery layers: {unknown_layers}")
+
+    tiles = get_prefetch_tiles(geometries, zoom_level)
+    tasks = []
+    cached = 0
+    for layer in layers:
+        img_format = catalog[layer]["Format"]
+        for date in dates:
+            for tile in tiles:
+                if api.tile_cache.has_tile(tile, layer, date, img_format):
+                    cached += 1
+                else:
+                    tasks.append((tile, layer, date, img_format))
+    logger.info(
+        f"{len(tiles)} tiles x {len(layers)} layers x {len(dates)} dates: "
+        f"{cached} already cached, {len(tasks)} to download"
+    )
+
+    rate_limiter = RateLimiter(rate)
+    failed = []
+
+    def download(task):
+        rate_limiter.wait()
+        try:
+            api.requests_wmts_tile(*task)
+        except UP42Error as err:
+            logger.warning(f"Prefetching {task} failed: {err}")
+            failed.append(task)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(download, tasks))
+
+    return len(tasks) - len(failed), cached, len(failed)
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument(
+        "--geometries",
+        type=Path,
+        required=True,
+        help="GeoJSON file (FeatureCollection, Feature or Geometry) with the AOIs",
+    )
+    arg_parser.add_argument(
+        "--layers",
+        default=DEFAULT_IMAGERY_LAYER,
+        help="Comma separated list of imagery layers",
+    )
+    arg_parser.add_argument("--start", required=True, help="First date (YYYY-MM-DD)")
+    arg_parser.add_argument("--end", required=True, help="Last date (YYYY-MM-DD)")
+    arg_parser.add_argument("--zoom-level", type=int, default=DEFAULT_ZOOM_LEVEL)
+    arg_parser.add_argument("--workers", type=int, default=8)
+    arg_parser.add_argument(
+        "--rate", type=float, default=20.0, help="Maximum requests per second"
+    )
+    arg_parser.add_argument(
+        "--cache-dir", type=Path, default=None, help="Defaults to $MODIS_CACHE_DIR"
+    )
+    args = arg_parser.parse_args(argv)
+
+    tile_cache = TileCache(args.cache_dir) if args.cache_dir else TileCache.from_env()
+    if tile_cache is None:
+        arg_parser.error("Either --cache-dir or MODIS_CACHE_DIR must be set")
+
+    downloaded, cached, failed = prefetch(
+        GibsAPI(tile_cache=tile_cache),
+        load_geometries(args.geometries),
+        args.layers.split(","),
+        get_prefetch_dates(args.start, args.end),
+        zoom_level=args.zoom_level,
+        max_workers=args.workers,
+        rate=args.rate,
+    )
+    logger.info(f"Downloaded {downloaded}, already cached {cached}, failed {failed}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
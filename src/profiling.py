@@ -0,0 +1,90 @@
+"""
+Opt-in profiling of fetch jobs with cProfile and tracemalloc.
+
+Profiling is switched on either by the `profile` query parameter or by setting the
+`MODIS_PROFILE` environment variable to a true value. When switched off, the job runs
+without any profiler attached.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+logger = get_logger(__name__)
+
+PROFILE_ENV_VAR = "MODIS_PROFILE"
+PROFILE_FILENAME = "profile.prof"
+PROFILE_STATS_FILENAME = "profile_stats.txt"
+ALLOCATIONS_FILENAME = "profile_allocations.txt"
+
+
+def profiling_enabled(query: STACQuery) -> bool:
+    """
+    Whether the job should be profiled, either requested in the query or via environment
+    """
+    env_value = os.environ.get(PROFILE_ENV_VAR, "").strip().lower()
+    return bool(query.get_param_if_exists("profile", False)) or env_value in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+def write_profile_report(
+    profiler: cProfile.Profile,
+    snapshot: tracemalloc.Snapshot,
+    output_dir: Path,
+    top_n: int = 30,
+):
+    """
+    Writes the raw profile (loadable with pstats/snakeviz), a text summary of the
+    slowest functions and the top allocation sites into output_dir
+    """
+    output_dir = Path(output_dir)
+    profiler.dump_stats(str(output_dir / PROFILE_FILENAME))
+
+    stats_stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stats_stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    with open(output_dir / PROFILE_STATS_FILENAME, "w", encoding="utf-8") as out:
+        out.write(stats_stream.getvalue())
+
+    with open(output_dir / ALLOCATIONS_FILENAME, "w", encoding="utf-8") as out:
+        current, peak = tracemalloc.get_traced_memory()
+        out.write(
+            f"Traced memory at end: {current / 2**20:.1f} MiB, peak: {peak / 2**20:.1f} MiB\n"
+        )
+        out.write(f"Top {top_n} allocation sites still allocated at end of job:\n")
+        for stat in snapshot.statistics("lineno")[:top_n]:
+            out.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_job(output_dir: Path, enabled: bool = True):
+    """
+    Runs the enclosed block under cProfile and tracemalloc and writes the
+    profile artifacts into output_dir afterwards (also if the block fails)
+    """
+    if not enabled:
+        yield
+        return
+
+    logger.info("Profiling enabled")
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        write_profile_report(profiler, snapshot, output_dir)
+        tracemalloc.stop()
+        logger.info(f"Profile written to {output_dir}")
@@ -0,0 +1,121 @@
+"""
+Progressive output: a low resolution preview of every date before its full resolution
+image.
+
+With the query parameter `"progressive": true`, `Modis.fetch_iter` yields a preview
+feature of each date it fetches before fetching its full resolution tiles. The preview
+(`<id>.preview.tif`, marked by the `preview` property) is the AOI from the lowest zoom
+level below the query's at which at most `PREVIEW_MAX_TILES` tiles per layer cover it,
+so it takes a few requests instead of the whole tile grid. The full resolution feature
+follows with the same id and replaces the preview: `FeatureCollectionWriter` rewrites it
+in data.json and `Modis.fetch` only returns the final features.
+"""
+
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import rasterio as rio
+from geojson import Feature
+from mercantile import Tile
+from rasterio.transform import Affine
+
+from blockutils.logging import get_logger
+
+from compression import CompressionProfile, to_cog
+from data_coverage import is_dropped
+from geographic import EPSG_3857
+from gibs import GibsAPI, get_tile_grid
+from native_overviews import fetch_overview_level, overview_tile_range
+
+logger = get_logger(__name__)
+
+PREVIEW_PROPERTY = "preview"
+PREVIEW_SUFFIX = ".preview.tif"
+PREVIEW_MAX_TILES = 4
+
+
+def preview_level(
+    transform: Affine,
+    width: int,
+    height: int,
+    zoom: int,
+    max_tiles: int = PREVIEW_MAX_TILES,
+) -> int:
+    """
+    Number of zoom levels below zoom of the preview of an image, the first at which at
+    most max_tiles tiles cover the image (0 if there is no lower zoom level)
+    """
+    for level in range(1, zoom + 1):
+        x_range, y_range, _, _ = overview_tile_range(
+            transform * Affine.scale(2**level),
+            -(-width // 2**level),
+            -(-height // 2**level),
+            zoom - level,
+        )
+        if len(x_range) * len(y_range) <= max_tiles:
+            return level
+    return 0
+
+
+def write_preview(
+    path: Path,
+    api: GibsAPI,
+    imagery_layers: dict,
+    date: str,
+    tile_list: List[Tile],
+    compression_profile: CompressionProfile,
+    threads=None,
+    max_tiles: int = PREVIEW_MAX_TILES,
+) -> int:
+    """
+    Writes the preview COG of the mosaic of tile_list, the imagery layers need their
+    bands_count
+
+    :return: The zoom level of the preview
+    """
+    transform, width, height = get_tile_grid(tile_list)
+    zoom = tile_list[0].z
+    level = preview_level(transform, width, height, zoom, max_tiles)
+    transform = transform * Affine.scale(2**level)
+    width, height = -(-width // 2**level), -(-height // 2**level)
+    data = fetch_overview_level(
+        api, imagery_layers, date, zoom - level, transform, width, height
+    )
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=data.shape[0],
+        dtype=data.dtype,
+        crs=EPSG_3857,
+        transform=transform,
+    ) as dst:
+        dst.write(data)
+    api.post_process(path, imagery_layers)
+    to_cog(path, compression_profile, threads=threads, forward_band_tags=True)
+    logger.info(f"Preview of {date} written from GIBS zoom {zoom - level}")
+    return zoom - level
+
+
+def latest_features(features: Iterable[Feature]) -> List[Feature]:
+    """
+    Final features of a progressive fetch: a feature replaces the earlier one of the
+    same id (its preview) in place, or removes it if it is dropped
+    """
+    latest: Dict[str, Feature] = {}
+    for feature in features:
+        if feature["id"] in latest and is_dropped(feature):
+            del latest[feature["id"]]
+        else:
+            latest[feature["id"]] = feature
+    return list(latest.values())
+
+
+def remove_previews(output_dir: Path):
+    """
+    Removes the preview files in output_dir, once their final features are emitted
+    """
+    for preview_filename in Path(output_dir).glob(f"*{PREVIEW_SUFFIX}"):
+        preview_filename.unlink(missing_ok=True)
@@ -0,0 +1,389 @@
+"""
+Sharded fetch over several workers sharing a directory.
+
+A job is split into deterministic units of work, one per date, imagery layer and chunk
+of the tile grid (see `chunking.plan_chunks`), that independent workers run against a
+shared shard directory:
+
+- `plan` resolves the catalog and the tile cover of a query once and writes them,
+  with the chunks, to `plan.json` in the shard directory
+- `work` runs the units of worker i of n (every n-th unit). A unit merges the tiles of
+  its chunk into `units/<unit>.tif` and records their valid data coverage in
+  `units/<unit>.json`. Completed units are skipped, so workers can be restarted.
+- `assemble` stitches the units of every date into the same features, quicklooks and
+  COGs a single-node fetch merging in chunks (`memory_budget_mb`) writes to the output
+  directory, once all units completed. Like chunked images, they cover the whole tile
+  grid, whereas an unchunked fetch crops its images to the range of the valid tiles.
+
+The units of a plan only depend on the query and the chunk size, so any worker can
+recompute them. Example:
+
+    python src/sharding.py plan --query query.json --shard-dir /shared/job
+    python src/sharding.py work --shard-dir /shared/job --worker-index 0 --worker-count 4
+    python src/sharding.py assemble --shard-dir /shared/job
+"""
+
+import argparse
+import json
+import os
+import sys
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import rasterio as rio
+from geojson import FeatureCollection
+from mercantile import Tile
+
+from blockutils.common import ensure_data_directories_exist, save_metadata
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from checkpoint import query_key
+from chunking import TileChunk, chunked_output_profile, plan_chunks, write_chunk
+from compression import DEFAULT_COMPRESSION_PROFILE, get_compression_profile
+from data_coverage import (
+    TileCoverage,
+    feature_coverage,
+    is_dropped,
+    validate_min_coverage,
+)
+from fetch_options import FetchOptions
+from geographic import EPSG_3857, validate_crs
+from gibs import extract_query_dates, validate_bands
+from modis import Modis
+from tile_cache import write_atomic
+
+logger = get_logger(__name__)
+
+PLAN_FILENAME = "plan.json"
+UNITS_DIRNAME = "units"
+DEFAULT_SHARD_TILES = 64
+# Catalog attributes the units need
+LAYER_ATTRIBUTES = ("Format", "TileMatrixSet", "bands_count", "bands")
+
+
+@dataclass(frozen=True)
+class Unit:
+    date: str
+    layer_index: int
+    chunk_index: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.date}_{self.layer_index}_{self.chunk_index}"
+
+
+def plan_units(plan: dict) -> List[Unit]:
+    """
+    All units of a plan, by date, layer and chunk
+    """
+    return [
+        Unit(date, layer_index, chunk_index)
+        for date in plan["dates"]
+        for layer_index in range(len(plan["layers"]))
+        for chunk_index in range(len(plan["chunks"]))
+    ]
+
+
+def load_plan(shard_dir: Path) -> dict:
+    with open(Path(shard_dir) / PLAN_FILENAME, encoding="utf-8") as src:
+        return json.load(src, object_pairs_hook=OrderedDict)
+
+
+def plan_tiles(plan: dict) -> List[Tile]:
+    return [Tile(*tile) for tile in plan["tiles"]]
+
+
+def plan_chunk(plan: dict, chunk_index: int) -> TileChunk:
+    chunk = plan["chunks"][chunk_index]
+    return TileChunk(
+        chunk["col_off"],
+        chunk["row_off"],
+        chunk["cols"],
+        chunk["rows"],
+        [Tile(*tile) for tile in chunk["tiles"]],
+    )
+
+
+def unit_paths(shard_dir: Path, unit: Unit):
+    """
+    Merged image and record of a unit
+    """
+    units_dir = Path(shard_dir) / UNITS_DIRNAME
+    return units_dir / f"{unit.name}.tif", units_dir / f"{unit.name}.json"
+
+
+def plan_modis(plan: dict) -> Modis:
+    """
+    Modis instance fetching from the endpoints and in the crs of the plan
+    """
+    modis = Modis()
+    modis.api.crs = plan["crs"]
+    modis.api.wmts_url = plan["wmts_url"]
+    modis.api.wms_url = plan["wms_url"]
+    return modis
+
+
+def write_plan(
+    query_dict: dict,
+    shard_dir: Path,
+    shard_tiles: int = DEFAULT_SHARD_TILES,
+    modis: Optional[Modis] = None,
+) -> dict:
+    """
+    Writes the plan of a query into the shard directory
+
+    :param shard_tiles: Maximum number of tiles of a chunk
+    """
+    modis = modis or Modis()
+    query = STACQuery.from_dict(query_dict)
+    query.set_param_if_not_exists("zoom_level", modis.default_zoom_level)
+    query.set_param_if_not_exists("imagery_layers", [modis.default_imagery_layer])
+    query.set_param_if_not_exists("compression_profile", DEFAULT_COMPRESSION_PROFILE)
+    query.set_param_if_not_exists("min_coverage", None)
+    query.set_param_if_not_exists("crs", EPSG_3857)
+    validate_bands(
+        query.get_param_if_exists("bands"), query.get_param_if_exists("imagery_layers")
+    )
+    compression_profile = get_compression_profile(
+        query.get_param_if_exists("compression_profile")
+    )
+    min_coverage = query.get_param_if_exists("min_coverage")
+    validate_min_coverage(min_coverage)
+    crs = query.get_param_if_exists("crs")
+    validate_crs(crs)
+    if query.get_param_if_exists("composite") or (
+        (query.get_param_if_exists("output_format") or "geotiff") != "geotiff"
+    ):
+        raise UP42Error(
+            SupportedErrors.INPUT_PARAMETERS_ERROR,
+            "Sharded fetches only write one GeoTIFF per date.",
+        )
+
+    modis.api.crs = crs
+    tile_list, valid_imagery_layers = modis.get_tiles_and_layers(query)
+    date_list = extract_query_dates(query)
+    modis.api.get_layer_bands_count(tile_list, valid_imagery_layers, date_list[0])
+    chunks = plan_chunks(
+        tile_list,
+        shard_tiles,
+        align=max(1, compression_profile.blocksize // modis.tile_size),
+    )
+
+    content = {
+        "key": query_key(query, False, "sharded", shard_tiles),
+        "crs": crs,
+        "wmts_url": modis.api.wmts_url,
+        "wms_url": modis.api.wms_url,
+        "compression_profile": compression_profile.name,
+        "cog_threads": query.get_param_if_exists("cog_threads"),
+        "min_coverage": min_coverage,
+        "dates": date_list,
+        "layers": OrderedDict(
+            (
+                layer,
+                {
+                    attribute: attributes[attribute]
+                    for attribute in LAYER_ATTRIBUTES
+                    if attribute in attributes
+                },
+            )
+            for layer, attributes in valid_imagery_layers.items()
+        ),
+        "tiles": [list(tile) for tile in tile_list],
+        "chunks": [
+            {
+                "col_off": chunk.col_off,
+                "row_off": chunk.row_off,
+                "cols": chunk.cols,
+                "rows": chunk.rows,
+                "tiles": [list(tile) for tile in chunk.tiles],
+            }
+            for chunk in chunks
+        ],
+    }
+    write_atomic(
+        Path(shard_dir) / PLAN_FILENAME, json.dumps(content, indent=2).encode()
+    )
+    logger.info(
+        f"Planned {len(date_list) * len(valid_imagery_layers) * len(chunks)} units: "
+        f"{len(date_list)} dates, {len(valid_imagery_layers)} layers, "
+        f"{len(chunks)} chunks of {len(tile_list)} tiles"
+    )
+    return content
+
+
+def run_unit(modis: Modis, plan_content: dict, unit: Unit, shard_dir: Path):
+    """
+    Merges the tiles of a unit; a unit without valid tiles has no image
+    """
+    image_path, record_path = unit_paths(shard_dir, unit)
+    layer = list(plan_content["layers"])[unit.layer_index]
+    coverage = TileCoverage()
+    tmp_path = image_path.with_name(f".{image_path.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        valid_tiles = modis.merge_layer(
+            plan_chunk(plan_content, unit.chunk_index).tiles,
+            plan_content["layers"],
+            layer,
+            unit.date,
+            coverage,
+            tmp_path,
+        )
+        os.replace(tmp_path, image_path)
+    except UP42Error as err:
+        tmp_path.unlink(missing_ok=True)
+        if err.error_code != SupportedErrors.NO_INPUT_ERROR:
+            raise
+        valid_tiles = []
+    # The record marks the unit as completed
+    record = {
+        "valid_tiles": len(valid_tiles),
+        "fractions": [
+            [*tile, fraction] for tile, fraction in coverage.fractions.items()
+        ],
+    }
+    write_atomic(record_path, json.dumps(record).encode())
+
+
+def run_worker(shard_dir: Path, worker_index: int = 0, worker_count: int = 1) -> int:
+    """
+    Runs the units of a worker that are not completed yet
+
+    :return: The number of units run
+    """
+    plan_content = load_plan(shard_dir)
+    modis = plan_modis(plan_content)
+    units = plan_units(plan_content)[worker_index::worker_count]
+    count = 0
+    for unit in units:
+        if unit_paths(shard_dir, unit)[1].is_file():
+            continue
+        logger.info(f"Worker {worker_index}/{worker_count} running unit {unit.name}")
+        run_unit(modis, plan_content, unit, shard_dir)
+        count += 1
+    return count
+
+
+def assemble(shard_dir: Path, modis: Optional[Modis] = None) -> FeatureCollection:
+    """
+    Writes the features, quicklooks and COGs of all dates from the completed units,
+    finished like those of `Modis.fetch_date`. The images cover the whole tile grid.
+    """
+    plan_content = load_plan(shard_dir)
+    modis = modis or plan_modis(plan_content)
+    missing = [
+        unit.name
+        for unit in plan_units(plan_content)
+        if not unit_paths(shard_dir, unit)[1].is_file()
+    ]
+    if missing:
+        raise UP42Error(
+            SupportedErrors.NO_OUTPUT_ERROR,
+            f"{len(missing)} units are not completed, e.g. {missing[:5]}.",
+        )
+
+    layers = plan_content["layers"]
+    tile_list = plan_tiles(plan_content)
+    chunks = [
+        plan_chunk(plan_content, index) for index in range(len(plan_content["chunks"]))
+    ]
+    compression_profile = get_compression_profile(plan_content["compression_profile"])
+    transform, width, height = modis.get_tile_grid(tile_list)
+    layer_bands = [attributes["bands_count"] for attributes in layers.values()]
+
+    output_features = []
+    for date in plan_content["dates"]:
+        feature = modis.date_feature(
+            tile_list,
+            layers,
+            date,
+            str(uuid.uuid5(uuid.NAMESPACE_URL, f"{plan_content['key']}/{date}")),
+        )
+
+        coverages = [TileCoverage() for _ in layers]
+        for layer_index, coverage in enumerate(coverages):
+            for chunk_index in range(len(chunks)):
+                with open(
+                    unit_paths(shard_dir, Unit(date, layer_index, chunk_index))[1],
+                    encoding="utf-8",
+                ) as src:
+                    for *tile, fraction in json.load(src)["fractions"]:
+                        coverage.add(Tile(*tile), fraction)
+        if not all(coverage.fractions for coverage in coverages):
+            raise UP42Error(SupportedErrors.NO_INPUT_ERROR, "All tiles are empty.")
+
+        img_filename = modis.output_dir / f"{feature['id']}.tif"
+        profile = chunked_output_profile(
+            transform,
+            width,
+            height,
+            plan_content["crs"],
+            sum(layer_bands),
+            compression_profile,
+        )
+        with rio.open(img_filename, "w", **profile) as dst:
+            for chunk_index, chunk in enumerate(chunks):
+                layer_files = []
+                for layer_index in range(len(layers)):
+                    image_path = unit_paths(
+                        shard_dir, Unit(date, layer_index, chunk_index)
+                    )[0]
+                    layer_files.append(image_path if image_path.is_file() else None)
+                write_chunk(dst, chunk, layer_files, layer_bands, modis.tile_size)
+        feature = modis.finish_date(
+            feature,
+            feature_coverage(coverages, len(tile_list)),
+            tile_list,
+            layers,
+            date,
+            FetchOptions(
+                compression_profile=compression_profile,
+                cog_threads=plan_content["cog_threads"],
+                min_coverage=plan_content["min_coverage"],
+            ),
+        )
+        if not is_dropped(feature):
+            output_features.append(feature)
+
+    logger.info(f"Assembled {len(output_features)} features")
+    return FeatureCollection(output_features)
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("step", choices=["plan", "work", "assemble"])
+    arg_parser.add_argument("--shard-dir", type=Path, required=True)
+    arg_parser.add_argument(
+        "--query", type=Path, default=None, help="JSON file with the query (plan)"
+    )
+    arg_parser.add_argument(
+        "--shard-tiles",
+        type=int,
+        default=DEFAULT_SHARD_TILES,
+        help="Maximum number of tiles of a unit (plan)",
+    )
+    arg_parser.add_argument("--worker-index", type=int, default=0)
+    arg_parser.add_argument("--worker-count", type=int, default=1)
+    args = arg_parser.parse_args(argv)
+
+    ensure_data_directories_exist()
+    if args.step == "plan":
+        if args.query is None:
+            arg_parser.error("plan requires --query")
+        with open(args.query, encoding="utf-8") as src:
+            write_plan(json.load(src), args.shard_dir, args.shard_tiles)
+    elif args.step == "work":
+        run_worker(args.shard_dir, args.worker_index, args.worker_count)
+    else:
+        save_metadata(assemble(args.shard_dir))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
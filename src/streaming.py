@@ -0,0 +1,97 @@
+"""
+Incremental writing of the output metadata.
+
+`FeatureCollectionWriter` writes `data.json` as an empty feature collection first and
+appends every feature as soon as it is emitted by `Modis.fetch_iter`, so downstream
+steps can pick up the first dates while later ones are still being fetched. After each
+feature the file is a complete, valid feature collection, and once all features are
+written it is identical to the one written by `blockutils.common.save_metadata`.
+A feature with the id of a feature written earlier, i.e. the final feature of a preview
+of a progressive fetch, replaces it in place.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable
+
+from geojson import Feature
+
+from blockutils.logging import get_logger
+
+from data_coverage import is_dropped
+from tile_cache import write_atomic
+
+logger = get_logger(__name__)
+
+COLLECTION_HEAD = b'{"type": "FeatureCollection", "features": ['
+COLLECTION_TAIL = b"]}"
+
+
+class FeatureCollectionWriter:
+    def __init__(self, path: Path):
+        """
+        :param path: The metadata file, replaced by an empty feature collection
+        """
+        self.path = Path(path)
+        self.count = 0
+        # Serialized features by id, in the order of the collection
+        self._features: Dict[object, bytes] = {}
+        # Kept open between appends, closed by close()
+        self._file = open(self.path, "wb+")  # pylint: disable=consider-using-with
+        self._file.write(COLLECTION_HEAD + COLLECTION_TAIL)
+        self._file.flush()
+
+    def __enter__(self) -> "FeatureCollectionWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, feature: Feature):
+        """
+        Appends the feature in place of the closing brackets and closes the collection
+        again. A feature with the id of a feature written earlier replaces it, or
+        removes it if it is dropped.
+        """
+        key = feature.get("id", object())
+        content = json.dumps(feature).encode()
+        if key in self._features:
+            features = dict(self._features)
+            if is_dropped(feature):
+                del features[key]
+            else:
+                features[key] = content
+            self._rewrite(features)
+            self._features = features
+            logger.debug(f"Replaced feature {key} in {self.path}")
+        else:
+            self._file.seek(-len(COLLECTION_TAIL), os.SEEK_END)
+            separator = b", " if self._features else b""
+            self._file.write(separator + content + COLLECTION_TAIL)
+            self._file.flush()
+            self._features[key] = content
+            logger.debug(f"Appended feature {key} to {self.path}")
+        self.count = len(self._features)
+
+    def _rewrite(self, features: Dict[object, bytes]):
+        """
+        Replaces the file by the collection of features, readers never see it partially
+        written
+        """
+        self._file.close()
+        try:
+            write_atomic(
+                self.path,
+                COLLECTION_HEAD + b", ".join(features.values()) + COLLECTION_TAIL,
+            )
+        finally:
+            # Also after a failed write, so the writer stays usable
+            self._file = open(self.path, "rb+")  # pylint: disable=consider-using-with
+
+    def extend(self, features: Iterable[Feature]):
+        for feature in features:
+            self.append(feature)
+
+    def close(self):
+        self._file.close()
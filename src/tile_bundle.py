@@ -0,0 +1,304 @@
+"""
+Offline tile bundles: the capabilities, tiles and quicklooks of a set of AOIs and dates
+packed into a single indexed file.
+
+A bundle is an SQLite database (similar to MBTiles) with one table per kind of content,
+indexed by layer, date and tile. With the environment variable `MODIS_TILE_BUNDLE`
+pointing to a bundle, `GibsAPI` serves the catalog, tiles and quicklooks from the bundle
+instead of GIBS and makes no requests at all, e.g. for reprocessing or in air-gapped
+environments. Reads go through SQLite's memory-mapped I/O, one read-only connection
+per thread.
+
+Bundles are packed with the tile download of `prefetch` (Web Mercator tiles):
+
+    python src/tile_bundle.py --geometries aois.geojson --start 2021-03-01 \
+        --end 2021-03-02 --layers MODIS_Terra_CorrectedReflectance_TrueColor \
+        --output aois.bundle
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import mercantile
+import requests
+import shapely.geometry
+
+from blockutils.geometry import tiles_to_geom
+from blockutils.logging import get_logger
+
+from geographic import EPSG_3857
+from gibs import GibsAPI, get_tile_list
+
+logger = get_logger(__name__)
+
+TILE_BUNDLE_ENV_VAR = "MODIS_TILE_BUNDLE"
+# Upper limit of the memory mapped part of the file, pages are only mapped when read
+MMAP_SIZE = 2**40
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS capabilities (
+    crs TEXT PRIMARY KEY,
+    content BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    crs TEXT NOT NULL,
+    layer TEXT NOT NULL,
+    date TEXT NOT NULL,
+    zoom INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (crs, layer, date, zoom, y, x, format)
+);
+CREATE TABLE IF NOT EXISTS quicklooks (
+    layer TEXT NOT NULL,
+    date TEXT NOT NULL,
+    bbox TEXT NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (layer, date, bbox)
+);
+"""
+
+
+def bbox_key(bbox: Sequence[float]) -> str:
+    return ",".join(f"{coord:.6f}" for coord in bbox)
+
+
+class TileBundle:
+    def __init__(self, path: Path, writable: bool = False):
+        """
+        :param path: The bundle file
+        :param writable: Opens the bundle for packing, creating it if needed; the
+            bundle then has the interface of `TileCache`
+        """
+        self.path = Path(path)
+        self.writable = writable
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if writable:
+            # Packing threads share one connection
+            self._shared = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            self._shared.executescript(SCHEMA)
+        elif not self.path.is_file():
+            raise FileNotFoundError(f"Tile bundle {self.path} does not exist")
+
+    @classmethod
+    def from_env(cls) -> Optional["TileBundle"]:
+        """
+        Bundle configured by environment, None if not configured
+        """
+        path = os.environ.get(TILE_BUNDLE_ENV_VAR)
+        if not path:
+            return None
+        return cls(Path(path))
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Read-only, memory mapped connection of the current thread
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # The bundle is not modified while it is read
+            connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro&immutable=1", uri=True
+            )
+            connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql: str, parameters: tuple) -> Optional[tuple]:
+        """
+        First row of a statement
+        """
+        if self.writable:
+            with self._lock:
+                return self._shared.execute(sql, parameters).fetchone()
+        return self._connection().execute(sql, parameters).fetchone()
+
+    def _get(self, sql: str, parameters: tuple) -> Optional[bytes]:
+        row = self._execute(sql, parameters)
+        return bytes(row[0]) if row is not None else None
+
+    def has_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        crs: str = EPSG_3857,
+    ) -> bool:
+        row = self._execute(
+            "SELECT 1 FROM tiles WHERE crs=? AND layer=? AND date=? AND zoom=? "
+            "AND y=? AND x=? AND format=?",
+            (crs, layer, date, tile.z, tile.y, tile.x, img_format),
+        )
+        return row is not None
+
+    def get_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        crs: str = EPSG_3857,
+    ) -> Optional[bytes]:
+        return self._get(
+            "SELECT content FROM tiles WHERE crs=? AND layer=? AND date=? AND zoom=? "
+            "AND y=? AND x=? AND format=?",
+            (crs, layer, date, tile.z, tile.y, tile.x, img_format),
+        )
+
+    def put_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        content: bytes,
+        crs: str = EPSG_3857,
+    ):
+        self._execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (crs, layer, date, tile.z, tile.x, tile.y, img_format, content),
+        )
+
+    def get_capabilities(self, crs: str = EPSG_3857) -> Optional[bytes]:
+        return self._get("SELECT content FROM capabilities WHERE crs=?", (crs,))
+
+    def put_capabilities(self, content: bytes, crs: str = EPSG_3857):
+        self._execute(
+            "INSERT OR REPLACE INTO capabilities VALUES (?, ?)", (crs, content)
+        )
+
+    def get_quicklook(self, layer: str, date: str, bbox: Sequence[float]):
+        return self._get(
+            "SELECT content FROM quicklooks WHERE layer=? AND date=? AND bbox=?",
+            (layer, date, bbox_key(bbox)),
+        )
+
+    def put_quicklook(
+        self, layer: str, date: str, bbox: Sequence[float], content: bytes
+    ):
+        self._execute(
+            "INSERT OR REPLACE INTO quicklooks VALUES (?, ?, ?, ?)",
+            (layer, date, bbox_key(bbox), content),
+        )
+
+    def close(self):
+        """
+        Closes the connection of the current thread, or of the packing threads
+        """
+        if self.writable:
+            self._shared.close()
+            return
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def pack(
+    bundle: TileBundle,
+    api: GibsAPI,
+    geometries: List[dict],
+    layers: List[str],
+    dates: List[str],
+    zoom_level: int,
+    max_workers: int = 8,
+    rate: float = 20.0,
+) -> Tuple[int, int, int]:
+    """
+    Packs the catalog, the tiles and the quicklooks a fetch of the geometries requests
+    into a writable bundle. Content already in the bundle is not downloaded again.
+
+    :return: Number of downloaded, already packed and failed tiles
+    """
+    # pylint: disable=import-outside-toplevel
+    from prefetch import prefetch
+
+    user_tile_cache = api.tile_cache
+    api.tile_cache = bundle
+    try:
+        result = prefetch(
+            api,
+            geometries,
+            layers,
+            dates,
+            zoom_level=zoom_level,
+            max_workers=max_workers,
+            rate=rate,
+        )
+    finally:
+        api.tile_cache = user_tile_cache
+
+    for geometry in geometries:
+        tile_list = get_tile_list(
+            shapely.geometry.shape(geometry).bounds, geometry, zoom_level
+        )
+        # The bounds of the quicklooks of a fetch, see `Modis.fetch_date`
+        bbox = tiles_to_geom(tile_list).bounds
+        for layer in layers:
+            for date in dates:
+                if bundle.get_quicklook(layer, date, bbox) is not None:
+                    continue
+                try:
+                    response = api.download_quicklook(layer, bbox, date)
+                except requests.exceptions.HTTPError as err:
+                    logger.warning(f"Quicklook of {layer} on {date} failed: {err}")
+                    continue
+                bundle.put_quicklook(layer, date, bbox, response.content)
+    return result
+
+
+def main(argv=None) -> int:
+    # pylint: disable=import-outside-toplevel
+    from modis import DEFAULT_IMAGERY_LAYER, DEFAULT_ZOOM_LEVEL
+    from prefetch import get_prefetch_dates, load_geometries
+
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument(
+        "--geometries",
+        type=Path,
+        required=True,
+        help="GeoJSON file (FeatureCollection, Feature or Geometry) with the AOIs",
+    )
+    arg_parser.add_argument(
+        "--layers",
+        default=DEFAULT_IMAGERY_LAYER,
+        help="Comma separated list of imagery layers",
+    )
+    arg_parser.add_argument("--start", required=True, help="First date (YYYY-MM-DD)")
+    arg_parser.add_argument("--end", required=True, help="Last date (YYYY-MM-DD)")
+    arg_parser.add_argument("--zoom-level", type=int, default=DEFAULT_ZOOM_LEVEL)
+    arg_parser.add_argument("--workers", type=int, default=8)
+    arg_parser.add_argument(
+        "--rate", type=float, default=20.0, help="Maximum requests per second"
+    )
+    arg_parser.add_argument("--output", type=Path, required=True, help="Bundle file")
+    args = arg_parser.parse_args(argv)
+
+    bundle = TileBundle(args.output, writable=True)
+    downloaded, packed, failed = pack(
+        bundle,
+        GibsAPI(),
+        load_geometries(args.geometries),
+        args.layers.split(","),
+        get_prefetch_dates(args.start, args.end),
+        zoom_level=args.zoom_level,
+        max_workers=args.workers,
+        rate=args.rate,
+    )
+    bundle.close()
+    logger.info(f"Downloaded {downloaded}, already packed {packed}, failed {failed}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
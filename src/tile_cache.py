@@ -0,0 +1,188 @@
+"""
+On-disk cache for GIBS tiles and the WMTS capabilities document.
+
+The cache is used when the `MODIS_CACHE_DIR` environment variable points to a
+(persistent) directory. Tiles are stored as the original payloads under
+`tiles/<layer>/<date>/<z>/<y>/<x>.<format>`, geographic (EPSG:4326) tiles under
+`tiles_epsg4326/`.
+"""
+
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import mercantile
+import requests
+
+from blockutils.logging import get_logger
+
+from geographic import EPSG_3857
+
+logger = get_logger(__name__)
+
+CACHE_DIR_ENV_VAR = "MODIS_CACHE_DIR"
+CAPABILITIES_MAX_AGE_ENV_VAR = "MODIS_CAPABILITIES_MAX_AGE"
+DEFAULT_CAPABILITIES_MAX_AGE = 24 * 60 * 60
+
+
+def cached_response(content: bytes, url: str = "") -> requests.Response:
+    """
+    Wraps cached content into a successful requests.Response
+    """
+    response = requests.Response()
+    # pylint: disable=protected-access
+    response._content = content
+    response._content_consumed = True
+    response.status_code = 200
+    response.url = url
+    return response
+
+
+def write_atomic(path: Path, content: bytes):
+    """
+    Writes via a temporary file and rename, so concurrent readers never see
+    partially written files
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as out:
+        out.write(content)
+    os.replace(tmp_path, path)
+
+
+def _crs_dirname(name: str, crs: str) -> str:
+    """
+    Web Mercator entries keep the unsuffixed names of earlier versions of the cache
+    """
+    if crs == EPSG_3857:
+        return name
+    return f"{name}_{crs.replace(':', '').lower()}"
+
+
+class TileCache:
+    def __init__(
+        self,
+        cache_dir: Path,
+        capabilities_max_age: float = DEFAULT_CAPABILITIES_MAX_AGE,
+    ):
+        """
+        :param cache_dir: Root directory of the cache
+        :param capabilities_max_age: Seconds after which the cached capabilities are refreshed
+        """
+        self.cache_dir = Path(cache_dir)
+        self.capabilities_max_age = capabilities_max_age
+
+    @classmethod
+    def from_env(cls) -> Optional["TileCache"]:
+        """
+        Cache configured by environment, None if caching is not configured
+        """
+        cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+        if not cache_dir:
+            return None
+        max_age = float(
+            os.environ.get(CAPABILITIES_MAX_AGE_ENV_VAR, DEFAULT_CAPABILITIES_MAX_AGE)
+        )
+        return cls(Path(cache_dir), capabilities_max_age=max_age)
+
+    def tile_path(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        crs: str = EPSG_3857,
+    ) -> Path:
+        return (
+            self.cache_dir
+            / _crs_dirname("tiles", crs)
+            / layer
+            / date
+            / str(tile.z)
+            / str(tile.y)
+            / f"{tile.x}.{img_format}"
+        )
+
+    def has_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        crs: str = EPSG_3857,
+    ) -> bool:
+        return self.tile_path(tile, layer, date, img_format, crs).is_file()
+
+    def get_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        crs: str = EPSG_3857,
+    ) -> Optional[bytes]:
+        try:
+            return self.tile_path(tile, layer, date, img_format, crs).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def prune(self, max_bytes: int) -> int:
+        """
+        Removes the oldest cached tiles until the tiles take at most max_bytes
+
+        :return: The number of removed tiles
+        """
+        tiles = []
+        for tiles_dir in self.cache_dir.glob("tiles*"):
+            for path in tiles_dir.rglob("*"):
+                if path.is_file():
+                    stat = path.stat()
+                    tiles.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in tiles)
+        removed = 0
+        for _, size, path in sorted(tiles):
+            if total <= max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} tiles from the cache")
+        return removed
+
+    def put_tile(
+        self,
+        tile: mercantile.Tile,
+        layer: str,
+        date: str,
+        img_format: str,
+        content: bytes,
+        crs: str = EPSG_3857,
+    ):
+        write_atomic(self.tile_path(tile, layer, date, img_format, crs), content)
+
+    @property
+    def capabilities_path(self) -> Path:
+        return self.get_capabilities_path(EPSG_3857)
+
+    def get_capabilities_path(self, crs: str) -> Path:
+        return self.cache_dir / (_crs_dirname("WMTSCapabilities", crs) + ".xml")
+
+    def get_capabilities(self, crs: str = EPSG_3857) -> Optional[bytes]:
+        """
+        The cached capabilities document, None if missing or outdated
+        """
+        capabilities_path = self.get_capabilities_path(crs)
+        try:
+            age = time.time() - capabilities_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if age > self.capabilities_max_age:
+            logger.info("Cached capabilities are outdated")
+            return None
+        return capabilities_path.read_bytes()
+
+    def put_capabilities(self, content: bytes, crs: str = EPSG_3857):
+        write_atomic(self.get_capabilities_path(crs), content)
@@ -0,0 +1,329 @@
+"""
+Long-lived worker running block jobs from a spool directory.
+
+A block run (`run.py`) handles a single job and exits, so every job pays for starting
+the interpreter, the imports, the capabilities download and new connections. A `Worker`
+stays resident and runs the jobs submitted to a spool directory one after another on
+shared warm state: the imported modules, the layer catalogs (refreshed as in
+`GibsAPI.catalog`), the HTTP connection pool (the HTTP/2 transport if `MODIS_HTTP2` is
+set, see `http2_transport`) and the tile cache (`MODIS_CACHE_DIR`, by default
+`<spool>/cache`), whose oldest tiles are removed after a job once it exceeds
+`max_cache_mb`.
+
+Every job writes the same outputs as a block run, but into directories of its own
+(`output/` and `quicklooks/` of `<spool>/running/<job>/`) instead of `/tmp/output` and
+`/tmp/quicklooks`, which are moved to its result directory afterwards.
+
+    <spool>/queue/<job>.json    submitted jobs, run in the order of their names
+    <spool>/running/<job>.json  the job being run
+    <spool>/done/<job>/         output/, quicklooks/ and status.json of a job
+    <spool>/failed/<job>/       the same for failed jobs, status.json has the exit code
+
+A job file holds the query (the task parameters of a block run) and whether to dry run,
+`submit` writes one with an id that sorts by submission time:
+
+    python src/worker.py submit --spool-dir /var/spool/modis --query query.json
+    python src/worker.py run --spool-dir /var/spool/modis
+
+One worker runs per spool directory, it holds a lock on it while running.
+SIGTERM stops the worker after the current job; jobs left running by a killed worker
+are queued again when it restarts.
+"""
+
+import argparse
+import fcntl
+import json
+import shutil
+import signal
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+from blockutils.stac import STACQuery
+
+from checkpoint import CHECKPOINT_DIRNAME
+from gibs import GibsAPI, HttpTransport
+from http2_transport import DEFAULT_MAX_CONCURRENCY, Http2Transport
+from modis import Modis
+from tile_bundle import TileBundle
+from tile_cache import TileCache, write_atomic
+
+logger = get_logger(__name__)
+
+QUEUE_DIR = "queue"
+RUNNING_DIR = "running"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+STATUS_FILENAME = "status.json"
+LOCK_FILENAME = "worker.lock"
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_MAX_CACHE_MB = 4096
+
+
+def submit_job(spool_dir: Path, query: dict, dry_run: bool = False) -> str:
+    """
+    Queues a job
+
+    :return: The job id
+    """
+    job_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    write_atomic(
+        Path(spool_dir) / QUEUE_DIR / f"{job_id}.json",
+        json.dumps({"query": query, "dry_run": dry_run}).encode(),
+    )
+    return job_id
+
+
+def job_status(spool_dir: Path, job_id: str) -> Optional[dict]:
+    """
+    Status of a finished job, None while it is queued or running
+    """
+    for result_dir in (DONE_DIR, FAILED_DIR):
+        path = Path(spool_dir) / result_dir / job_id / STATUS_FILENAME
+        if path.is_file():
+            with open(path, encoding="utf-8") as src:
+                return json.load(src)
+    return None
+
+
+def exit_code(err: Exception) -> int:
+    """
+    Exit code of a block run failing with err, see `blockutils.exceptions`
+    """
+    if isinstance(err, UP42Error):
+        return err.error_code.value
+    if isinstance(err, MemoryError):
+        return 137
+    return 1
+
+
+class Worker:
+    def __init__(
+        self,
+        spool_dir: Path,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        wmts_url: Optional[str] = None,
+        wms_url: Optional[str] = None,
+        max_cache_mb: Optional[int] = DEFAULT_MAX_CACHE_MB,
+    ):
+        """
+        :param spool_dir: The spool directory, created if needed
+        :param poll_interval: Seconds between looks into an empty queue
+        :param wmts_url: The WMTS endpoint, GIBS by default
+        :param wms_url: The WMS endpoint, GIBS by default
+        :param max_cache_mb: Size of the cached tiles kept after a job, None for no
+            limit
+        """
+        self.spool_dir = Path(spool_dir)
+        for name in (QUEUE_DIR, RUNNING_DIR, DONE_DIR, FAILED_DIR):
+            (self.spool_dir / name).mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval
+        self.max_cache_mb = max_cache_mb
+        self.stopping = False
+        self.jobs_run = 0
+        # Warm state shared by all jobs: the catalogs, tile cache, bundle, transport
+        # and endpoints of this API are handed to the API of every job
+        transport = Http2Transport.from_env()
+        if transport is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=4, pool_maxsize=DEFAULT_MAX_CONCURRENCY
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            transport = HttpTransport(session)
+        self.warm_api = GibsAPI(
+            tile_cache=TileCache.from_env() or TileCache(self.spool_dir / "cache"),
+            tile_bundle=TileBundle.from_env(),
+            transport=transport,
+        )
+        if wmts_url is not None:
+            self.warm_api.wmts_url = wmts_url
+        if wms_url is not None:
+            self.warm_api.wms_url = wms_url
+
+    def api(self) -> GibsAPI:
+        """
+        `GibsAPI` of a job, on the warm state of the worker
+        """
+        api = GibsAPI(
+            tile_cache=self.warm_api.tile_cache,
+            tile_bundle=self.warm_api.tile_bundle,
+            transport=self.warm_api.transport,
+        )
+        api.catalogs = self.warm_api.catalogs
+        api.wmts_url = self.warm_api.wmts_url
+        api.wms_url = self.warm_api.wms_url
+        return api
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Holds the spool directory for this worker
+        """
+        with open(self.spool_dir / LOCK_FILENAME, "w", encoding="utf-8") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError as err:
+                raise UP42Error(
+                    SupportedErrors.INPUT_PARAMETERS_ERROR,
+                    f"Another worker is running on {self.spool_dir}.",
+                ) from err
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def recover(self):
+        """
+        Queues the jobs left running by a stopped worker again
+        """
+        running_dir = self.spool_dir / RUNNING_DIR
+        for job_path in sorted(running_dir.glob("*.json")):
+            logger.info(f"Queueing job {job_path.stem} again, its worker stopped")
+            job_path.rename(self.spool_dir / QUEUE_DIR / job_path.name)
+        for partial_dir in running_dir.iterdir():
+            if partial_dir.is_dir():
+                shutil.rmtree(partial_dir)
+
+    def next_job(self) -> Optional[Path]:
+        """
+        Claims the first queued job
+        """
+        for job_path in sorted((self.spool_dir / QUEUE_DIR).glob("*.json")):
+            claimed = self.spool_dir / RUNNING_DIR / job_path.name
+            try:
+                job_path.rename(claimed)
+            except FileNotFoundError:
+                # Withdrawn in the meantime
+                continue
+            return claimed
+        return None
+
+    def run_job(self, job_path: Path) -> dict:
+        """
+        Runs a claimed job in its own output directories and moves them and its status
+        to its result directory
+
+        :return: The status of the job
+        """
+        job_id = job_path.stem
+        logger.info(f"Running job {job_id}")
+        staging_dir = self.spool_dir / RUNNING_DIR / job_id
+        output_dir = staging_dir / "output"
+        quicklook_dir = staging_dir / "quicklooks"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        quicklook_dir.mkdir(parents=True, exist_ok=True)
+        status = {"job_id": job_id, "exit_code": 0}
+        start = time.perf_counter()
+        try:
+            with open(job_path, encoding="utf-8") as src:
+                job = json.load(src)
+            Modis(
+                api=self.api(), output_dir=output_dir, quicklook_dir=quicklook_dir
+            ).run_query(STACQuery.from_dict(job["query"]), job.get("dry_run", False))
+        except Exception as err:  # pylint: disable=broad-except
+            logger.exception(f"Job {job_id} failed")
+            status.update(exit_code=exit_code(err), error=str(err))
+        status["seconds"] = round(time.perf_counter() - start, 4)
+
+        # Nothing resumes the journal of a failed job
+        shutil.rmtree(output_dir / CHECKPOINT_DIRNAME, ignore_errors=True)
+        write_atomic(staging_dir / STATUS_FILENAME, json.dumps(status).encode())
+        result_dir = (
+            self.spool_dir / (FAILED_DIR if status["exit_code"] else DONE_DIR) / job_id
+        )
+        if result_dir.exists():
+            shutil.rmtree(result_dir)
+        staging_dir.rename(result_dir)
+        job_path.unlink()
+        logger.info(f"Job {job_id} finished in {status['seconds']}s: {status}")
+        return status
+
+    def serve(
+        self, max_jobs: Optional[int] = None, exit_when_idle: bool = False
+    ) -> int:
+        """
+        Runs the queued jobs until stopped, after max_jobs or, with exit_when_idle,
+        once the queue is empty
+
+        :return: The number of jobs run
+        """
+        with self.lock():
+            self.recover()
+            while not self.stopping and (max_jobs is None or self.jobs_run < max_jobs):
+                job_path = self.next_job()
+                if job_path is None:
+                    if exit_when_idle:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                self.run_job(job_path)
+                self.jobs_run += 1
+                if self.max_cache_mb is not None:
+                    self.warm_api.tile_cache.prune(self.max_cache_mb * 2**20)
+        return self.jobs_run
+
+    def stop(self, *_):
+        """
+        Stops the worker after the current job, usable as signal handler
+        """
+        logger.info("Stopping after the current job")
+        self.stopping = True
+
+
+def main(argv=None) -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    arg_parser.add_argument("step", choices=["submit", "run"])
+    arg_parser.add_argument("--spool-dir", type=Path, required=True)
+    arg_parser.add_argument(
+        "--query", type=Path, default=None, help="JSON file with the query (submit)"
+    )
+    arg_parser.add_argument("--dry-run", action="store_true", help="(submit)")
+    arg_parser.add_argument(
+        "--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="(run)"
+    )
+    arg_parser.add_argument("--max-jobs", type=int, default=None, help="(run)")
+    arg_parser.add_argument(
+        "--exit-when-idle", action="store_true", help="Stop once the queue is empty"
+    )
+    arg_parser.add_argument("--wmts-url", default=None, help="WMTS endpoint (run)")
+    arg_parser.add_argument("--wms-url", default=None, help="WMS endpoint (run)")
+    arg_parser.add_argument(
+        "--max-cache-mb",
+        type=int,
+        default=DEFAULT_MAX_CACHE_MB,
+        help="Size of the tile cache kept between jobs (run)",
+    )
+    args = arg_parser.parse_args(argv)
+
+    if args.step == "submit":
+        if args.query is None:
+            arg_parser.error("submit requires --query")
+        with open(args.query, encoding="utf-8") as src:
+            print(submit_job(args.spool_dir, json.load(src), args.dry_run))
+        return 0
+
+    worker = Worker(
+        args.spool_dir,
+        args.poll_interval,
+        args.wmts_url,
+        args.wms_url,
+        args.max_cache_mb,
+    )
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.serve(args.max_jobs, args.exit_when_idle)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
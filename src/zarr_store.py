@@ -0,0 +1,286 @@
+"""
+Chunked Zarr output for time series.
+
+With `"output_format": "zarr"` the mosaics of all dates are written into one Zarr (v2)
+directory store instead of one GeoTIFF per date. The store holds a `data` array laid out
+as (time, band, y, x), chunked per date and band in blocks of 512 x 512 pixels and
+compressed with zlib, together with the coordinate arrays `time`, `band`, `y` and `x`
+and the provenance of every band (`layer`, `layer_band`, see `make_list_layer_band`).
+Dimension names follow the xarray convention, so the store opens with
+`xarray.open_zarr`.
+
+The grid of the store is the tile grid of the AOI, a date's mosaic is placed at its
+offset in the grid. Dates are appended in the order they are written, only the chunks of
+the new date and the updated array metadata are written, earlier chunks are never
+rewritten.
+"""
+
+import json
+import zlib
+from datetime import date as Date
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+from blockutils.logging import get_logger
+
+from tile_cache import write_atomic
+
+logger = get_logger(__name__)
+
+ZARR_STORE_NAME = "modis.zarr"
+DATA_ARRAY = "data"
+CHUNK_SIZE = 512
+EPOCH = Date(1970, 1, 1)
+
+
+def _array_metadata(
+    shape: Sequence[int],
+    chunks: Sequence[int],
+    dtype: str,
+    compression_level: Optional[int] = None,
+    fill_value: Optional[int] = None,
+) -> dict:
+    return {
+        "zarr_format": 2,
+        "shape": list(shape),
+        "chunks": list(chunks),
+        "dtype": dtype,
+        "compressor": (
+            {"id": "zlib", "level": compression_level}
+            if compression_level is not None
+            else None
+        ),
+        "fill_value": fill_value,
+        "order": "C",
+        "filters": None,
+        "dimension_separator": ".",
+    }
+
+
+class ZarrTimeSeries:
+    def __init__(self, path: Path):
+        """
+        Opens an existing store, see `create_or_open`
+        """
+        self.path = Path(path)
+        self.attrs = self._read_json(self.path / ".zattrs")
+        self.metadata = self._read_json(self.path / DATA_ARRAY / ".zarray")
+        self.dates: List[str] = self.attrs["dates"]
+        self.transform = Affine(*self.attrs["transform"])
+        self.count, self.height, self.width = self.metadata["shape"][1:]
+
+    @staticmethod
+    def _read_json(path: Path) -> dict:
+        with open(path, encoding="utf-8") as src:
+            return json.load(src)
+
+    @staticmethod
+    def _write_json(path: Path, content: dict):
+        write_atomic(path, json.dumps(content, indent=2).encode())
+
+    @classmethod
+    def _write_array(
+        cls,
+        path: Path,
+        name: str,
+        values: np.ndarray,
+        dims: List[str],
+        attrs: Optional[dict] = None,
+    ):
+        """
+        Writes a small, uncompressed, single chunk coordinate array
+        """
+        array_dir = path / name
+        cls._write_json(
+            array_dir / ".zarray",
+            _array_metadata(values.shape, values.shape, values.dtype.str),
+        )
+        cls._write_json(
+            array_dir / ".zattrs", {"_ARRAY_DIMENSIONS": dims, **(attrs or {})}
+        )
+        write_atomic(array_dir / ".".join(["0"] * values.ndim), values.tobytes())
+
+    @classmethod
+    def create_or_open(
+        cls,
+        path: Path,
+        transform: Affine,
+        width: int,
+        height: int,
+        crs: str,
+        bands: List[List],
+        compression_level: int = 5,
+    ) -> "ZarrTimeSeries":
+        """
+        Opens the store at path, or creates an empty store if there is none
+
+        :param transform: Transform of the grid of the store
+        :param bands: Provenance of the bands, as returned by `make_list_layer_band`
+        """
+        path = Path(path)
+        if (path / ".zgroup").is_file():
+            store = cls(path)
+            if (
+                store.transform != transform
+                or (store.width, store.height) != (width, height)
+                or store.attrs["bands"] != [list(band) for band in bands]
+            ):
+                raise UP42Error(
+                    SupportedErrors.INPUT_PARAMETERS_ERROR,
+                    f"The Zarr store {path} has a different grid or bands.",
+                )
+            return store
+
+        logger.info(f"Creating Zarr store {path}")
+        cls._write_json(path / ".zgroup", {"zarr_format": 2})
+        cls._write_array(
+            path,
+            "x",
+            transform.c + transform.a * (np.arange(width) + 0.5),
+            ["x"],
+        )
+        cls._write_array(
+            path,
+            "y",
+            transform.f + transform.e * (np.arange(height) + 0.5),
+            ["y"],
+        )
+        cls._write_array(path, "band", np.array([band[0] for band in bands]), ["band"])
+        cls._write_array(
+            path, "layer", np.array([band[1] for band in bands], dtype=str), ["band"]
+        )
+        cls._write_array(
+            path, "layer_band", np.array([band[2] for band in bands]), ["band"]
+        )
+        cls._write_json(
+            path / DATA_ARRAY / ".zarray",
+            _array_metadata(
+                (0, len(bands), height, width),
+                (1, 1, CHUNK_SIZE, CHUNK_SIZE),
+                "|u1",
+                compression_level,
+                fill_value=0,
+            ),
+        )
+        cls._write_json(
+            path / DATA_ARRAY / ".zattrs",
+            {"_ARRAY_DIMENSIONS": ["time", "band", "y", "x"], "crs": crs},
+        )
+        cls._write_json(
+            path / ".zattrs",
+            {
+                "crs": crs,
+                "transform": list(transform)[:6],
+                "bands": [list(band) for band in bands],
+                "dates": [],
+            },
+        )
+        return cls(path)
+
+    def _chunk_path(self, index: Tuple[int, ...]) -> Path:
+        return self.path / DATA_ARRAY / ".".join(str(i) for i in index)
+
+    def _write_time(self):
+        days = np.array(
+            [(Date.fromisoformat(date) - EPOCH).days for date in self.dates],
+            dtype="<i4",
+        )
+        time_dir = self.path / "time"
+        self._write_json(
+            time_dir / ".zarray", _array_metadata(days.shape, (1,), days.dtype.str)
+        )
+        self._write_json(
+            time_dir / ".zattrs",
+            {
+                "_ARRAY_DIMENSIONS": ["time"],
+                "units": "days since 1970-01-01",
+                "calendar": "proleptic_gregorian",
+            },
+        )
+        # One chunk per date, so appending does not rewrite the earlier dates
+        write_atomic(time_dir / str(len(self.dates) - 1), days[-1:].tobytes())
+
+    def append(self, date: str, img_filename: Path) -> int:
+        """
+        Writes the mosaic of a date chunk by chunk. A date already in the store is
+        overwritten in place.
+
+        :return: The time index of the date
+        """
+        if date in self.dates:
+            index = self.dates.index(date)
+        else:
+            index = len(self.dates)
+        level = (self.metadata["compressor"] or {}).get("level")
+
+        with rio.open(img_filename) as src:
+            if src.count != self.count:
+                raise UP42Error(
+                    SupportedErrors.INPUT_PARAMETERS_ERROR,
+                    f"{img_filename} has {src.count} bands, the store {self.count}.",
+                )
+            col_off = int(round((src.transform.c - self.transform.c) / src.res[0]))
+            row_off = int(round((self.transform.f - src.transform.f) / src.res[1]))
+            for chunk_row in range(
+                row_off // CHUNK_SIZE, -(-(row_off + src.height) // CHUNK_SIZE)
+            ):
+                for chunk_col in range(
+                    col_off // CHUNK_SIZE, -(-(col_off + src.width) // CHUNK_SIZE)
+                ):
+                    data = src.read(
+                        window=Window(
+                            chunk_col * CHUNK_SIZE - col_off,
+                            chunk_row * CHUNK_SIZE - row_off,
+                            CHUNK_SIZE,
+                            CHUNK_SIZE,
+                        ),
+                        boundless=True,
+                        fill_value=0,
+                    )
+                    for band in range(self.count):
+                        write_atomic(
+                            self._chunk_path((index, band, chunk_row, chunk_col)),
+                            (
+                                zlib.compress(data[band].tobytes(), level)
+                                if level is not None
+                                else data[band].tobytes()
+                            ),
+                        )
+
+        if index == len(self.dates):
+            self.dates.append(date)
+            self.metadata["shape"][0] = len(self.dates)
+            self._write_json(self.path / DATA_ARRAY / ".zarray", self.metadata)
+            self._write_time()
+            self._write_json(self.path / ".zattrs", self.attrs)
+        logger.info(f"Date {date} written to {self.path} at time index {index}")
+        return index
+
+    def read(self, index: int) -> np.ndarray:
+        """
+        (band, y, x) array of the date at time index
+        """
+        compressed = self.metadata["compressor"] is not None
+        data = np.zeros((self.count, self.height, self.width), dtype=np.uint8)
+        for band in range(self.count):
+            for chunk_row in range(-(-self.height // CHUNK_SIZE)):
+                for chunk_col in range(-(-self.width // CHUNK_SIZE)):
+                    chunk_path = self._chunk_path((index, band, chunk_row, chunk_col))
+                    if not chunk_path.is_file():
+                        continue
+                    content = chunk_path.read_bytes()
+                    chunk = np.frombuffer(
+                        zlib.decompress(content) if compressed else content,
+                        dtype=np.uint8,
+                    ).reshape(CHUNK_SIZE, CHUNK_SIZE)
+                    rows = slice(chunk_row * CHUNK_SIZE, (chunk_row + 1) * CHUNK_SIZE)
+                    cols = slice(chunk_col * CHUNK_SIZE, (chunk_col + 1) * CHUNK_SIZE)
+                    target = data[band, rows, cols]
+                    target[:] = chunk[: target.shape[0], : target.shape[1]]
+        return data
@@ -0,0 +1,33 @@
+"""
+Fixtures shared by the test modules
+"""
+
+# pylint: disable=redefined-outer-name
+import os
+import re
+
+import pytest
+
+MOCK_DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mock_data")
+
+
+@pytest.fixture()
+def mock_image() -> bytes:
+    with open(os.path.join(MOCK_DATA_DIR, "tile.jpg"), "rb") as tile_file:
+        return tile_file.read()
+
+
+@pytest.fixture()
+def gibs_mock(requests_mock, mock_image):
+    """
+    GIBS serving the mock capabilities, and the mock tile for every tile and quicklook
+    """
+    with open(
+        os.path.join(MOCK_DATA_DIR, "available_imagery_layers.xml"), "rb"
+    ) as xml_file:
+        mock_xml = xml_file.read()
+
+    requests_mock.get(re.compile("WMTSCapabilities.xml"), content=mock_xml)
+    requests_mock.get(re.compile("wms.cgi"), content=mock_image)
+    requests_mock.get(re.compile("/best/MODIS_"), content=mock_image)
+    return requests_mock
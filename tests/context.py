@@ -1,6 +1,7 @@
 """
 Helper module allowing src modules to be imported into tests
 """
+
 # pylint: disable=wrong-import-position
 # pylint: disable=unused-import
 
@@ -14,10 +15,81 @@ from blockutils.stac import STACQuery
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
+from src.checkpoint import CheckpointJournal, query_key
+from src.chunking import (
+    TileChunk,
+    current_rss_mb,
+    max_chunk_tiles,
+    plan_chunks,
+    validate_memory_budget,
+    write_chunk,
+)
+from src.cogwriter import CogWriter
+from src.composite import (
+    composite_stack,
+    ndvi_bands,
+    validate_composite,
+    write_composite_quicklook,
+)
+from src.compression import (
+    COMPRESSION_PROFILES,
+    CogWorkerPool,
+    get_compression_profile,
+    to_cog,
+    write_multiband_tif,
+)
+from src.data_coverage import (
+    TileCoverage,
+    feature_coverage,
+    is_dropped,
+    valid_fraction,
+    validate_min_coverage,
+)
+from src import geographic
+from src.fetch_options import FetchOptions, set_query_defaults
 from src.gibs import (
+    REQUEST_TIMEOUT,
     GibsAPI,
+    HttpTransport,
+    LayerCatalog,
     extract_query_dates,
+    get_tile_grid,
+    get_tile_list,
     make_list_layer_band,
     move_dates_to_past,
+    validate_bands,
+)
+from src.http2_transport import Http2Transport
+from src.incremental import IncrementalManifest, incremental_key
+from src.jpeg_passthrough import (
+    is_passthrough_eligible,
+    jpeg_subsampling,
+    write_jpeg_passthrough_cog,
 )
+from src.metrics import Metrics
 from src.modis import Modis
+from src.mosaic import BufferPool
+from src.native_overviews import overview_tile_range, write_native_overviews
+from src.profiling import profile_job, profiling_enabled
+from src.prefetch import (
+    RateLimiter,
+    get_prefetch_dates,
+    get_prefetch_tiles,
+    load_geometries,
+    prefetch,
+)
+from src.progressive import latest_features, preview_level
+from src.sharding import (
+    Unit,
+    assemble,
+    load_plan,
+    plan_units,
+    run_worker,
+    unit_paths,
+    write_plan,
+)
+from src.streaming import FeatureCollectionWriter
+from src.tile_bundle import TileBundle, pack
+from src.tile_cache import TileCache
+from src.worker import Worker, job_status, submit_job
+from src.zarr_store import ZarrTimeSeries
@@ -0,0 +1,157 @@
+"""
+Tests for the asyncio client and fetch, against the local GIBS stand-in server
+"""
+
+# pylint: disable=wrong-import-order,wrong-import-position
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio as rio
+import requests
+
+from context import Modis, STACQuery
+
+from blockutils.exceptions import UP42Error
+
+# aiohttp is an optional dependency
+pytest.importorskip("aiohttp")
+
+from src.async_gibs import AsyncGibsClient
+
+from benchmarks.bench_fetch import make_query
+from benchmarks.gibs_stub_server import GibsStubServer
+
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+
+
+def test_async_client():
+    async def run(server):
+        async with AsyncGibsClient(
+            wmts_url=server.wmts_url, wms_url=server.wms_url
+        ) as client:
+            # One catalog for concurrent queries
+            catalogs = await asyncio.gather(client.get_catalog(), client.get_catalog())
+            assert catalogs[0] is catalogs[1]
+            assert catalogs[0].get(LAYER)["Format"] == "jpeg"
+            assert b"Capabilities" in await client.get_capabilities()
+
+            tiles = await asyncio.gather(
+                *(
+                    client.get_tile(mercantile.Tile(x, 178, 9), LAYER, "2019-06-30")
+                    for x in range(270, 274)
+                )
+            )
+            assert all(tile == server.tile for tile in tiles)
+            quicklook = await client.get_quicklook(LAYER, [0, 0, 1, 1], "2019-06-30")
+            assert quicklook == server.tile
+
+            server.error_rate = 1.0
+            with pytest.raises(UP42Error):
+                await client.get_tile(mercantile.Tile(270, 178, 9), LAYER, "2019-06-30")
+            with pytest.raises(requests.exceptions.HTTPError):
+                await client.get_quicklook(LAYER, [0, 0, 1, 1], "2019-06-30")
+
+    with GibsStubServer() as server:
+        asyncio.run(run(server))
+
+
+def test_fetch_async_matches_fetch():
+    query = make_query({"aoi_tiles": 2, "layers": 2, "dates": 2})
+    other_query = make_query({"aoi_tiles": 3, "layers": 1, "dates": 1})
+    modis_async = Modis()
+
+    async def run(server):
+        async with AsyncGibsClient(
+            wmts_url=server.wmts_url, wms_url=server.wms_url
+        ) as client:
+            return await asyncio.gather(
+                modis_async.fetch_async(STACQuery.from_dict(query), client=client),
+                Modis().fetch_async(STACQuery.from_dict(other_query), client=client),
+            )
+
+    with GibsStubServer(latency=0.01) as server:
+        result, other_result = asyncio.run(run(server))
+        modis = Modis()
+        modis.api.wmts_url = server.wmts_url
+        modis.api.wms_url = server.wms_url
+        expected = modis.fetch(STACQuery.from_dict(query), dry_run=False)
+
+    assert len(result.features) == 2
+    assert len(other_result.features) == 1
+    for feature, expected_feature in zip(result.features, expected.features):
+        with rio.open(
+            modis_async.output_dir / feature["properties"]["up42.data_path"]
+        ) as src, rio.open(
+            "/tmp/output/%s" % expected_feature["properties"]["up42.data_path"]
+        ) as expected_src:
+            assert src.profile == expected_src.profile
+            np.testing.assert_array_equal(src.read(), expected_src.read())
+
+
+def test_fetch_async_concurrent_queries_keep_their_outputs():
+    queries = [
+        make_query({"aoi_tiles": 2, "layers": 1, "dates": 2}),
+        make_query({"aoi_tiles": 3, "layers": 1, "dates": 1}),
+    ]
+    instances = [Modis(), Modis()]
+
+    async def run(server):
+        async with AsyncGibsClient(
+            wmts_url=server.wmts_url, wms_url=server.wms_url
+        ) as client:
+            return await asyncio.gather(
+                *(
+                    modis.fetch_async(
+                        STACQuery.from_dict({**query, "include_metrics": True}),
+                        client=client,
+                    )
+                    for modis, query in zip(instances, queries)
+                )
+            )
+
+    with GibsStubServer(latency=0.01) as server:
+        results = asyncio.run(run(server))
+
+    assert instances[0].output_dir != instances[1].output_dir
+    for modis, result, query in zip(instances, results, queries):
+        assert modis.output_dir.parent == Path("/tmp/output")
+        assert len(result.features) == query["limit"]
+        for feature in result.features:
+            assert (
+                modis.output_dir / feature["properties"]["up42.data_path"]
+            ).is_file()
+            assert (modis.quicklook_dir / f"{feature['id']}.jpg").is_file()
+        with open(modis.output_dir / "metrics.json", encoding="utf-8") as src:
+            metrics = json.load(src)
+        assert len(metrics["dates"]) == query["limit"]
+        assert all("metrics" in feature["properties"] for feature in result.features)
+        assert not (modis.output_dir / ".checkpoint").exists()
+
+
+def test_fetch_async_cancel():
+    query = STACQuery.from_dict(make_query({"aoi_tiles": 3, "layers": 1, "dates": 1}))
+
+    async def run(server):
+        async with AsyncGibsClient(
+            wmts_url=server.wmts_url, wms_url=server.wms_url
+        ) as client:
+            fetch = asyncio.ensure_future(Modis().fetch_async(query, client=client))
+            while server.requests_served == 0:
+                await asyncio.sleep(0.01)
+            start = time.perf_counter()
+            fetch.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await fetch
+            # The in-flight request was cancelled, not waited for
+            assert time.perf_counter() - start < server.latency / 2
+            # The worker thread stopped, no request follows
+            await asyncio.sleep(0.2)
+            assert server.requests_served == 1
+
+    with GibsStubServer(latency=2.0) as server:
+        asyncio.run(run(server))
@@ -0,0 +1,145 @@
+"""
+Tests for the benchmark harness and its local GIBS stand-in server
+"""
+
+# pylint: disable=wrong-import-order
+import subprocess
+import sys
+
+import mercantile
+import requests
+
+from context import STACQuery, Modis
+
+from benchmarks.bench_compression import FIXTURE_TILE, run_profiles
+from benchmarks.bench_fetch import aoi_bbox, compare, make_query
+from benchmarks.bench_http2 import run_transports
+from benchmarks.bench_merge import run_merges
+from benchmarks.bench_progressive import run_progressive
+from benchmarks.bench_startup import REPO_DIR, run_startup
+from benchmarks.bench_worker import run_worker_benchmark
+from benchmarks.gibs_stub_server import GibsStubServer
+
+
+def test_stub_server_serves_capabilities_and_tiles():
+    with GibsStubServer() as server:
+        capabilities = requests.get(
+            server.wmts_url + "/epsg3857/best/1.0.0/WMTSCapabilities.xml"
+        )
+        tile = requests.get(server.wmts_url + "/epsg3857/best/layer/9/1/1.jpg")
+
+    assert capabilities.status_code == 200
+    assert b"Capabilities" in capabilities.content
+    assert tile.status_code == 200
+    assert tile.headers["Content-Type"] == "image/jpeg"
+
+
+def test_stub_server_error_rate():
+    with GibsStubServer(error_rate=1.0) as server:
+        tile = requests.get(server.wmts_url + "/epsg3857/best/layer/9/1/1.jpg")
+    assert tile.status_code == 500
+    assert server.requests_served == 1
+
+
+def test_aoi_bbox_covers_exact_tiles():
+    tiles = list(mercantile.tiles(*aoi_bbox(3), zooms=9))
+    assert len(tiles) == 9
+
+
+def test_fetch_against_stub_server():
+    case = {"aoi_tiles": 2, "layers": 2, "dates": 2}
+    modis = Modis()
+    with GibsStubServer() as server:
+        modis.api.wmts_url = server.wmts_url
+        modis.api.wms_url = server.wms_url
+        result = modis.fetch(STACQuery.from_dict(make_query(case)), dry_run=True)
+
+    assert len(result.features) == 2
+
+
+def test_compare_flags_regressions():
+    baseline = {
+        "results": [
+            {"id": "a", "status": "ok", "seconds": 1.0, "peak_rss_mb": 100},
+            {"id": "b", "status": "ok", "seconds": 1.0, "peak_rss_mb": 100},
+        ]
+    }
+    current = {
+        "results": [
+            {"id": "a", "status": "ok", "seconds": 1.1, "peak_rss_mb": 100},
+            {"id": "b", "status": "ok", "seconds": 1.5, "peak_rss_mb": 100},
+            {"id": "c", "status": "ok", "seconds": 9.0, "peak_rss_mb": 100},
+        ]
+    }
+    assert compare(current, baseline, threshold=0.2) == ["b"]
+
+
+def test_compression_benchmark():
+    results = run_profiles([FIXTURE_TILE], size=2, repeat=1)["results"]
+
+    assert [result["profile"] for result in results] == ["fast", "balanced", "archival"]
+    sizes = {result["profile"]: result["cog_bytes"] for result in results}
+    assert sizes["archival"] < sizes["balanced"]
+
+
+def test_merge_benchmark():
+    results = {
+        result["merge"]: result for result in run_merges(size=2, repeat=1)["results"]
+    }
+
+    assert results["tile_files"]["temporary_files"] == 3
+    assert results["pooled"]["temporary_files"] == 0
+    assert results["pooled"]["pool_allocations"] == 1
+    assert results["pooled"]["peak_traced_mb"] < results["tile_files"]["peak_traced_mb"]
+
+
+def test_http2_benchmark():
+    results = {
+        result["transport"]: result
+        for result in run_transports(size=3, latency=0.02)["results"]
+    }
+
+    assert results["http1_blocking"]["connections"] == 9
+    assert results["http1_pooled"]["http2_connections"] == 0
+    assert results["http2"]["connections"] == results["http2"]["http2_connections"]
+    assert all(result["mb_received"] > 0 for result in results.values())
+
+
+def test_progressive_benchmark():
+    results = run_progressive(aoi_tiles=4, latency=0.0)["results"]
+
+    assert [result["progressive"] for result in results] == [False, True]
+    assert results[1]["first_feature_seconds"] < results[0]["first_feature_seconds"]
+    assert results[1]["requests"] > results[0]["requests"]
+
+
+def test_worker_benchmark():
+    results = run_worker_benchmark(jobs=2, latency=0.0)["results"]
+
+    assert [result["mode"] for result in results] == ["block_runs", "worker"]
+    assert results[0]["capabilities_downloads"] == 2
+    assert results[1]["capabilities_downloads"] == 1
+    assert results[1]["first_job_seconds"] > 0
+
+
+def test_startup_benchmark():
+    results = run_startup(repeat=1)["results"]
+
+    assert [result["id"] for result in results] == [
+        "import_seconds",
+        "dry_run_seconds",
+        "process_seconds",
+    ]
+    assert all(result["seconds"] > 0 for result in results)
+
+
+def test_block_import_is_lazy():
+    # Dependencies of optional features are imported on first use
+    script = (
+        f"import sys; sys.path.insert(0, {str(REPO_DIR / 'src')!r}); import run; "
+        "print(sorted({'PIL', 'multiprocessing'} & set(sys.modules)))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    assert completed.stdout.strip() == "[]"
@@ -0,0 +1,138 @@
+"""
+Unit tests for the per-date checkpoint journal and resuming of fetch jobs
+"""
+
+import os
+import re
+
+import pytest
+from geojson import Feature
+
+from context import CheckpointJournal, Modis, STACQuery, query_key
+
+from blockutils.exceptions import UP42Error
+
+QUERY = {
+    "zoom_level": 9,
+    "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+    "limit": 2,
+    "bbox": [
+        123.59349578619005,
+        -10.188159969024264,
+        123.70257586240771,
+        -10.113232998848046,
+    ],
+    "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+}
+
+
+def test_query_key():
+    query = STACQuery.from_dict(QUERY)
+    assert query_key(query, False) == query_key(STACQuery.from_dict(QUERY), False)
+    assert query_key(query, False) != query_key(query, True)
+    assert query_key(query, False) != query_key(
+        STACQuery.from_dict({**QUERY, "limit": 3}), False
+    )
+    assert query_key(query, False) == query_key(
+        STACQuery.from_dict({**QUERY, "compression_profile": "balanced"}), False
+    )
+    assert query_key(query, False) != query_key(
+        STACQuery.from_dict({**QUERY, "compression_profile": "archival"}), False
+    )
+
+
+def test_journal_record_and_resume(tmp_path):
+    (tmp_path / "abc.tif").write_bytes(b"")
+    feature = Feature(id="abc", properties={"up42.data_path": "abc.tif"})
+
+    journal = CheckpointJournal(tmp_path, "key")
+    assert not journal.resumable
+    assert journal.completed("2019-01-01") is None
+    journal.record("2019-01-01", feature)
+
+    resumed = CheckpointJournal(tmp_path, "key")
+    assert resumed.resumable
+    assert resumed.completed("2019-01-01") == feature
+
+    (tmp_path / "abc.tif").unlink()
+    assert resumed.completed("2019-01-01") is None
+
+
+def test_journal_of_other_query_is_discarded(tmp_path):
+    journal = CheckpointJournal(tmp_path, "key")
+    journal.record("2019-01-01", Feature(id="abc"))
+    journal.tile_cache.put_capabilities(b"<xml/>")
+
+    other = CheckpointJournal(tmp_path, "other-key")
+    assert other.completed("2019-01-01") is None
+    assert not (tmp_path / ".checkpoint").exists()
+
+
+def test_fetch_resumes_after_failure(gibs_mock, mock_image):
+    failing_date = re.compile("/default/2018-11-20/")
+    gibs_mock.get(failing_date, status_code=500)
+
+    query = STACQuery.from_dict(QUERY)
+    with pytest.raises(UP42Error):
+        Modis().fetch(query, dry_run=False)
+
+    journal = CheckpointJournal(
+        "/tmp/output",
+        query_key(STACQuery.from_dict(QUERY), False),
+    )
+    first_feature = journal.completed("2018-11-19")
+    assert first_feature is not None
+
+    gibs_mock.get(failing_date, content=mock_image)
+    gibs_mock.reset_mock()
+    result = Modis().fetch(STACQuery.from_dict(QUERY), dry_run=False)
+
+    assert len(result.features) == 2
+    assert result.features[0]["id"] == first_feature["id"]
+    tile_urls = [
+        request.url for request in gibs_mock.request_history if "wmts" in request.url
+    ]
+    assert tile_urls
+    assert not [url for url in tile_urls if "2018-11-19" in url]
+    assert not os.path.exists("/tmp/output/.checkpoint")
+
+
+def test_fetch_with_other_overviews_does_not_resume(gibs_mock):
+    gibs_mock.get(re.compile("/default/2018-11-20/"), status_code=500)
+    with pytest.raises(UP42Error):
+        Modis().fetch(STACQuery.from_dict(QUERY), dry_run=False)
+    assert os.path.exists("/tmp/output/.checkpoint")
+
+    gibs_mock.reset_mock()
+    with pytest.raises(UP42Error):
+        Modis().fetch(
+            STACQuery.from_dict({**QUERY, "native_overviews": True}), dry_run=False
+        )
+
+    assert [
+        request.url
+        for request in gibs_mock.request_history
+        if "/default/2018-11-19/" in request.url
+    ]
+    journal = CheckpointJournal(
+        "/tmp/output",
+        query_key(STACQuery.from_dict({**QUERY, "native_overviews": True}), False),
+    )
+    journal.clear()
+
+
+@pytest.mark.parametrize("checkpoint_tiles", [False, True])
+def test_fetch_checkpoints_tiles(gibs_mock, mock_image, checkpoint_tiles):
+    failing_date = re.compile("/default/2018-11-20/")
+    gibs_mock.get(failing_date, status_code=500)
+    query = {**QUERY, "checkpoint_tiles": checkpoint_tiles}
+    with pytest.raises(UP42Error):
+        Modis().fetch(STACQuery.from_dict(query), dry_run=False)
+
+    assert os.path.exists("/tmp/output/.checkpoint/journal.json")
+    assert os.path.exists("/tmp/output/.checkpoint/tiles") == checkpoint_tiles
+
+    # The checkpoint and its tiles are removed once the job completed
+    gibs_mock.get(failing_date, content=mock_image)
+    Modis().fetch(STACQuery.from_dict(QUERY), dry_run=False)
+    assert not os.path.exists("/tmp/output/.checkpoint")
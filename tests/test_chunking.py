@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from mercantile import Tile
+from rasterio.transform import from_origin
+
+from context import (
+    TileChunk,
+    current_rss_mb,
+    max_chunk_tiles,
+    plan_chunks,
+    validate_memory_budget,
+    write_chunk,
+)
+
+from blockutils.exceptions import UP42Error
+
+
+def test_max_chunk_tiles():
+    # 3 bands of 256 x 256 pixels, merged array and written copy
+    assert max_chunk_tiles(3, 3, 256) == 8
+    assert max_chunk_tiles(0, 3, 256) == 1
+    assert max_chunk_tiles(1024, 4, 512) == 512
+
+
+def test_plan_chunks():
+    tile_list = [Tile(x, y, 9) for y in range(10, 15) for x in range(20, 25)]
+    chunks = plan_chunks(tile_list, 8, align=2)
+    # Chunks of 4 x 2 tiles, the last column and row are partial
+    assert [(chunk.col_off, chunk.row_off, chunk.cols, chunk.rows) for chunk in chunks][
+        :3
+    ] == [(0, 0, 4, 2), (4, 0, 1, 2), (0, 2, 4, 2)]
+    assert len(chunks) == 6
+    assert sorted(tile for chunk in chunks for tile in chunk.tiles) == sorted(tile_list)
+    assert all(len(chunk.tiles) <= 8 for chunk in chunks)
+
+    # Everything fits into one chunk
+    assert len(plan_chunks(tile_list, 100, align=2)) == 1
+    # Fewer tiles than the alignment
+    chunks = plan_chunks(tile_list, 1, align=2)
+    assert len(chunks) == 25
+    assert chunks[1] == TileChunk(1, 0, 1, 1, [Tile(21, 10, 9)])
+
+
+def test_plan_chunks_sparse():
+    tile_list = [Tile(0, 0, 9), Tile(5, 0, 9), Tile(5, 3, 9)]
+    chunks = plan_chunks(tile_list, 4, align=2)
+    # Chunks without tiles are left out
+    assert [chunk.tiles for chunk in chunks] == [
+        [Tile(0, 0, 9)],
+        [Tile(5, 0, 9)],
+        [Tile(5, 3, 9)],
+    ]
+
+
+def test_validate_memory_budget():
+    validate_memory_budget(None)
+    validate_memory_budget(512)
+    with pytest.raises(UP42Error, match="memory_budget_mb"):
+        validate_memory_budget(0)
+
+
+def test_current_rss_mb():
+    assert current_rss_mb() > 0
+
+
+def test_write_chunk(tmp_path):
+    transform = from_origin(0, 8, 1, 1)
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "width": 8,
+        "height": 8,
+        "tiled": True,
+        "blockxsize": 16,
+        "blockysize": 16,
+    }
+    # Only the first tile of the chunk has data, in the first layer
+    layer = tmp_path / "layer.tif"
+    with rio.open(
+        layer,
+        "w",
+        **{**profile, "count": 2, "width": 2, "height": 2},
+        transform=from_origin(4, 6, 1, 1),
+    ) as dst:
+        dst.write(np.full((2, 2, 2), 7, dtype=np.uint8))
+
+    output = tmp_path / "output.tif"
+    with rio.open(output, "w", **profile, count=3, transform=transform) as dst:
+        write_chunk(
+            dst,
+            TileChunk(2, 1, 2, 1, [Tile(2, 1, 9), Tile(3, 1, 9)]),
+            [layer, None],
+            [2, 1],
+            tile_size=2,
+        )
+
+    with rio.open(output) as src:
+        data = src.read()
+    assert (data[:2, 2:4, 4:6] == 7).all()
+    assert data[2].sum() == 0
+    assert data.sum() == 2 * 4 * 7
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import rasterio as rio
+
+from context import composite_stack, ndvi_bands, validate_composite
+from context import write_composite_quicklook
+
+from blockutils.exceptions import UP42Error
+
+TRUE_COLOR = "MODIS_Terra_CorrectedReflectance_TrueColor"
+BANDS_721 = "MODIS_Terra_CorrectedReflectance_Bands721"
+
+
+@pytest.fixture()
+def stack():
+    """
+    Three dates of a 3 band, 1 x 4 pixel image. Date 2 has a gap in pixel 1, date 3
+    in pixels 1 and 2, no date has data in pixel 3.
+    """
+    stack = np.zeros((3, 3, 1, 4), dtype=np.uint8)
+    stack[0, :, 0, :3] = [[10], [20], [30]]
+    stack[1, :, 0, 0] = [50, 60, 70]
+    stack[1, :, 0, 2] = [11, 21, 31]
+    stack[2, :, 0, 0] = [90, 10, 10]
+    return stack
+
+
+def test_composite_latest_valid(stack):
+    result = composite_stack(stack, "latest_valid")
+    np.testing.assert_array_equal(
+        result[:, 0], [[90, 10, 11, 0], [10, 20, 21, 0], [10, 30, 31, 0]]
+    )
+
+
+def test_composite_median(stack):
+    result = composite_stack(stack, "median")
+    # Gaps are ignored, the median of two values is their mean
+    np.testing.assert_array_equal(
+        result[:, 0], [[50, 10, 10, 0], [20, 20, 20, 0], [30, 30, 30, 0]]
+    )
+    assert result.dtype == np.uint8
+
+
+def test_composite_max_ndvi(stack):
+    # NIR in band 2 and red in band 3, as in the 7-2-1 composite
+    result = composite_stack(stack, "max_ndvi", (1, 2))
+    # Date 1 NDVI is -0.2 and -0.2, date 2 -0.08 and -0.19, date 3 0
+    np.testing.assert_array_equal(
+        result[:, 0], [[90, 10, 11, 0], [10, 20, 21, 0], [10, 30, 31, 0]]
+    )
+
+
+def test_ndvi_bands():
+    layers = {TRUE_COLOR: {"bands_count": 3}, BANDS_721: {"bands_count": 3}}
+    assert ndvi_bands(layers) == (4, 5)
+    with pytest.raises(UP42Error, match="max_ndvi"):
+        ndvi_bands({TRUE_COLOR: {"bands_count": 3}})
+
+
+def test_validate_composite():
+    validate_composite(None, {TRUE_COLOR: {}})
+    validate_composite("median", {TRUE_COLOR: {}})
+    validate_composite("max_ndvi", {BANDS_721: {}})
+    with pytest.raises(UP42Error, match="Invalid composite"):
+        validate_composite("mean", {TRUE_COLOR: {}})
+    with pytest.raises(UP42Error, match="max_ndvi"):
+        validate_composite("max_ndvi", {TRUE_COLOR: {}})
+
+
+def test_write_composite_quicklook(tmp_path):
+    img_filename = tmp_path / "composite.tif"
+    with rio.open(
+        img_filename,
+        "w",
+        driver="GTiff",
+        width=1024,
+        height=512,
+        count=3,
+        dtype="uint8",
+    ) as dst:
+        dst.write(np.full((3, 512, 1024), 100, dtype=np.uint8))
+
+    write_composite_quicklook(img_filename, tmp_path / "quicklook.jpg", (512, 512))
+
+    with rio.open(tmp_path / "quicklook.jpg") as quicklook:
+        assert quicklook.driver == "JPEG"
+        assert quicklook.shape == (256, 512)
+        assert quicklook.count == 3
@@ -0,0 +1,100 @@
+"""
+Unit tests for the output compression profiles
+"""
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+from rio_cogeo.cogeo import cog_validate
+
+from context import (
+    COMPRESSION_PROFILES,
+    CogWorkerPool,
+    get_compression_profile,
+    to_cog,
+    write_multiband_tif,
+)
+
+from blockutils.exceptions import UP42Error
+
+
+def write_tif(path, count, value):
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=600,
+        height=600,
+        count=count,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_origin(0, 0, 250, 250),
+    ) as dst:
+        data = np.arange(600 * 600, dtype=np.uint32).reshape(600, 600) % 251
+        dst.write(np.stack([(data + value).astype(np.uint8)] * count))
+
+
+def test_get_compression_profile():
+    assert get_compression_profile("archival").codec == "zstd"
+    with pytest.raises(UP42Error, match="Invalid compression profile"):
+        get_compression_profile("best")
+
+
+def test_creation_options():
+    options = COMPRESSION_PROFILES["balanced"].creation_options()
+    assert options == {
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+        "predictor": 2,
+        "zlevel": 6,
+    }
+    assert COMPRESSION_PROFILES["archival"].creation_options(1)["zstd_level"] == 1
+
+
+@pytest.mark.parametrize("name", list(COMPRESSION_PROFILES))
+def test_write_multiband_tif_and_cog(tmp_path, name):
+    profile = COMPRESSION_PROFILES[name]
+    write_tif(tmp_path / "a.tif", 2, 0)
+    write_tif(tmp_path / "b.tif", 1, 7)
+    img_filename = tmp_path / "out.tif"
+
+    write_multiband_tif([tmp_path / "a.tif", tmp_path / "b.tif"], img_filename, profile)
+
+    with rio.open(img_filename) as dataset:
+        assert dataset.count == 3
+        assert dataset.profile["compress"] == profile.codec
+        stacked = dataset.read()
+
+    to_cog(img_filename, profile)
+
+    assert cog_validate(img_filename)[0]
+    assert not (tmp_path / "out.tif.tmp").exists()
+    with rio.open(img_filename) as dataset:
+        assert dataset.profile["compress"] == profile.codec
+        assert dataset.profile["blockxsize"] == profile.blocksize
+        np.testing.assert_array_equal(dataset.read(), stacked)
+
+
+def test_to_cog_threads(tmp_path):
+    write_tif(tmp_path / "a.tif", 3, 0)
+    to_cog(tmp_path / "a.tif", COMPRESSION_PROFILES["fast"], threads=2)
+    assert cog_validate(tmp_path / "a.tif")[0]
+
+
+def test_cog_worker_pool(tmp_path):
+    for name in ("a.tif", "b.tif"):
+        write_tif(tmp_path / name, 3, 0)
+
+    with CogWorkerPool(workers=2) as pool:
+        assert pool.threads >= 1
+        for name in ("a.tif", "b.tif"):
+            pool.submit(tmp_path / name, COMPRESSION_PROFILES["balanced"])
+        assert pool.wait(tmp_path / "a.tif") > 0
+        assert pool.wait(tmp_path / "b.tif") > 0
+        assert pool.wait(tmp_path / "b.tif") is None
+
+    for name in ("a.tif", "b.tif"):
+        assert cog_validate(tmp_path / name)[0]
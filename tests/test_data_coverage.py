@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from geojson import Feature
+from mercantile import Tile
+
+from context import (
+    TileCoverage,
+    feature_coverage,
+    is_dropped,
+    valid_fraction,
+    validate_min_coverage,
+)
+
+from blockutils.exceptions import UP42Error
+
+
+def test_valid_fraction():
+    data = np.zeros((3, 4, 4), dtype=np.uint8)
+    assert valid_fraction(data) == 0
+    # A pixel is valid if any of its bands has data
+    data[0, 0, :2] = 1
+    data[2, 1, :] = 255
+    assert valid_fraction(data) == 6 / 16
+
+
+def test_feature_coverage():
+    first = TileCoverage()
+    first.add(Tile(0, 0, 9), 1.0)
+    first.add(Tile(1, 0, 9), 0.5)
+    second = TileCoverage()
+    second.add(Tile(0, 0, 9), 0.25)
+
+    # Tiles that were not added are empty
+    assert first.ratio(4) == 0.375
+    assert second.ratio(4) == 0.0625
+    assert feature_coverage([first, second], 4) == 0.0625
+    assert TileCoverage().ratio(0) == 0
+
+
+def test_validate_min_coverage():
+    validate_min_coverage(None)
+    validate_min_coverage(0)
+    validate_min_coverage(0.8)
+    with pytest.raises(UP42Error, match="min_coverage"):
+        validate_min_coverage(1.5)
+
+
+def test_is_dropped():
+    assert not is_dropped(Feature(id="a", properties={"coverage": 1.0}))
+    assert is_dropped(Feature(id="a", properties={"coverage": 0.1, "dropped": True}))
@@ -0,0 +1,80 @@
+"""
+Unit tests for the settings of fetch jobs
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+
+import pytest
+
+from context import FetchOptions, STACQuery, set_query_defaults
+
+from blockutils.exceptions import UP42Error
+
+JPEG_LAYERS = OrderedDict(
+    [("MODIS_Terra_CorrectedReflectance_TrueColor", {"Format": "jpeg"})]
+)
+QUERY = {
+    "zoom_level": 9,
+    "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+    "limit": 2,
+    "bbox": [
+        123.59349578619005,
+        -10.188159969024264,
+        123.70257586240771,
+        -10.113232998848046,
+    ],
+    "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+}
+
+
+def options_of(dry_run=False, **params) -> FetchOptions:
+    query = STACQuery.from_dict({**QUERY, **params})
+    set_query_defaults(query)
+    return FetchOptions.from_query(query, dry_run, JPEG_LAYERS, Path("/tmp/output"))
+
+
+def test_set_query_defaults():
+    query = STACQuery.from_dict(QUERY)
+    set_query_defaults(query)
+    assert query.get_param_if_exists("crs") == "EPSG:3857"
+    assert query.get_param_if_exists("output_format") == "geotiff"
+    assert query.get_param_if_exists("cog_workers") == 1
+
+    with pytest.raises(UP42Error, match="Invalid output format"):
+        set_query_defaults(STACQuery.from_dict({**QUERY, "output_format": "png"}))
+    with pytest.raises(UP42Error, match="only available in EPSG:3857"):
+        set_query_defaults(
+            STACQuery.from_dict({**QUERY, "crs": "EPSG:4326", "composite": "max"})
+        )
+
+
+def test_from_query():
+    options = options_of(jpeg_passthrough=True, cog_workers=2, progressive=True)
+    assert options.jpeg_passthrough
+    assert options.progressive
+    assert options.zarr_path is None
+    # Pass-through writes the COG itself
+    assert options.cog_workers == 1
+
+    options = options_of(cog_workers=2, output_format="zarr", incremental=True)
+    assert options.zarr_path == Path("/tmp/output/modis.zarr")
+    assert not options.incremental
+    assert options.cog_workers == 1
+
+    options = options_of(
+        crs="EPSG:4326", native_overviews=True, progressive=True, cog_workers=2
+    )
+    assert not options.native_overviews
+    assert not options.progressive
+    assert options.cog_workers == 2
+
+
+def test_from_query_dry_run():
+    options = options_of(
+        dry_run=True, output_format="zarr", progressive=True, cog_workers=2
+    )
+    assert options.dry_run
+    assert options.zarr_path is None
+    assert not options.progressive
+    assert options.cog_workers == 1
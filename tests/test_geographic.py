@@ -0,0 +1,41 @@
+import pytest
+from mercantile import Tile
+from shapely.geometry import box, mapping
+
+from context import geographic
+
+from blockutils.exceptions import UP42Error
+
+
+def test_bounds():
+    assert geographic.bounds(Tile(0, 0, 0)) == (-180, -198, 108, 90)
+    # 320 x 160 tiles of 1.125 degrees at level 8
+    assert geographic.bounds(Tile(319, 159, 8)) == (178.875, -90, 180, -88.875)
+
+
+def test_tile_level():
+    layers = {"a": {"TileMatrixSet": "250m"}, "b": {"TileMatrixSet": "1km"}}
+    assert geographic.tile_level(9, {"a": layers["a"]}) == 8
+    assert geographic.tile_level(9, layers) == 6
+
+
+def test_get_tile_list():
+    bbox = [10.5, 44.8, 12.6, 46.0]
+    tile_list = geographic.get_tile_list(bbox, mapping(box(*bbox)), 8)
+    assert tile_list == [
+        Tile(169, 39, 8),
+        Tile(170, 39, 8),
+        Tile(171, 39, 8),
+        Tile(169, 40, 8),
+        Tile(170, 40, 8),
+        Tile(171, 40, 8),
+    ]
+    # Tiles only touching the geometry are left out
+    bbox = [11.25, 45.0, 12.375, 46.125]
+    assert geographic.get_tile_list(bbox, mapping(box(*bbox)), 8) == [Tile(170, 39, 8)]
+
+
+def test_validate_crs():
+    geographic.validate_crs("EPSG:4326")
+    with pytest.raises(UP42Error, match="Invalid crs"):
+        geographic.validate_crs("EPSG:32633")
@@ -15,12 +15,16 @@ import requests_mock as mock
 from PIL import Image
 
 from context import (
+    REQUEST_TIMEOUT,
     GibsAPI,
+    HttpTransport,
+    LayerCatalog,
     STACQuery,
     ensure_data_directories_exist,
     extract_query_dates,
     make_list_layer_band,
     move_dates_to_past,
+    validate_bands,
 )
 
 from blockutils.exceptions import UP42Error
@@ -63,6 +67,32 @@ def test_get_dict_available_imagery_layers(requests_mock):
     assert len(imagery_layers) == 45
 
 
+def test_get_dict_available_imagery_layers_epsg4326(requests_mock):
+    _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    with open(
+        os.path.join(_location_, "mock_data/available_imagery_layers_epsg4326.xml"),
+        "rb",
+    ) as xml_file:
+        fake_xml: object = xml_file.read()
+
+    requests_mock.get(
+        "https://gibs.earthdata.nasa.gov/wmts/epsg4326/best/1.0.0/WMTSCapabilities.xml",
+        content=fake_xml,
+    )
+
+    imagery_layers = GibsAPI(crs="EPSG:4326").get_dict_available_imagery_layers()
+
+    # Layers with unknown tile matrix sets are left out
+    assert {
+        layer: attributes["TileMatrixSet"]
+        for layer, attributes in imagery_layers.items()
+    } == {
+        "MODIS_Terra_CorrectedReflectance_TrueColor": "250m",
+        "MODIS_Terra_Land_Surface_Temp_Day": "1km",
+    }
+
+
 def test_validate_imagery_layers(requests_mock):
     _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -104,6 +134,13 @@ def test_validate_imagery_layers(requests_mock):
     assert not multiple_valid
     assert invalid[0] == ["ABC"]
 
+    # Only the unknown name is invalid, not the layers after it
+    multiple_valid, invalid, _ = GibsAPI().validate_imagery_layers(
+        ["ABC", "MODIS_Aqua_CorrectedReflectance_TrueColor"], [50, 50, 60, 60]
+    )
+    assert not multiple_valid
+    assert invalid[0] == ["ABC"]
+
     multiple_geom, invalid, _ = GibsAPI().validate_imagery_layers(
         ["MODIS_Aqua_CorrectedReflectance_TrueColor"], [200, 200, 210, 210]
     )
@@ -114,6 +151,39 @@ def test_validate_imagery_layers(requests_mock):
     ]
 
 
+def test_layer_catalog(requests_mock):
+    _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    with open(
+        os.path.join(_location_, "mock_data/available_imagery_layers.xml"), "rb"
+    ) as xml_file:
+        fake_xml: object = xml_file.read()
+
+    capabilities_mock = requests_mock.get(mock.ANY, content=fake_xml)
+
+    api = GibsAPI()
+    all_layers = LayerCatalog(fake_xml).layers()
+    for identifier, entry in all_layers.items():
+        layer = api.catalog.get(identifier)
+        assert layer["TileMatrixSet"] == entry["TileMatrixSet"]
+        assert layer["Format"] == entry["Format"]
+        assert layer["WGS84BoundingBox"].equals(entry["WGS84BoundingBox"])
+    # Unknown layers, layers of other tile matrix sets and style identifiers
+    assert api.catalog.get("ABC") is None
+    assert api.catalog.get("BlueMarble_NextGeneration") is None
+    assert api.catalog.get("default") is None
+
+    # Entries are copies, the catalog is downloaded once
+    api.catalog.get("MODIS_Aqua_CorrectedReflectance_TrueColor")["bands_count"] = 3
+    assert "bands_count" not in api.catalog.get(
+        "MODIS_Aqua_CorrectedReflectance_TrueColor"
+    )
+    api.validate_imagery_layers(
+        ["MODIS_Aqua_CorrectedReflectance_TrueColor"], [50, 50, 60, 60]
+    )
+    assert capabilities_mock.call_count == 1
+
+
 def test_move_dates_to_past():
 
     date_points = [datetime(2019, 4, 20, 16, 40, 49), datetime(2029, 4, 25, 17, 45, 49)]
@@ -267,6 +337,46 @@ def test_make_list_layer_band():
     assert list_imagery_layers[3] == [4, "MODIS_Aqua_CorrectedReflectance_TrueColor", 1]
 
 
+def test_make_list_layer_band_selected_bands():
+    test_imagery_layers = collections.OrderedDict(
+        {
+            "MODIS_Terra_CorrectedReflectance_Bands721": {
+                "Format": "jpeg",
+                "bands": [3, 1],
+                "bands_count": 2,
+            },
+            "MODIS_Terra_CorrectedReflectance_TrueColor": {
+                "Format": "jpeg",
+                "bands_count": 3,
+            },
+        }
+    )
+
+    assert make_list_layer_band(test_imagery_layers, 5) == [
+        [1, "MODIS_Terra_CorrectedReflectance_Bands721", 3],
+        [2, "MODIS_Terra_CorrectedReflectance_Bands721", 1],
+        [3, "MODIS_Terra_CorrectedReflectance_TrueColor", 1],
+        [4, "MODIS_Terra_CorrectedReflectance_TrueColor", 2],
+        [5, "MODIS_Terra_CorrectedReflectance_TrueColor", 3],
+    ]
+
+
+def test_validate_bands():
+    layers = ["MODIS_Terra_CorrectedReflectance_Bands721"]
+    validate_bands(None, layers)
+    validate_bands({"MODIS_Terra_CorrectedReflectance_Bands721": [2, 1]}, layers)
+    for bands in (
+        [1],
+        {"MODIS_Terra_CorrectedReflectance_TrueColor": [1]},
+        {"MODIS_Terra_CorrectedReflectance_Bands721": []},
+        {"MODIS_Terra_CorrectedReflectance_Bands721": [0]},
+        {"MODIS_Terra_CorrectedReflectance_Bands721": [1, 1]},
+        {"MODIS_Terra_CorrectedReflectance_Bands721": 1},
+    ):
+        with pytest.raises(UP42Error, match="Invalid bands"):
+            validate_bands(bands, layers)
+
+
 def test_requests_wmts_tile(requests_mock):
     """
     Mocked test for tile download
@@ -286,6 +396,25 @@ def test_requests_wmts_tile(requests_mock):
     assert result.content is not None
 
 
+def test_requests_wmts_tile_epsg4326(requests_mock):
+    """
+    Mocked test for the tile URL of the geographic tile matrix sets
+    """
+    requests_mock.get(mock.ANY, content=b"tile")
+
+    GibsAPI(crs="EPSG:4326").requests_wmts_tile(
+        mercantile.Tile(x=290, y=30, z=8),
+        "MODIS_Terra_CorrectedReflectance_TrueColor",
+        "2019-06-20",
+        tile_matrix_set="250m",
+    )
+
+    assert requests_mock.last_request.url == (
+        "https://gibs.earthdata.nasa.gov/wmts/epsg4326/best/"
+        "MODIS_Terra_CorrectedReflectance_TrueColor/default/2019-06-20/250m/8/30/290.jpg"
+    )
+
+
 @patch("requests.get")
 @pytest.mark.parametrize(
     "expected_error",
@@ -350,3 +479,11 @@ def test_get_layer_bands_count(requests_mock):
         test_imagery_layers["MODIS_Terra_CorrectedReflectance_TrueColor"]["bands_count"]
         == 3
     )
+
+
+def test_http_transport_timeout(requests_mock):
+    requests_mock.get(mock.ANY, content=b"tile")
+    HttpTransport().get("https://gibs.earthdata.nasa.gov/wmts")
+    assert requests_mock.last_request.timeout == REQUEST_TIMEOUT
+    HttpTransport(requests.Session()).get("https://gibs.earthdata.nasa.gov/wmts")
+    assert requests_mock.last_request.timeout == REQUEST_TIMEOUT
@@ -0,0 +1,80 @@
+import socket
+import sys
+
+import pytest
+import requests
+
+from context import GibsAPI, Http2Transport
+
+from benchmarks.gibs_stub_server import GibsStubServer
+
+TILE_PATH = "/epsg3857/best/layer/default/2019-06-30/level9/9/{}/1.jpeg"
+
+
+def test_http2_transport_multiplexes_prefetched_tiles():
+    with GibsStubServer(latency=0.05, http2=True, max_connections=2) as server:
+        transport = Http2Transport(prior_knowledge=True)
+        urls = [server.wmts_url + TILE_PATH.format(row) for row in range(16)]
+        transport.prefetch(urls)
+        responses = [transport.get(url) for url in urls]
+        transport.close()
+
+    assert all(response.status_code == 200 for response in responses)
+    assert responses[0].content == server.tile
+    assert transport.negotiated
+    assert server.requests_served == 16
+    assert server.connections == server.http2_connections <= 2
+
+
+def test_http2_transport_falls_back_to_http1():
+    with GibsStubServer(http2=False) as server:
+        transport = Http2Transport(prior_knowledge=True)
+        api = GibsAPI(transport=transport)
+        api.wmts_url = server.wmts_url
+        response = api.get_capabilities()
+        transport.close()
+
+    assert response.status_code == 200
+    assert b"Capabilities" in response.content
+    assert not transport.http2
+    assert not transport.negotiated
+
+
+def test_http2_transport_error_status():
+    with GibsStubServer(http2=True, error_rate=1.0) as server:
+        transport = Http2Transport(prior_knowledge=True)
+        response = transport.get(server.wmts_url + TILE_PATH.format(1))
+        transport.close()
+
+    assert response.status_code == 500
+    with pytest.raises(requests.exceptions.HTTPError):
+        response.raise_for_status()
+
+
+def test_http2_transport_connection_error():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    transport = Http2Transport(prior_knowledge=True)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        transport.get(f"http://127.0.0.1:{port}/wmts" + TILE_PATH.format(1))
+    transport.close()
+
+
+def test_http2_transport_from_env(monkeypatch):
+    monkeypatch.delenv("MODIS_HTTP2", raising=False)
+    assert Http2Transport.from_env() is None
+
+    monkeypatch.setenv("MODIS_HTTP2", "prior_knowledge")
+    transport = Http2Transport.from_env()
+    assert transport.prior_knowledge
+    transport.close()
+
+    monkeypatch.setenv("MODIS_HTTP2", "1")
+    transport = Http2Transport.from_env()
+    assert not transport.prior_knowledge
+    transport.close()
+
+    # Missing dependencies keep the default transport
+    monkeypatch.setitem(sys.modules, "httpx", None)
+    assert Http2Transport.from_env() is None
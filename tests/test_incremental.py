@@ -0,0 +1,120 @@
+"""
+Unit tests for the incremental mode of recurring queries
+"""
+
+import os
+
+from geojson import Feature
+
+from context import IncrementalManifest, Modis, STACQuery, incremental_key
+
+QUERY = {
+    "zoom_level": 9,
+    "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+    "limit": 2,
+    "bbox": [
+        123.59349578619005,
+        -10.188159969024264,
+        123.70257586240771,
+        -10.113232998848046,
+    ],
+    "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+    "incremental": True,
+}
+
+
+def test_incremental_key_ignores_time_window():
+    query = STACQuery.from_dict(QUERY)
+    shifted = STACQuery.from_dict(
+        {**QUERY, "time": "2018-11-02T00:00:00+00:00/2018-11-21T00:00:00+00:00"}
+    )
+    other_layers = STACQuery.from_dict({**QUERY, "imagery_layers": ["OTHER"]})
+    assert incremental_key(query) == incremental_key(shifted)
+    assert incremental_key(query) != incremental_key(other_layers)
+    assert incremental_key(query) == incremental_key(
+        STACQuery.from_dict({**QUERY, "compression_profile": "balanced"})
+    )
+    assert incremental_key(query) != incremental_key(
+        STACQuery.from_dict({**QUERY, "compression_profile": "fast"})
+    )
+
+
+def test_manifest_add_restore_prune(tmp_path):
+    output_dir, quicklook_dir, state_dir = (
+        tmp_path / "output",
+        tmp_path / "quicklooks",
+        tmp_path / "state",
+    )
+    output_dir.mkdir()
+    quicklook_dir.mkdir()
+    (output_dir / "abc.tif").write_bytes(b"tif")
+    (quicklook_dir / "abc.jpg").write_bytes(b"jpg")
+    feature = Feature(
+        id="abc", properties={"up42.data_path": "abc.tif", "metrics": {"tiles": 1}}
+    )
+
+    manifest = IncrementalManifest(state_dir, "key")
+    assert manifest.restore("2019-01-01", output_dir, quicklook_dir) is None
+    manifest.add("2019-01-01", feature, output_dir, quicklook_dir)
+    (output_dir / "abc.tif").unlink()
+    (quicklook_dir / "abc.jpg").unlink()
+
+    restored = IncrementalManifest(state_dir, "key").restore(
+        "2019-01-01", output_dir, quicklook_dir
+    )
+    assert restored["id"] == "abc"
+    assert restored["properties"] == {"up42.data_path": "abc.tif"}
+    assert (output_dir / "abc.tif").read_bytes() == b"tif"
+    assert (quicklook_dir / "abc.jpg").read_bytes() == b"jpg"
+
+    manifest.prune(["2019-01-02"])
+    assert IncrementalManifest(state_dir, "key").dates == {}
+    assert not list(manifest.manifest_dir.glob("*.tif"))
+
+
+def test_fetch_incremental_only_fetches_new_dates(gibs_mock, monkeypatch, tmp_path):
+    monkeypatch.setenv("MODIS_STATE_DIR", str(tmp_path))
+
+    first = Modis().fetch(STACQuery.from_dict(QUERY), dry_run=False)
+    assert len(first.features) == 2
+
+    gibs_mock.reset_mock()
+    shifted_query = {
+        **QUERY,
+        "time": "2018-11-02T16:40:49+00:00/2018-11-21T16:41:49+00:00",
+    }
+    second = Modis().fetch(STACQuery.from_dict(shifted_query), dry_run=False)
+
+    assert len(second.features) == 2
+    assert second.features[0]["id"] == first.features[1]["id"]
+    assert second.features[1]["id"] != first.features[1]["id"]
+    for feature in second.features:
+        assert os.path.isfile(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        )
+    fetched_dates = {
+        url.split("/default/")[1].split("/")[0]
+        for url in [request.url for request in gibs_mock.request_history]
+        if "/default/" in url
+    }
+    assert fetched_dates == {"2018-11-21"}
+
+
+def test_fetch_incremental_with_other_overviews_fetches_again(
+    gibs_mock, monkeypatch, tmp_path
+):
+    monkeypatch.setenv("MODIS_STATE_DIR", str(tmp_path))
+
+    Modis().fetch(STACQuery.from_dict(QUERY), dry_run=False)
+    gibs_mock.reset_mock()
+    result = Modis().fetch(
+        STACQuery.from_dict({**QUERY, "native_overviews": True}), dry_run=False
+    )
+
+    assert len(result.features) == 2
+    fetched_dates = {
+        url.split("/default/")[1].split("/")[0]
+        for url in [request.url for request in gibs_mock.request_history]
+        if "/default/" in url
+    }
+    assert fetched_dates == {"2018-11-19", "2018-11-20"}
@@ -0,0 +1,119 @@
+"""
+Unit tests for the JPEG pass-through COG writer
+"""
+
+import io
+import os
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio as rio
+from PIL import Image
+from rio_cogeo.cogeo import cog_validate
+
+from context import (
+    CogWriter,
+    is_passthrough_eligible,
+    jpeg_subsampling,
+    write_jpeg_passthrough_cog,
+)
+
+from blockutils.exceptions import UP42Error
+
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+TILE_PATH = os.path.join(os.path.dirname(__file__), "mock_data/tile.jpg")
+
+
+@pytest.fixture()
+def payload():
+    with open(TILE_PATH, "rb") as tile_file:
+        return tile_file.read()
+
+
+def jpeg(array: np.ndarray, **kwargs) -> bytes:
+    out = io.BytesIO()
+    Image.fromarray(array).save(out, "JPEG", **kwargs)
+    return out.getvalue()
+
+
+def test_is_passthrough_eligible():
+    assert is_passthrough_eligible({LAYER: {"Format": "jpeg"}})
+    assert not is_passthrough_eligible({"MODIS_Terra_NDVI_8Day": {"Format": "png"}})
+    assert not is_passthrough_eligible(
+        {LAYER: {"Format": "jpeg"}, "b": {"Format": "jpeg"}}
+    )
+
+
+def test_jpeg_subsampling(payload):
+    rgb = np.full((16, 16, 3), 100, dtype=np.uint8)
+    assert jpeg_subsampling(payload) == (2, 2)
+    assert jpeg_subsampling(jpeg(rgb, subsampling=0)) == (1, 1)
+    assert jpeg_subsampling(jpeg(rgb, progressive=True)) is None
+    assert jpeg_subsampling(jpeg(rgb[:, :, 0])) is None
+    assert jpeg_subsampling(b"\x89PNG") is None
+
+
+def test_write_jpeg_passthrough_cog(tmp_path, payload):
+    tiles = [mercantile.Tile(x, y, 9) for y in range(200, 203) for x in range(300, 303)]
+    empty = jpeg(np.zeros((256, 256, 3), dtype=np.uint8))
+    payloads = {tile: payload for tile in tiles}
+    payloads[tiles[0]] = empty
+    img_filename = tmp_path / "out.tif"
+
+    valid_tiles = write_jpeg_passthrough_cog(img_filename, tiles, payloads, LAYER)
+
+    assert valid_tiles == tiles[1:]
+    assert cog_validate(img_filename) == (True, [], [])
+    with rio.open(TILE_PATH) as src:
+        expected = src.read()
+    with rio.open(img_filename) as dataset:
+        assert dataset.crs.to_epsg() == 3857
+        assert dataset.shape == (768, 768)
+        assert dataset.profile["compress"] == "jpeg"
+        assert dataset.overviews(1) == [2, 4]
+        assert dataset.bounds.left == pytest.approx(mercantile.xy_bounds(tiles[0]).left)
+        assert dataset.bounds.top == pytest.approx(mercantile.xy_bounds(tiles[0]).top)
+        assert dataset.tags(3) == {"layer": LAYER, "band": "3"}
+        # Copied tiles decode exactly like the source JPEGs, empty tiles are sparse
+        np.testing.assert_array_equal(
+            dataset.read(window=((0, 256), (256, 512))), expected
+        )
+        assert not dataset.read(window=((0, 256), (0, 256))).any()
+    with open(img_filename, "rb") as out:
+        assert payload in out.read()
+
+
+def test_write_jpeg_passthrough_cog_reencodes_incompatible_tiles(tmp_path, payload):
+    tiles = [mercantile.Tile(300, 200, 9), mercantile.Tile(301, 200, 9)]
+    progressive = jpeg(np.full((256, 256, 3), 120, dtype=np.uint8), progressive=True)
+    img_filename = tmp_path / "out.tif"
+
+    write_jpeg_passthrough_cog(
+        img_filename, tiles, {tiles[0]: payload, tiles[1]: progressive}, LAYER
+    )
+
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        assert np.abs(dataset.read(1)[:, 256:].astype(int) - 120).max() <= 2
+
+
+def test_write_jpeg_passthrough_cog_all_empty(tmp_path):
+    tile = mercantile.Tile(300, 200, 9)
+    empty = jpeg(np.zeros((256, 256, 3), dtype=np.uint8))
+    with pytest.raises(UP42Error, match="All tiles are empty"):
+        write_jpeg_passthrough_cog(tmp_path / "out.tif", [tile], {tile: empty}, LAYER)
+
+
+def test_cog_writer_bigtiff(tmp_path):
+    img_filename = tmp_path / "big.tif"
+    with CogWriter(
+        img_filename, 300, 300, samples=1, compression=1, photometric=1, bigtiff=True
+    ) as writer:
+        assert writer.level_count == 2
+        writer.write_tile(1, 0, 0, bytes(range(256)) * 256)
+        writer.write_tile(0, 1, 1, bytes([7]) * 256 * 256)
+    with rio.open(img_filename) as dataset:
+        band = dataset.read(1)
+        assert band[256:, 256:].min() == 7
+        assert not band[:256].any()
@@ -0,0 +1,63 @@
+"""
+Unit tests for the fetch job instrumentation
+"""
+
+import json
+import time
+
+from context import Metrics
+
+
+def test_stage_nested_time_is_exclusive():
+    metrics = Metrics()
+    with metrics.stage("merge"):
+        time.sleep(0.02)
+        with metrics.stage("download"):
+            time.sleep(0.05)
+
+    assert 0.05 <= metrics.stage_seconds["download"] < 0.07
+    assert 0.02 <= metrics.stage_seconds["merge"] < 0.05
+
+
+def test_record_request_and_retries():
+    metrics = Metrics()
+    metrics.record_request(("layer", "2019-01-01", (1, 2, 9)), 100)
+    metrics.record_failure(("layer", "2019-01-01", (2, 2, 9)))
+    metrics.record_request(("layer", "2019-01-01", (2, 2, 9)), 50)
+    metrics.record_request(("quicklook", "layer", "2019-01-01"), 10, tile=False)
+
+    summary = metrics.summary()
+    assert summary["tiles"] == 2
+    assert summary["requests"] == 3
+    assert summary["bytes_transferred"] == 160
+    assert summary["failed_requests"] == 1
+    assert summary["retries"] == 1
+
+
+def test_summary_since_snapshot_and_cache_ratio():
+    metrics = Metrics()
+    metrics.record_request("a", 10)
+    metrics.record_cache("tiles", hit=False)
+    snapshot = metrics.snapshot()
+    metrics.record_request("b", 20)
+    metrics.record_cache("tiles", hit=True)
+    metrics.record_cache("tiles", hit=True)
+    metrics.record_cache("tiles", hit=False)
+
+    summary = metrics.summary(since=snapshot)
+    assert summary["tiles"] == 1
+    assert summary["bytes_transferred"] == 20
+    assert summary["cache_hit_ratio"] == {"tiles": 0.6667}
+    assert metrics.summary()["cache_hit_ratio"] == {"tiles": 0.5}
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    with metrics.stage("cog"):
+        pass
+    out_path = metrics.write(tmp_path, dates={"2019-01-01": {}})
+
+    with open(out_path, encoding="utf-8") as src:
+        content = json.load(src)
+    assert content["dates"] == {"2019-01-01": {}}
+    assert "tiles_per_second" in content
@@ -1,17 +1,21 @@
 """
 Integration tests for the higher-level fetch methods
 """
-# pylint: disable=unused-import, redefined-outer-name
-# requests_mock used as fixture in tests
+
+# pylint: disable=unused-import, unused-argument, redefined-outer-name
+# requests_mock and gibs_mock used as fixtures in tests
+import json
 import os
 import re
+import shutil
 
 import rasterio as rio
+from rasterio.io import MemoryFile
 import numpy as np
 import pytest
 from rio_cogeo.cogeo import cog_validate
 
-from context import STACQuery, Modis
+from context import STACQuery, Modis, ZarrTimeSeries, current_rss_mb
 
 from blockutils.exceptions import UP42Error
 
@@ -219,6 +223,591 @@ def test_aoiclipped_fetcher_fetch(requests_mock, modis_instance):
     assert os.path.isfile("/tmp/quicklooks/%s.jpg" % result.features[0]["id"])
 
 
+def test_aoiclipped_fetcher_fetch_bands(gibs_mock, modis_instance):
+    """
+    Mocked test for fetching a band subset of a layer
+    """
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 1,
+        "bbox": [
+            123.59349578619005,
+            -10.188159969024264,
+            123.70257586240771,
+            -10.113232998848046,
+        ],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+        "jpeg_passthrough": True,
+    }
+
+    def fetch_image(bands=None):
+        result = modis_instance.fetch(
+            STACQuery.from_dict({**query, "bands": bands}), dry_run=False
+        )
+        img_filename = (
+            "/tmp/output/%s" % result.features[0]["properties"]["up42.data_path"]
+        )
+        assert cog_validate(img_filename)[0]
+        with rio.open(img_filename) as dataset:
+            return dataset.read(), [dataset.tags(band) for band in dataset.indexes]
+
+    data, _ = fetch_image({"MODIS_Terra_CorrectedReflectance_TrueColor": [1, 2, 3]})
+    subset, tags = fetch_image({"MODIS_Terra_CorrectedReflectance_TrueColor": [3, 2]})
+
+    assert subset.shape[0] == 2
+    np.testing.assert_array_equal(subset, data[[2, 1]])
+    assert [tag["band"] for tag in tags] == ["3", "2"]
+
+    with pytest.raises(UP42Error, match="Invalid bands"):
+        fetch_image({"MODIS_Terra_CorrectedReflectance_TrueColor": [4]})
+
+
+def test_aoiclipped_fetcher_fetch_jpeg_passthrough(gibs_mock, modis_instance):
+    """
+    Mocked test for the JPEG pass-through of single JPEG layer requests
+    """
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 1,
+            "bbox": [
+                123.59349578619005,
+                -10.188159969024264,
+                123.70257586240771,
+                -10.113232998848046,
+            ],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "jpeg_passthrough": True,
+        }
+    )
+
+    result = modis_instance.fetch(query, dry_run=False)
+
+    img_filename = "/tmp/output/%s" % result.features[0]["properties"]["up42.data_path"]
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        assert dataset.profile["compress"] == "jpeg"
+        assert np.sum(dataset.read(2)) == 7954025
+        assert dataset.tags(1)["layer"] == "MODIS_Terra_CorrectedReflectance_TrueColor"
+        assert dataset.tags(2)["band"] == str(2)
+
+
+def test_aoiclipped_fetcher_fetch_compression_profile(gibs_mock, modis_instance):
+    """
+    Mocked test for the output compression profiles
+    """
+
+    query_dict = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 1,
+        "bbox": [
+            123.59349578619005,
+            -10.188159969024264,
+            123.70257586240771,
+            -10.113232998848046,
+        ],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+        "compression_profile": "fast",
+    }
+
+    result = modis_instance.fetch(STACQuery.from_dict(query_dict), dry_run=False)
+
+    img_filename = "/tmp/output/%s" % result.features[0]["properties"]["up42.data_path"]
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        assert dataset.profile["compress"] == "zstd"
+        assert np.sum(dataset.read(2)) == 7954025
+
+    query_dict["compression_profile"] = "smallest"
+    with pytest.raises(UP42Error, match="Invalid compression profile"):
+        modis_instance.fetch(STACQuery.from_dict(query_dict), dry_run=False)
+
+
+def test_aoiclipped_fetcher_fetch_cog_workers(gibs_mock, modis_instance):
+    """
+    Mocked test for the COG conversion of several dates in worker processes
+    """
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 3,
+            "bbox": [
+                123.59349578619005,
+                -10.188159969024264,
+                123.70257586240771,
+                -10.113232998848046,
+            ],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "include_metrics": True,
+            "cog_workers": 2,
+            "cog_threads": 1,
+        }
+    )
+
+    result = modis_instance.fetch(query, dry_run=False)
+
+    assert len(result.features) == 3
+    for feature in result.features:
+        img_filename = "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        assert cog_validate(img_filename)[0]
+        with rio.open(img_filename) as dataset:
+            assert np.sum(dataset.read(2)) == 7954025
+            assert dataset.tags(1)["band"] == str(1)
+        assert feature["properties"]["metrics"]["stages"]["cog"] > 0
+
+
+def test_aoiclipped_fetcher_fetch_iter(
+    gibs_mock, mock_image, modis_instance, monkeypatch
+):
+    """
+    Mocked test for the features of a fetch being emitted one date at a time
+    """
+    tile_mock = gibs_mock.get(
+        re.compile("/wmts/epsg3857/best/MODIS_Terra_CorrectedReflectance_TrueColor/"),
+        content=mock_image,
+    )
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 3,
+        "bbox": [
+            123.59349578619005,
+            -10.188159969024264,
+            123.70257586240771,
+            -10.113232998848046,
+        ],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+    }
+
+    features = modis_instance.fetch_iter(STACQuery.from_dict(query), dry_run=False)
+    feature = next(features)
+    # The first date (its band count and mosaic tile) is final before the next one is
+    # fetched
+    assert tile_mock.call_count == 2
+    assert cog_validate("/tmp/output/%s" % feature["properties"]["up42.data_path"])[0]
+    assert len([feature] + list(features)) == 3
+    assert tile_mock.call_count == 6
+
+    # The block writes data.json as the features are emitted
+    monkeypatch.setenv("UP42_TASK_PARAMETERS", json.dumps(query))
+    Modis.run()
+    with open("/tmp/output/data.json", encoding="utf-8") as data_json:
+        result = json.load(data_json)
+    assert len(result["features"]) == 3
+    for feature in result["features"]:
+        assert os.path.isfile(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        )
+
+
+def test_aoiclipped_fetcher_fetch_progressive(
+    gibs_mock, mock_image, modis_instance, monkeypatch
+):
+    """
+    Mocked test for emitting a low resolution preview of each date first
+    """
+    tile_mock = gibs_mock.get(
+        re.compile("/wmts/epsg3857/best/MODIS_Terra_CorrectedReflectance_TrueColor/"),
+        content=mock_image,
+    )
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 2,
+        "bbox": [123.5, -10.4, 124.5, -9.6],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+        "progressive": True,
+    }
+
+    def zoom_levels():
+        return [
+            int(request.path.split("/")[-3]) for request in tile_mock.request_history
+        ]
+
+    features = modis_instance.fetch_iter(STACQuery.from_dict(query), dry_run=False)
+    preview = next(features)
+    preview_filename = "/tmp/output/%s" % preview["properties"]["up42.data_path"]
+    assert preview["properties"]["preview"]
+    assert preview["properties"]["preview_zoom_level"] == 8
+    assert cog_validate(preview_filename)[0]
+    # Only the tile counting the bands was requested at full resolution
+    assert zoom_levels().count(9) == 1
+    assert zoom_levels().count(8) <= 4
+    with rio.open(preview_filename) as dataset:
+        preview_bounds, preview_width = dataset.bounds, dataset.width
+        assert dataset.count == 3
+
+    final = next(features)
+    assert final["id"] == preview["id"]
+    assert "preview" not in final["properties"]
+    with rio.open("/tmp/output/%s" % final["properties"]["up42.data_path"]) as dataset:
+        assert dataset.bounds == pytest.approx(preview_bounds)
+        assert dataset.width == 2 * preview_width
+    assert [feature["properties"].get("preview", False) for feature in features] == [
+        True,
+        False,
+    ]
+    # The previews are removed once the final features are emitted
+    assert not os.path.exists(preview_filename)
+
+    result = modis_instance.fetch(STACQuery.from_dict(query), dry_run=False)
+    assert len(result.features) == 2
+    assert not any("preview" in feature["properties"] for feature in result.features)
+
+    # data.json ends with the final features only
+    monkeypatch.setenv("UP42_TASK_PARAMETERS", json.dumps(query))
+    Modis.run()
+    with open("/tmp/output/data.json", encoding="utf-8") as data_json:
+        result = json.load(data_json)
+    assert len(result["features"]) == 2
+    for feature in result["features"]:
+        assert "preview" not in feature["properties"]
+        assert os.path.isfile(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        )
+
+
+def test_aoiclipped_fetcher_fetch_native_overviews(gibs_mock, modis_instance):
+    """
+    Mocked test for COG overviews built from the lower GIBS zoom levels
+    """
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 1,
+            # 3 x 3 tiles at zoom level 9
+            "bbox": [31.65, 46.56, 33.74, 47.98],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "native_overviews": True,
+        }
+    )
+
+    result = modis_instance.fetch(query, dry_run=False)
+
+    img_filename = "/tmp/output/%s" % result.features[0]["properties"]["up42.data_path"]
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        assert dataset.shape == (768, 768)
+        assert dataset.overviews(1) == [2]
+    assert any(
+        "/googlemapscompatible_level9/8/" in request.path.lower()
+        for request in gibs_mock.request_history
+    )
+
+
+def test_aoiclipped_fetcher_fetch_memory_budget(gibs_mock, modis_instance, monkeypatch):
+    """
+    Mocked test for merging a large AOI in chunks within a memory budget
+    """
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 1,
+        # 3 x 3 tiles at zoom level 9
+        "bbox": [31.65, 46.56, 33.74, 47.98],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+    }
+
+    def fetch_image(memory_budget_mb=None):
+        result = modis_instance.fetch(
+            STACQuery.from_dict({**query, "memory_budget_mb": memory_budget_mb}),
+            dry_run=False,
+        )
+        feature = result.features[0]
+        assert feature["properties"]["coverage"] == 1
+        with rio.open(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        ) as dataset:
+            return dataset.profile, dataset.read()
+
+    profile, data = fetch_image()
+    assert "chunks" not in modis_instance.metrics.counters
+    # Leaves room for at most two tiles per chunk, independent of the memory freed
+    # or allocated meanwhile
+    rss_mb = current_rss_mb()
+    monkeypatch.setattr("chunking.current_rss_mb", lambda: rss_mb)
+    chunked_profile, chunked_data = fetch_image(rss_mb + 1)
+    assert modis_instance.metrics.counters["chunks"] > 1
+
+    assert chunked_profile["transform"].almost_equals(profile["transform"])
+    assert chunked_profile["compress"] == profile["compress"]
+    np.testing.assert_array_equal(chunked_data, data)
+
+    with pytest.raises(UP42Error, match="memory_budget_mb"):
+        fetch_image(-1)
+
+
+def test_aoiclipped_fetcher_fetch_min_coverage(gibs_mock, mock_image, modis_instance):
+    """
+    Mocked test for dropping dates with little valid data
+    """
+    with MemoryFile(mock_image) as mem_file:
+        with mem_file.open() as tile:
+            data = tile.read()
+    # Swath gap over the left half of the tile
+    data[:, :, :128] = 0
+    with MemoryFile() as mem_file:
+        with mem_file.open(
+            driver="PNG", width=256, height=256, count=3, dtype="uint8"
+        ) as dst:
+            dst.write(data)
+        gap_image = mem_file.read()
+
+    gibs_mock.get(re.compile("wms.cgi"), content=gap_image)
+    gibs_mock.get(
+        re.compile("/wmts/epsg3857/best/MODIS_Terra_CorrectedReflectance_TrueColor/"),
+        content=gap_image,
+    )
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 2,
+        "bbox": [
+            123.59349578619005,
+            -10.188159969024264,
+            123.70257586240771,
+            -10.113232998848046,
+        ],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+    }
+
+    result = modis_instance.fetch(
+        STACQuery.from_dict({**query, "min_coverage": 0.4}), dry_run=False
+    )
+    assert len(result.features) == 2
+    for feature in result.features:
+        assert feature["properties"]["coverage"] == 0.5
+        assert os.path.isfile(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        )
+
+    result = modis_instance.fetch(
+        STACQuery.from_dict({**query, "min_coverage": 0.6}), dry_run=False
+    )
+    assert not result.features
+    assert "post_process" not in modis_instance.metrics.summary()["stages"]
+
+    with pytest.raises(UP42Error, match="min_coverage"):
+        modis_instance.fetch(
+            STACQuery.from_dict({**query, "min_coverage": 2}), dry_run=False
+        )
+
+
+def test_aoiclipped_fetcher_fetch_composite(gibs_mock, modis_instance):
+    """
+    Mocked test for a single composite of all dates
+    """
+
+    query = {
+        "zoom_level": 9,
+        "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+        "limit": 3,
+        "bbox": [
+            123.59349578619005,
+            -10.188159969024264,
+            123.70257586240771,
+            -10.113232998848046,
+        ],
+        "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+    }
+
+    result = modis_instance.fetch(
+        STACQuery.from_dict({**query, "composite": "median"}), dry_run=False
+    )
+
+    assert len(result.features) == 1
+    properties = result.features[0]["properties"]
+    assert properties["composite"] == "median"
+    assert properties["dates"] == ["2018-11-18", "2018-11-19", "2018-11-20"]
+    assert properties["coverage"] == 1
+    img_filename = "/tmp/output/%s" % properties["up42.data_path"]
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        # The median of identical tiles is the tile
+        assert np.sum(dataset.read(2)) == 7954025
+        assert dataset.tags(1)["layer"] == "MODIS_Terra_CorrectedReflectance_TrueColor"
+    assert os.path.isfile("/tmp/quicklooks/%s.jpg" % result.features[0]["id"])
+
+    dry_run = modis_instance.fetch(
+        STACQuery.from_dict({**query, "composite": "median"}), dry_run=True
+    )
+    assert len(dry_run.features) == 1
+    properties = dry_run.features[0]["properties"]
+    assert properties["composite"] == "median"
+    assert properties["dates"] == ["2018-11-18", "2018-11-19", "2018-11-20"]
+    assert "up42.data_path" not in properties
+    assert not os.path.exists("/tmp/output/%s.tif" % dry_run.features[0]["id"])
+    assert os.path.isfile("/tmp/quicklooks/%s.jpg" % dry_run.features[0]["id"])
+
+    with pytest.raises(UP42Error, match="max_ndvi"):
+        modis_instance.fetch(
+            STACQuery.from_dict({**query, "composite": "max_ndvi"}), dry_run=False
+        )
+
+
+def test_aoiclipped_fetcher_fetch_zarr(gibs_mock, modis_instance):
+    """
+    Mocked test for appending all dates to a Zarr store
+    """
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 2,
+            "bbox": [
+                123.59349578619005,
+                -10.188159969024264,
+                123.70257586240771,
+                -10.113232998848046,
+            ],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "output_format": "zarr",
+        }
+    )
+
+    shutil.rmtree("/tmp/output/modis.zarr", ignore_errors=True)
+    try:
+        result = modis_instance.fetch(query, dry_run=False)
+
+        assert len(result.features) == 2
+        assert [feature["properties"]["time_index"] for feature in result.features] == [
+            0,
+            1,
+        ]
+        assert all(
+            feature["properties"]["up42.data_path"] == "modis.zarr"
+            for feature in result.features
+        )
+        store = ZarrTimeSeries("/tmp/output/modis.zarr")
+        assert store.dates == ["2018-11-19", "2018-11-20"]
+        assert store.attrs["bands"][0] == [
+            1,
+            "MODIS_Terra_CorrectedReflectance_TrueColor",
+            1,
+        ]
+        assert np.sum(store.read(1)[1]) == 7954025
+    finally:
+        shutil.rmtree("/tmp/output/modis.zarr", ignore_errors=True)
+
+
+def test_aoiclipped_fetcher_fetch_epsg4326(requests_mock, modis_instance):
+    """
+    Mocked test for fetching from the geographic tile matrix sets
+    """
+    _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    with rio.open(os.path.join(_location_, "mock_data/tile.jpg")) as tile:
+        data = tile.read()
+    # Geographic tiles have 512 pixels
+    data = data.repeat(2, axis=1).repeat(2, axis=2)
+    with MemoryFile() as mem_file:
+        with mem_file.open(
+            driver="PNG", width=512, height=512, count=3, dtype="uint8"
+        ) as dst:
+            dst.write(data)
+        mock_image = mem_file.read()
+
+    with open(
+        os.path.join(_location_, "mock_data/available_imagery_layers_epsg4326.xml"),
+        "rb",
+    ) as xml_file:
+        mock_xml: object = xml_file.read()
+
+    requests_mock.get(
+        re.compile("epsg4326/best/1.0.0/WMTSCapabilities.xml"), content=mock_xml
+    )
+    requests_mock.get(re.compile("wms.cgi"), content=mock_image)
+    requests_mock.get(
+        re.compile(
+            "/wmts/epsg4326/best/MODIS_Terra_CorrectedReflectance_TrueColor/"
+            "default/2018-11-20/250m/8/"
+        ),
+        content=mock_image,
+    )
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 1,
+            "bbox": [
+                123.59349578619005,
+                -10.188159969024264,
+                123.70257586240771,
+                -10.113232998848046,
+            ],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "crs": "EPSG:4326",
+        }
+    )
+
+    result = modis_instance.fetch(query, dry_run=False)
+
+    assert len(result.features) == 1
+    # Two tiles of 1.125 degrees
+    assert result.features[0]["bbox"] == (122.625, -11.25, 123.75, -9.0)
+    img_filename = "/tmp/output/%s" % result.features[0]["properties"]["up42.data_path"]
+    assert cog_validate(img_filename)[0]
+    with rio.open(img_filename) as dataset:
+        assert dataset.crs.to_epsg() == 4326
+        assert dataset.shape == (1024, 512)
+        assert dataset.block_shapes[0] == (256, 256)
+        assert tuple(dataset.bounds) == (122.625, -11.25, 123.75, -9.0)
+        assert np.sum(dataset.read(2)) == 8 * 7954025
+
+
+def test_aoiclipped_fetcher_fetch_metrics(gibs_mock, modis_instance):
+    """
+    Mocked test for the metrics written next to data.json and added to the features
+    """
+
+    query = STACQuery.from_dict(
+        {
+            "zoom_level": 9,
+            "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+            "limit": 1,
+            "bbox": [
+                123.59349578619005,
+                -10.188159969024264,
+                123.70257586240771,
+                -10.113232998848046,
+            ],
+            "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+            "include_metrics": True,
+        }
+    )
+
+    result = modis_instance.fetch(query, dry_run=False)
+
+    feature_metrics = result.features[0]["properties"]["metrics"]
+    # The tile downloaded to count the bands is downloaded again for the mosaic, no
+    # tile cache is configured
+    assert feature_metrics["tiles"] == 2
+    assert feature_metrics["cache_hit_ratio"] == {}
+    assert feature_metrics["bytes_transferred"] > 0
+    for stage in ["download", "decode", "merge", "post_process", "cog", "quicklook"]:
+        assert stage in feature_metrics["stages"]
+
+    with open("/tmp/output/metrics.json", encoding="utf-8") as metrics_file:
+        job_metrics = json.load(metrics_file)
+    assert "catalog" in job_metrics["stages"]
+    assert "tile_cover" in job_metrics["stages"]
+    assert job_metrics["dates"] == {"2018-11-20": feature_metrics}
+
+
 def test_aoiclipped_dry_run_error_name_fetcher_fetch(requests_mock, modis_instance):
     """
     Mocked test for fetching data with error in name
@@ -0,0 +1,108 @@
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.io import MemoryFile
+
+from context import BufferPool, Modis, TileCoverage
+
+from blockutils.wmts import TileMergeHelper
+
+TEST_LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+
+
+def test_buffer_pool():
+    pool = BufferPool(max_buffers=1)
+    with pool.array((3, 4, 4), np.uint8) as array:
+        assert not array.any()
+        array[:] = 1
+    with pool.array((2, 4, 4), np.uint8) as smaller:
+        # Reuses the buffer, zeroed again
+        assert not smaller.any()
+        with pool.array((3, 4, 4), np.uint8) as other:
+            assert not np.shares_memory(smaller, other)
+    assert (pool.allocated, pool.reused) == (2, 1)
+
+    with pool.array((3, 8, 8), np.uint8):
+        pass
+    assert pool.allocated == 3
+
+
+# Comparing arrays of different sizes warns before numpy 1.25 and raises since
+@pytest.mark.filterwarnings("error::DeprecationWarning")
+def test_buffer_pool_takes_from_buffers_of_different_sizes():
+    pool = BufferPool(max_buffers=2)
+    with pool.array((2, 4, 4), np.uint8):
+        with pool.array((3, 4, 4), np.uint8):
+            pass
+    with pool.array((1, 4, 4), np.uint8) as array:
+        assert array.base.nbytes == 2 * 4 * 4
+    with pool.array((3, 4, 4), np.uint8):
+        pass
+    assert (pool.allocated, pool.reused) == (2, 2)
+
+
+def test_merge_layer_matches_tile_files(requests_mock, tmp_path):
+    """
+    The pooled mosaic gives the image of merging tile files with `TileMergeHelper`,
+    also when the tiles at the edge of the grid are empty
+    """
+    _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    with open(os.path.join(_location_, "mock_data/tile.jpg"), "rb") as tile_file:
+        mock_image = tile_file.read()
+    with MemoryFile() as mem_file:
+        with mem_file.open(
+            driver="PNG", width=256, height=256, count=3, dtype="uint8"
+        ) as image:
+            image.write(np.zeros((3, 256, 256), dtype=np.uint8))
+        empty_image = mem_file.read()
+
+    # 3 x 2 tiles, the last column is empty
+    tile_list = [mercantile.Tile(x, y, 9) for y in (178, 179) for x in (270, 271, 272)]
+
+    def tile_content(request, _):
+        return empty_image if request.path.endswith("/272.jpeg") else mock_image
+
+    requests_mock.get(
+        re.compile(f"/wmts/epsg3857/best/{TEST_LAYER}/"), content=tile_content
+    )
+    layers = OrderedDict(
+        [
+            (
+                TEST_LAYER,
+                {"Format": "jpeg", "TileMatrixSet": "GoogleMapsCompatible_Level9"},
+            )
+        ]
+    )
+
+    modis = Modis()
+    modis.buffer_pool = BufferPool()
+    coverage = TileCoverage()
+    merged = Path(tmp_path / "merged.tif")
+    for _ in range(2):
+        valid_tiles = modis.merge_layer(
+            tile_list, layers, TEST_LAYER, "2019-06-30", coverage, merged
+        )
+    assert sorted(valid_tiles) == sorted(tile for tile in tile_list if tile.x < 272)
+    assert sorted(coverage.fractions) == sorted(valid_tiles)
+    # The second merge reuses the mosaic of the first
+    assert (modis.buffer_pool.allocated, modis.buffer_pool.reused) == (1, 1)
+
+    expected = Path(tmp_path / "expected.tif")
+    TileMergeHelper(
+        tile_list,
+        req=modis.api.requests_wmts_tile,
+        req_kwargs={"layer": TEST_LAYER, "date": "2019-06-30", "img_format": "jpeg"},
+        crs="EPSG:3857",
+    ).get_final_image(expected, return_cog=False)
+
+    with rio.open(merged) as result, rio.open(expected) as reference:
+        assert result.shape == reference.shape == (512, 512)
+        assert result.transform.almost_equals(reference.transform)
+        assert result.crs == reference.crs
+        np.testing.assert_array_equal(result.read(), reference.read())
@@ -0,0 +1,110 @@
+"""
+Unit tests for the COG overviews built from the native GIBS pyramid
+"""
+
+import os
+import re
+
+import mercantile
+import numpy as np
+import rasterio as rio
+import requests_mock as mock
+from rasterio.transform import from_bounds
+from rio_cogeo.cogeo import cog_validate
+
+from context import (
+    COMPRESSION_PROFILES,
+    GibsAPI,
+    overview_tile_range,
+    to_cog,
+    write_native_overviews,
+)
+
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+DATE = "2019-06-20"
+TILE_PATH = os.path.join(os.path.dirname(__file__), "mock_data/tile.jpg")
+LAYERS = {LAYER: {"Format": "jpeg", "bands_count": 3}}
+
+
+def write_mosaic(path, tiles_per_side, first_tile):
+    last_tile = mercantile.Tile(
+        first_tile.x + tiles_per_side - 1, first_tile.y + tiles_per_side - 1, 9
+    )
+    size = tiles_per_side * 256
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=3,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_bounds(
+            mercantile.xy_bounds(first_tile).left,
+            mercantile.xy_bounds(last_tile).bottom,
+            mercantile.xy_bounds(last_tile).right,
+            mercantile.xy_bounds(first_tile).top,
+            size,
+            size,
+        ),
+    ) as dst:
+        dst.write(np.full((3, size, size), 10, dtype=np.uint8))
+        dst.update_tags(1, layer=LAYER, band=1)
+
+
+def test_overview_tile_range(tmp_path):
+    write_mosaic(tmp_path / "mosaic.tif", 3, mercantile.Tile(301, 200, 9))
+    with rio.open(tmp_path / "mosaic.tif") as src:
+        transform = src.transform * rio.Affine.scale(2)
+
+    x_range, y_range, col_offset, row_offset = overview_tile_range(
+        transform, 384, 384, 8
+    )
+
+    assert x_range == range(150, 152)
+    assert y_range == range(100, 102)
+    assert (col_offset, row_offset) == (128, 0)
+
+
+def test_write_native_overviews(tmp_path):
+    img_filename = tmp_path / "mosaic.tif"
+    write_mosaic(img_filename, 3, mercantile.Tile(301, 200, 9))
+    with open(TILE_PATH, "rb") as tile_file:
+        tile = tile_file.read()
+    with rio.open(TILE_PATH) as src:
+        expected = src.read()
+
+    with mock.Mocker() as mocker:
+        mocker.get(re.compile(f"/{LAYER}/default/{DATE}/"), content=tile)
+        overviews = write_native_overviews(
+            img_filename, GibsAPI(), LAYERS, DATE, zoom_level=9, blocksize=256
+        )
+        requested_zooms = sorted(
+            {req.path.split("/")[-3] for req in mocker.request_history}
+        )
+
+    assert requested_zooms == ["7", "8"]
+    assert [overview.name for overview in overviews] == [
+        "mosaic.ovr1.tif",
+        "mosaic.ovr2.tif",
+    ]
+    with rio.open(overviews[0]) as level1:
+        assert level1.shape == (384, 384)
+        # The image starts in the right half of its zoom 8 parent tile
+        np.testing.assert_array_equal(
+            level1.read()[:, :256, :128], expected[:, :, 128:]
+        )
+
+    to_cog(img_filename, COMPRESSION_PROFILES["balanced"], overviews=overviews)
+
+    assert cog_validate(img_filename)[0]
+    assert not any(overview.exists() for overview in overviews)
+    with rio.open(img_filename) as dataset:
+        assert dataset.overviews(1) == [2, 4]
+        assert dataset.tags(1)["layer"] == LAYER
+        assert dataset.read(1).max() == 10
+    with rio.open(img_filename, OVERVIEW_LEVEL=0) as level1:
+        np.testing.assert_array_equal(
+            level1.read()[:, :256, :128], expected[:, :, 128:]
+        )
@@ -0,0 +1,94 @@
+"""
+Unit tests for the tile cache warm-up command
+"""
+
+# pylint: disable=unused-argument
+# gibs_mock used as fixture in tests
+import json
+import time
+
+import pytest
+
+from context import (
+    GibsAPI,
+    RateLimiter,
+    TileCache,
+    get_prefetch_dates,
+    get_prefetch_tiles,
+    load_geometries,
+    prefetch,
+)
+
+BBOX_GEOMETRY = {
+    "type": "Polygon",
+    "coordinates": [
+        [
+            [123.59349578619005, -10.188159969024264],
+            [123.70257586240771, -10.188159969024264],
+            [123.70257586240771, -10.113232998848046],
+            [123.59349578619005, -10.113232998848046],
+            [123.59349578619005, -10.188159969024264],
+        ]
+    ],
+}
+
+
+def test_load_geometries(tmp_path):
+    geojson_path = tmp_path / "aois.geojson"
+    with open(geojson_path, "w", encoding="utf-8") as out:
+        json.dump(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {"type": "Feature", "geometry": BBOX_GEOMETRY, "properties": {}}
+                ]
+                * 2,
+            },
+            out,
+        )
+    assert load_geometries(geojson_path) == [BBOX_GEOMETRY, BBOX_GEOMETRY]
+
+
+def test_get_prefetch_dates():
+    assert get_prefetch_dates("2019-04-29", "2019-05-02") == [
+        "2019-04-29",
+        "2019-04-30",
+        "2019-05-01",
+        "2019-05-02",
+    ]
+
+
+def test_get_prefetch_tiles_deduplicates():
+    tiles = get_prefetch_tiles([BBOX_GEOMETRY, BBOX_GEOMETRY], 9)
+    assert len(tiles) == 1
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(6):
+        rate_limiter.wait()
+    assert time.monotonic() - start >= 0.1
+
+
+def test_prefetch(gibs_mock, tmp_path):
+    api = GibsAPI(tile_cache=TileCache(tmp_path))
+    layers = [
+        "MODIS_Terra_CorrectedReflectance_TrueColor",
+        "MODIS_Aqua_CorrectedReflectance_TrueColor",
+    ]
+    dates = ["2019-04-29", "2019-04-30"]
+
+    assert prefetch(api, [BBOX_GEOMETRY], layers, dates, rate=0) == (4, 0, 0)
+    assert TileCache(tmp_path).capabilities_path.exists()
+    assert len(list((tmp_path / "tiles").rglob("*.jpeg"))) == 4
+
+    calls = gibs_mock.call_count
+    assert prefetch(api, [BBOX_GEOMETRY], layers, dates, rate=0) == (0, 4, 0)
+    assert gibs_mock.call_count == calls
+
+
+def test_prefetch_unknown_layer(gibs_mock, tmp_path):
+    api = GibsAPI(tile_cache=TileCache(tmp_path))
+    with pytest.raises(ValueError, match="UNKNOWN"):
+        prefetch(api, [BBOX_GEOMETRY], ["UNKNOWN"], ["2019-04-29"])
@@ -0,0 +1,55 @@
+"""
+Unit tests for the opt-in profiling of jobs
+"""
+
+import pytest
+
+from context import STACQuery, profile_job, profiling_enabled
+
+
+def make_query(**params):
+    return STACQuery.from_dict({"bbox": [10, 10, 11, 11], **params})
+
+
+@pytest.mark.parametrize(
+    "params, env_value, expected",
+    [
+        ({}, None, False),
+        ({"profile": True}, None, True),
+        ({}, "1", True),
+        ({}, "true", True),
+        ({}, "0", False),
+        ({"profile": False}, "no", False),
+    ],
+)
+def test_profiling_enabled(monkeypatch, params, env_value, expected):
+    if env_value is None:
+        monkeypatch.delenv("MODIS_PROFILE", raising=False)
+    else:
+        monkeypatch.setenv("MODIS_PROFILE", env_value)
+    assert profiling_enabled(make_query(**params)) == expected
+
+
+def test_profile_job_writes_artifacts(tmp_path):
+    with profile_job(tmp_path):
+        data = [bytearray(1024) for _ in range(100)]
+    assert len(data) == 100
+
+    assert (tmp_path / "profile.prof").stat().st_size > 0
+    assert "cumulative" in (tmp_path / "profile_stats.txt").read_text(encoding="utf-8")
+    assert "test_profiling.py" in (tmp_path / "profile_allocations.txt").read_text(
+        encoding="utf-8"
+    )
+
+
+def test_profile_job_disabled(tmp_path):
+    with profile_job(tmp_path, enabled=False):
+        pass
+    assert not list(tmp_path.iterdir())
+
+
+def test_profile_job_writes_artifacts_on_error(tmp_path):
+    with pytest.raises(ValueError):
+        with profile_job(tmp_path):
+            raise ValueError
+    assert (tmp_path / "profile.prof").exists()
@@ -0,0 +1,30 @@
+import mercantile
+from geojson import Feature
+
+from context import get_tile_grid, latest_features, preview_level
+
+
+def test_preview_level():
+    # 3 x 3 tiles at zoom 9 are covered by 4 tiles at zoom 8 at most
+    tile_list = [
+        mercantile.Tile(x, y, 9) for y in range(176, 179) for x in range(268, 271)
+    ]
+    transform, width, height = get_tile_grid(tile_list)
+    assert preview_level(transform, width, height, 9) == 1
+    assert preview_level(transform, width, height, 9, max_tiles=1) == 2
+
+    tile = mercantile.Tile(270, 178, 9)
+    assert preview_level(*get_tile_grid([tile]), 9) == 1
+    assert preview_level(*get_tile_grid([mercantile.Tile(0, 0, 0)]), 0) == 0
+
+
+def test_latest_features():
+    previews = [
+        Feature(id=str(index), properties={"preview": True}) for index in range(3)
+    ]
+    final = Feature(id="1", properties={})
+    dropped = Feature(id="0", properties={"dropped": True})
+
+    assert latest_features(previews + [final, dropped]) == [final, previews[2]]
+    # Dropped features without preview are kept as they are
+    assert latest_features([dropped]) == [dropped]
@@ -0,0 +1,97 @@
+"""
+Tests for sharded fetches, with the workers in separate processes
+"""
+
+# pylint: disable=wrong-import-order
+import multiprocessing
+
+import numpy as np
+import pytest
+import rasterio as rio
+
+from context import (
+    Modis,
+    STACQuery,
+    Unit,
+    assemble,
+    load_plan,
+    plan_units,
+    run_worker,
+    unit_paths,
+    write_plan,
+)
+
+from blockutils.exceptions import UP42Error
+
+from benchmarks.bench_fetch import make_query
+from benchmarks.gibs_stub_server import GibsStubServer
+
+
+def stub_modis(server: GibsStubServer) -> Modis:
+    modis = Modis()
+    modis.api.wmts_url = server.wmts_url
+    modis.api.wms_url = server.wms_url
+    return modis
+
+
+def test_plan_units():
+    plan = {"dates": ["2019-06-29", "2019-06-30"], "layers": {"a": {}, "b": {}}}
+    plan["chunks"] = [{}, {}, {}]
+    units = plan_units(plan)
+    assert len(units) == 12
+    assert units[:4] == [
+        Unit("2019-06-29", 0, 0),
+        Unit("2019-06-29", 0, 1),
+        Unit("2019-06-29", 0, 2),
+        Unit("2019-06-29", 1, 0),
+    ]
+    assert units[-1].name == "2019-06-30_1_2"
+
+
+def test_sharded_fetch_matches_single_node(tmp_path):
+    query = make_query({"aoi_tiles": 3, "layers": 2, "dates": 2})
+    with GibsStubServer() as server:
+        single_node = stub_modis(server).fetch(
+            STACQuery.from_dict(query), dry_run=False
+        )
+
+        plan = write_plan(query, tmp_path, shard_tiles=2, modis=stub_modis(server))
+        assert len(plan["chunks"]) == 6
+        with pytest.raises(UP42Error, match="not completed"):
+            assemble(tmp_path)
+
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=run_worker, args=(tmp_path, index, 2))
+            for index in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert [worker.exitcode for worker in workers] == [0, 0]
+        assert all(
+            unit_paths(tmp_path, unit)[1].is_file()
+            for unit in plan_units(load_plan(tmp_path))
+        )
+        # Completed units are not run again
+        assert run_worker(tmp_path, 0, 1) == 0
+
+        sharded = assemble(tmp_path)
+
+    assert len(sharded.features) == len(single_node.features) == 2
+    for sharded_feature, feature in zip(sharded.features, single_node.features):
+        assert sharded_feature["bbox"] == feature["bbox"]
+        assert (
+            sharded_feature["properties"]["coverage"]
+            == feature["properties"]["coverage"]
+        )
+        with rio.open(
+            "/tmp/output/%s" % sharded_feature["properties"]["up42.data_path"]
+        ) as sharded_image, rio.open(
+            "/tmp/output/%s" % feature["properties"]["up42.data_path"]
+        ) as image:
+            assert sharded_image.count == image.count == 6
+            assert sharded_image.tags(4) == image.tags(4)
+            assert sharded_image.transform.almost_equals(image.transform)
+            np.testing.assert_array_equal(sharded_image.read(), image.read())
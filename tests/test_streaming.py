@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+from geojson import Feature, FeatureCollection
+
+from context import FeatureCollectionWriter
+
+from blockutils.common import save_metadata
+
+
+def test_feature_collection_writer(tmp_path):
+    path = tmp_path / "data.json"
+    features = [
+        Feature(id=str(index), bbox=[0, 0, 1, 1], properties={"up42.data_path": "a"})
+        for index in range(3)
+    ]
+    with FeatureCollectionWriter(path) as writer:
+        assert json.loads(path.read_text(encoding="utf-8")) == FeatureCollection([])
+        for count, feature in enumerate(features, 1):
+            writer.append(feature)
+            # A valid collection after every feature
+            assert (
+                json.loads(path.read_text(encoding="utf-8"))["features"]
+                == features[:count]
+            )
+    assert writer.count == 3
+
+    # Same file as written at once
+    save_metadata(FeatureCollection(features))
+    with open("/tmp/output/data.json", encoding="utf-8") as data_json:
+        assert path.read_text(encoding="utf-8") == data_json.read()
+
+
+def test_feature_collection_writer_replaces_previews(tmp_path):
+    path = tmp_path / "data.json"
+    previews = [
+        Feature(id=str(index), bbox=[0, 0, 1, 1], properties={"preview": True})
+        for index in range(3)
+    ]
+    final = Feature(id="1", bbox=[0, 0, 1, 1], properties={"up42.data_path": "1.tif"})
+    dropped = Feature(id="0", bbox=[0, 0, 1, 1], properties={"dropped": True})
+    with FeatureCollectionWriter(path) as writer:
+        writer.extend(previews)
+        writer.append(final)
+        # In place of the preview
+        assert json.loads(path.read_text(encoding="utf-8"))["features"] == [
+            previews[0],
+            final,
+            previews[2],
+        ]
+        writer.append(dropped)
+        assert json.loads(path.read_text(encoding="utf-8"))["features"] == [
+            final,
+            previews[2],
+        ]
+        writer.append(Feature(id="3", bbox=[0, 0, 1, 1]))
+    assert writer.count == 3
+    assert [
+        feature["id"]
+        for feature in json.loads(path.read_text(encoding="utf-8"))["features"]
+    ] == [
+        "1",
+        "2",
+        "3",
+    ]
+
+
+def test_feature_collection_writer_survives_failed_rewrite(tmp_path, monkeypatch):
+    path = tmp_path / "data.json"
+
+    def failing_write_atomic(*_):
+        raise OSError("No space left on device")
+
+    with FeatureCollectionWriter(path) as writer:
+        writer.append(Feature(id="0", properties={"preview": True}))
+        with monkeypatch.context() as patch:
+            patch.setattr("src.streaming.write_atomic", failing_write_atomic)
+            with pytest.raises(OSError):
+                writer.append(Feature(id="0", properties={"up42.data_path": "0.tif"}))
+        writer.append(Feature(id="1"))
+    assert [
+        feature["properties"]
+        for feature in json.loads(path.read_text(encoding="utf-8"))["features"]
+    ] == [{"preview": True}, {}]
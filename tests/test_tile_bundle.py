@@ -0,0 +1,95 @@
+"""
+Unit tests for offline tile bundles
+"""
+
+import os
+
+import pytest
+import rasterio as rio
+from mercantile import Tile
+
+from context import GibsAPI, Modis, STACQuery, TileBundle, pack
+
+from blockutils.exceptions import UP42Error
+
+BBOX = [
+    123.59349578619005,
+    -10.188159969024264,
+    123.70257586240771,
+    -10.113232998848046,
+]
+BBOX_GEOMETRY = {
+    "type": "Polygon",
+    "coordinates": [
+        [
+            [BBOX[0], BBOX[1]],
+            [BBOX[2], BBOX[1]],
+            [BBOX[2], BBOX[3]],
+            [BBOX[0], BBOX[3]],
+            [BBOX[0], BBOX[1]],
+        ]
+    ],
+}
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+
+
+def test_tile_bundle_roundtrip(tmp_path):
+    path = tmp_path / "test.bundle"
+    tile = Tile(1, 2, 9)
+    bundle = TileBundle(path, writable=True)
+    bundle.put_tile(tile, LAYER, "2021-03-01", "jpeg", b"tile")
+    bundle.put_tile(tile, LAYER, "2021-03-01", "jpeg", b"tile", crs="EPSG:4326")
+    bundle.put_capabilities(b"capabilities")
+    bundle.put_quicklook(LAYER, "2021-03-01", (1.0, 2.0, 3.0, 4.0), b"quicklook")
+    assert bundle.has_tile(tile, LAYER, "2021-03-01", "jpeg")
+    bundle.close()
+
+    bundle = TileBundle(path)
+    assert bundle.get_tile(tile, LAYER, "2021-03-01", "jpeg") == b"tile"
+    assert bundle.get_tile(tile, LAYER, "2021-03-02", "jpeg") is None
+    assert bundle.get_tile(Tile(2, 1, 9), LAYER, "2021-03-01", "jpeg") is None
+    assert bundle.get_capabilities() == b"capabilities"
+    assert bundle.get_capabilities("EPSG:4326") is None
+    assert (
+        bundle.get_quicklook(LAYER, "2021-03-01", [1.0000001, 2.0, 3.0, 4.0])
+        == b"quicklook"
+    )
+    bundle.close()
+
+    with pytest.raises(FileNotFoundError):
+        TileBundle(tmp_path / "missing.bundle")
+
+
+def test_fetch_from_bundle(gibs_mock, tmp_path):
+    path = tmp_path / "test.bundle"
+    bundle = TileBundle(path, writable=True)
+    downloaded, packed, failed = pack(
+        bundle, GibsAPI(), [BBOX_GEOMETRY], [LAYER], ["2021-03-01"], zoom_level=9
+    )
+    assert (downloaded, packed, failed) == (1, 0, 0)
+    bundle.close()
+    call_count = gibs_mock.call_count
+
+    modis = Modis()
+    modis.api.tile_bundle = TileBundle(path)
+    query = {
+        "zoom_level": 9,
+        "time": "2021-03-01T00:00:00+00:00/2021-03-01T23:59:59+00:00",
+        "limit": 1,
+        "bbox": BBOX,
+        "imagery_layers": [LAYER],
+    }
+    result = modis.fetch(STACQuery.from_dict(query), dry_run=False)
+
+    # Everything was served from the bundle
+    assert gibs_mock.call_count == call_count
+    feature = result.features[0]
+    assert os.path.isfile("/tmp/quicklooks/%s.jpg" % feature["id"])
+    with rio.open("/tmp/output/%s" % feature["properties"]["up42.data_path"]) as src:
+        assert src.shape == (256, 256)
+    assert modis.metrics.cache["bundle"]["hits"] > 0
+
+    query["time"] = "2021-03-02T00:00:00+00:00/2021-03-02T23:59:59+00:00"
+    with pytest.raises(UP42Error, match="not in the tile bundle"):
+        modis.fetch(STACQuery.from_dict(query), dry_run=False)
+    assert gibs_mock.call_count == call_count
@@ -0,0 +1,121 @@
+"""
+Unit tests for the on-disk tile and capabilities cache
+"""
+
+import os
+import re
+import time
+
+import mercantile
+import requests_mock as mock
+
+from context import GibsAPI, TileCache
+
+TILE = mercantile.Tile(x=290, y=300, z=9)
+LAYER = "MODIS_Terra_CorrectedReflectance_TrueColor"
+DATE = "2019-06-20"
+
+
+def test_put_and_get_tile(tmp_path):
+    cache = TileCache(tmp_path)
+    assert cache.get_tile(TILE, LAYER, DATE, "jpeg") is None
+    assert not cache.has_tile(TILE, LAYER, DATE, "jpeg")
+
+    cache.put_tile(TILE, LAYER, DATE, "jpeg", b"payload")
+
+    assert cache.has_tile(TILE, LAYER, DATE, "jpeg")
+    assert cache.get_tile(TILE, LAYER, DATE, "jpeg") == b"payload"
+    assert cache.tile_path(TILE, LAYER, DATE, "jpeg") == (
+        tmp_path / "tiles" / LAYER / DATE / "9" / "300" / "290.jpeg"
+    )
+    assert not list(cache.tile_path(TILE, LAYER, DATE, "jpeg").parent.glob("*.tmp"))
+
+
+def test_crs_entries_are_separate(tmp_path):
+    cache = TileCache(tmp_path)
+    cache.put_tile(TILE, LAYER, DATE, "jpeg", b"mercator")
+    cache.put_tile(TILE, LAYER, DATE, "jpeg", b"geographic", "EPSG:4326")
+    cache.put_capabilities(b"<mercator/>")
+    cache.put_capabilities(b"<geographic/>", "EPSG:4326")
+
+    assert cache.get_tile(TILE, LAYER, DATE, "jpeg") == b"mercator"
+    assert cache.get_tile(TILE, LAYER, DATE, "jpeg", "EPSG:4326") == b"geographic"
+    assert cache.tile_path(TILE, LAYER, DATE, "jpeg", "EPSG:4326") == (
+        tmp_path / "tiles_epsg4326" / LAYER / DATE / "9" / "300" / "290.jpeg"
+    )
+    assert cache.get_capabilities() == b"<mercator/>"
+    assert cache.get_capabilities("EPSG:4326") == b"<geographic/>"
+
+
+def test_capabilities_max_age(tmp_path):
+    cache = TileCache(tmp_path, capabilities_max_age=60)
+    assert cache.get_capabilities() is None
+    cache.put_capabilities(b"<xml/>")
+    assert cache.get_capabilities() == b"<xml/>"
+
+    outdated = time.time() - 120
+    os.utime(cache.capabilities_path, (outdated, outdated))
+    assert cache.get_capabilities() is None
+
+
+def test_prune(tmp_path):
+    cache = TileCache(tmp_path)
+    for index, x in enumerate(range(290, 294)):
+        tile = mercantile.Tile(x=x, y=300, z=9)
+        cache.put_tile(tile, LAYER, DATE, "jpeg", b"1234")
+        written = time.time() - 100 + index
+        os.utime(cache.tile_path(tile, LAYER, DATE, "jpeg"), (written, written))
+    cache.put_capabilities(b"<xml/>")
+
+    assert cache.prune(8) == 2
+    assert not cache.has_tile(mercantile.Tile(x=291, y=300, z=9), LAYER, DATE, "jpeg")
+    assert cache.has_tile(mercantile.Tile(x=292, y=300, z=9), LAYER, DATE, "jpeg")
+    assert cache.get_capabilities() == b"<xml/>"
+    assert cache.prune(8) == 0
+
+
+def test_from_env(monkeypatch, tmp_path):
+    monkeypatch.delenv("MODIS_CACHE_DIR", raising=False)
+    assert TileCache.from_env() is None
+
+    monkeypatch.setenv("MODIS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("MODIS_CAPABILITIES_MAX_AGE", "10")
+    cache = TileCache.from_env()
+    assert cache.cache_dir == tmp_path
+    assert cache.capabilities_max_age == 10
+
+
+def test_gibs_api_serves_tiles_from_cache(requests_mock, tmp_path):
+    requests_mock.get(mock.ANY, content=b"tile")
+    api = GibsAPI(tile_cache=TileCache(tmp_path))
+
+    first = api.requests_wmts_tile(TILE, LAYER, DATE)
+    second = api.requests_wmts_tile(TILE, LAYER, DATE)
+
+    assert first.content == second.content == b"tile"
+    assert second.status_code == 200
+    assert requests_mock.call_count == 1
+    assert api.metrics.summary()["cache_hit_ratio"] == {"tiles": 0.5}
+
+
+def test_gibs_api_serves_capabilities_from_cache(requests_mock, tmp_path):
+    _location_ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    with open(
+        os.path.join(_location_, "mock_data/available_imagery_layers.xml"), "rb"
+    ) as xml_file:
+        mock_xml: object = xml_file.read()
+    requests_mock.get(re.compile("WMTSCapabilities.xml"), content=mock_xml)
+
+    GibsAPI(tile_cache=TileCache(tmp_path)).get_dict_available_imagery_layers()
+    imagery_layers = GibsAPI(
+        tile_cache=TileCache(tmp_path)
+    ).get_dict_available_imagery_layers()
+
+    assert len(imagery_layers) == 45
+    assert requests_mock.call_count == 1
+
+
+def test_gibs_api_does_not_cache_errors(requests_mock, tmp_path):
+    requests_mock.get(re.compile("WMTSCapabilities.xml"), status_code=500)
+    GibsAPI(tile_cache=TileCache(tmp_path)).get_capabilities()
+    assert not TileCache(tmp_path).capabilities_path.exists()
@@ -0,0 +1,146 @@
+# pylint: disable=unused-argument
+# gibs_mock used as fixture in tests
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio as rio
+
+from context import Modis, Worker, job_status, submit_job
+
+from blockutils.exceptions import SupportedErrors, UP42Error
+
+QUERY = {
+    "zoom_level": 9,
+    "time": "2018-11-01T16:40:49+00:00/2018-11-20T16:41:49+00:00",
+    "limit": 2,
+    "bbox": [
+        123.59349578619005,
+        -10.188159969024264,
+        123.70257586240771,
+        -10.113232998848046,
+    ],
+    "imagery_layers": ["MODIS_Terra_CorrectedReflectance_TrueColor"],
+}
+
+
+def capabilities_requests(gibs_mock) -> int:
+    return sum(
+        "WMTSCapabilities.xml" in request.url for request in gibs_mock.request_history
+    )
+
+
+def read_result(output_dir: Path):
+    with open(output_dir / "data.json", encoding="utf-8") as data_json:
+        features = json.load(data_json)["features"]
+    images = []
+    for feature in features:
+        with rio.open(output_dir / feature["properties"]["up42.data_path"]) as dataset:
+            images.append(dataset.read())
+        del feature["id"]
+        del feature["properties"]["up42.data_path"]
+    return features, images
+
+
+def block_outputs() -> set:
+    return set(Path("/tmp/output").iterdir()) | set(Path("/tmp/quicklooks").iterdir())
+
+
+def test_worker_runs_jobs_like_block_runs(gibs_mock, tmp_path, monkeypatch):
+    outputs_before = block_outputs()
+    spool_dir = tmp_path / "spool"
+    job_ids = [
+        submit_job(spool_dir, QUERY),
+        submit_job(spool_dir, {**QUERY, "imagery_layers": ["unknown"]}),
+        submit_job(spool_dir, QUERY, dry_run=True),
+    ]
+    assert job_ids == sorted(job_ids)
+    assert job_status(spool_dir, job_ids[0]) is None
+
+    assert Worker(spool_dir, poll_interval=0.01).serve(exit_when_idle=True) == 3
+    # The capabilities are downloaded once for all jobs
+    assert capabilities_requests(gibs_mock) == 1
+
+    status = job_status(spool_dir, job_ids[0])
+    assert status["exit_code"] == 0
+    output_dir = spool_dir / "done" / job_ids[0] / "output"
+    assert len(list((spool_dir / "done" / job_ids[0] / "quicklooks").iterdir())) == 2
+    features, images = read_result(output_dir)
+    assert len(features) == 2
+
+    status = job_status(spool_dir, job_ids[1])
+    assert status["exit_code"] == SupportedErrors.INPUT_PARAMETERS_ERROR.value
+    assert "Invalid Layers" in status["error"]
+    assert (spool_dir / "failed" / job_ids[1] / "output").is_dir()
+
+    dry_run_output = spool_dir / "done" / job_ids[2] / "output"
+    assert not list(dry_run_output.glob("*.tif"))
+    assert (
+        len(
+            json.loads((dry_run_output / "data.json").read_text(encoding="utf-8"))[
+                "features"
+            ]
+        )
+        == 2
+    )
+
+    # Jobs write into their own directories, not the ones of block runs
+    assert block_outputs() == outputs_before
+    assert not list((spool_dir / "queue").iterdir())
+    assert not list((spool_dir / "running").iterdir())
+
+    # Same outputs as a block run
+    monkeypatch.setenv("UP42_TASK_PARAMETERS", json.dumps(QUERY))
+    Modis.run()
+    block_features, block_images = read_result(Path("/tmp/output"))
+    assert features == block_features
+    for image, block_image in zip(images, block_images):
+        np.testing.assert_array_equal(image, block_image)
+
+
+def test_worker_drops_checkpoint_of_failed_job(gibs_mock, tmp_path):
+    gibs_mock.get(re.compile("/default/2018-11-20/"), status_code=500)
+    outputs_before = block_outputs()
+    spool_dir = tmp_path / "spool"
+    job_id = submit_job(spool_dir, QUERY)
+
+    assert Worker(spool_dir).serve(exit_when_idle=True) == 1
+    assert capabilities_requests(gibs_mock) == 1
+    assert job_status(spool_dir, job_id)["exit_code"]
+    output_dir = spool_dir / "failed" / job_id / "output"
+    assert list(output_dir.glob("*.tif"))
+    assert not (output_dir / ".checkpoint").exists()
+    assert block_outputs() == outputs_before
+
+
+def test_worker_queues_jobs_of_stopped_worker_again(gibs_mock, tmp_path):
+    spool_dir = tmp_path / "spool"
+    job_id = submit_job(spool_dir, QUERY, dry_run=True)
+    worker = Worker(spool_dir)
+    assert worker.next_job() is not None
+    # Partial outputs of the stopped worker
+    (spool_dir / "running" / job_id / "output").mkdir(parents=True)
+
+    assert Worker(spool_dir).serve(exit_when_idle=True) == 1
+    assert job_status(spool_dir, job_id)["exit_code"] == 0
+
+
+def test_worker_prunes_tile_cache(gibs_mock, tmp_path, monkeypatch):
+    monkeypatch.delenv("MODIS_CACHE_DIR", raising=False)
+    spool_dir = tmp_path / "spool"
+    submit_job(spool_dir, QUERY)
+    worker = Worker(spool_dir, max_cache_mb=0)
+    assert worker.serve(exit_when_idle=True) == 1
+    assert capabilities_requests(gibs_mock) == 1
+    cached = [path for path in (spool_dir / "cache").rglob("*") if path.is_file()]
+    # Only the capabilities are left
+    assert [path.name for path in cached] == ["WMTSCapabilities.xml"]
+
+
+def test_worker_lock(tmp_path):
+    worker = Worker(tmp_path / "spool")
+    with worker.lock():
+        with pytest.raises(UP42Error, match="Another worker"):
+            Worker(tmp_path / "spool").serve(exit_when_idle=True)
@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import Affine
+
+from context import ZarrTimeSeries
+
+from blockutils.exceptions import UP42Error
+
+# 3 x 3 tiles of 256 pixels, 2 x 2 chunks of 512 pixels
+GRID = Affine(100.0, 0.0, 1000.0, 0.0, -100.0, 5000.0)
+BANDS = [[1, "layer_a", 1], [2, "layer_a", 2], [3, "layer_b", 1]]
+
+
+def write_mosaic(path, data, col_off, row_off):
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=data.shape[2],
+        height=data.shape[1],
+        count=data.shape[0],
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=GRID * Affine.translation(col_off, row_off),
+    ) as dst:
+        dst.write(data)
+
+
+def test_zarr_time_series(tmp_path):
+    store_path = tmp_path / "modis.zarr"
+    store = ZarrTimeSeries.create_or_open(
+        store_path, GRID, 768, 768, "EPSG:3857", BANDS
+    )
+    first = np.random.randint(1, 255, (3, 512, 512), dtype=np.uint8)
+    # Mosaic of the lower right 2 x 2 tiles
+    write_mosaic(tmp_path / "first.tif", first, 256, 256)
+    assert store.append("2021-03-01", tmp_path / "first.tif") == 0
+    first_chunks = {
+        chunk.name: chunk.read_bytes() for chunk in (store_path / "data").glob("0.*")
+    }
+
+    second = np.random.randint(1, 255, (3, 768, 768), dtype=np.uint8)
+    write_mosaic(tmp_path / "second.tif", second, 0, 0)
+    store = ZarrTimeSeries.create_or_open(
+        store_path, GRID, 768, 768, "EPSG:3857", BANDS
+    )
+    assert store.append("2021-03-02", tmp_path / "second.tif") == 1
+
+    # The chunks of the first date are not rewritten
+    assert {
+        chunk.name: chunk.read_bytes() for chunk in (store_path / "data").glob("0.*")
+    } == first_chunks
+    expected = np.zeros((3, 768, 768), dtype=np.uint8)
+    expected[:, 256:, 256:] = first
+    np.testing.assert_array_equal(store.read(0), expected)
+    np.testing.assert_array_equal(store.read(1), second)
+
+    with open(store_path / "data" / ".zarray", encoding="utf-8") as src:
+        metadata = json.load(src)
+    assert metadata["shape"] == [2, 3, 768, 768]
+    assert metadata["chunks"] == [1, 1, 512, 512]
+    time = np.concatenate(
+        [
+            np.frombuffer((store_path / "time" / str(i)).read_bytes(), dtype="<i4")
+            for i in range(2)
+        ]
+    )
+    np.testing.assert_array_equal(time, [18687, 18688])
+    layer = np.frombuffer((store_path / "layer" / "0").read_bytes(), dtype="<U7")
+    assert list(layer) == ["layer_a", "layer_a", "layer_b"]
+    x = np.frombuffer((store_path / "x" / "0").read_bytes(), dtype="<f8")
+    assert x[0] == 1050.0
+
+
+def test_zarr_time_series_overwrite_and_mismatch(tmp_path):
+    store_path = tmp_path / "modis.zarr"
+    store = ZarrTimeSeries.create_or_open(
+        store_path, GRID, 768, 768, "EPSG:3857", BANDS
+    )
+    data = np.ones((3, 768, 768), dtype=np.uint8)
+    write_mosaic(tmp_path / "mosaic.tif", data, 0, 0)
+    store.append("2021-03-01", tmp_path / "mosaic.tif")
+    write_mosaic(tmp_path / "mosaic.tif", data * 2, 0, 0)
+    assert store.append("2021-03-01", tmp_path / "mosaic.tif") == 0
+    assert store.dates == ["2021-03-01"]
+    np.testing.assert_array_equal(store.read(0), data * 2)
+
+    with pytest.raises(UP42Error, match="different grid or bands"):
+        ZarrTimeSeries.create_or_open(
+            store_path, GRID, 768, 768, "EPSG:3857", BANDS[:2]
+        )